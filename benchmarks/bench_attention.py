@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_attention.py
+
+Time, peak CUDA memory and numerical difference of one unify ``MultiheadAttention``
+self-attention layer at the size of the PolyFormer encoder (image patches
+followed by the padded expression), with the eager backend (bmm, bias add,
+softmax, bmm) versus the fused ``F.scaled_dot_product_attention`` backend.
+
+The attention gets the same inputs as in the encoder: a per-sample
+(bsz * heads, T, T) position bias as in training, or with ``--shared-bias``
+the (1, heads, T, T) bias that broadcasts over the batch at inference, and a
+key padding mask for the text padding. ``--backward`` also times the
+backward pass and compares the input and bias gradients.
+
+Typical usage:
+
+  python benchmarks/bench_attention.py --batch-size 8 --image-tokens 1024 --text-tokens 20
+  python benchmarks/bench_attention.py --batch-size 8 --dtype fp16 --backward
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import torch
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from models.polyformer.unify_multihead_attention import MultiheadAttention  # noqa: E402
+
+DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run(attn, x, bias, padding_mask, backward):
+    x = x.detach().requires_grad_(backward)
+    bias = bias.detach().requires_grad_(backward)
+    with torch.set_grad_enabled(backward):
+        out, _ = attn(x, x, x, key_padding_mask=padding_mask, need_weights=False, attn_bias=bias)
+        if backward:
+            out.float().square().mean().backward()
+    grads = (x.grad, bias.grad) if backward else ()
+    return out.detach(), grads
+
+
+def measure(attn, backend, inputs, backward, iters, device):
+    attn.set_attn_backend(backend)
+    run(attn, *inputs, backward)  # warm up
+    _sync(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(iters):
+        result = run(attn, *inputs, backward)
+    _sync(device)
+    elapsed = (time.perf_counter() - start) / iters
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20 if device.type == "cuda" else float("nan")
+    return result, elapsed, peak
+
+
+def max_rel_diff(a, b):
+    return ((a.float() - b.float()).abs().max() / b.float().abs().max().clamp(min=1e-12)).item()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark eager vs fused attention of the unify encoder")
+    ap.add_argument("--batch-size", default=8, type=int)
+    ap.add_argument("--image-tokens", default=1024, type=int, help="Image patches, e.g. 32x32 for 512x512 images")
+    ap.add_argument("--text-tokens", default=20, type=int, help="Padded expression length")
+    ap.add_argument("--embed-dim", default=768, type=int)
+    ap.add_argument("--heads", default=12, type=int)
+    ap.add_argument("--dtype", default="fp32", choices=sorted(DTYPES))
+    ap.add_argument("--shared-bias", action="store_true", help="One position bias broadcast over the batch")
+    ap.add_argument("--backward", action="store_true", help="Also time and compare the backward pass")
+    ap.add_argument("--iters", default=10, type=int, help="Timed iterations")
+    ap.add_argument("--cpu", action="store_true", help="Run on CPU even if CUDA is available")
+    args = ap.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    dtype = DTYPES[args.dtype]
+    torch.manual_seed(0)
+    attn = MultiheadAttention(args.embed_dim, args.heads, self_attention=True).to(device, dtype)
+    attn.eval()
+
+    bsz, heads = args.batch_size, args.heads
+    seq_len = args.image_tokens + args.text_tokens
+    x = torch.randn(seq_len, bsz, args.embed_dim, device=device, dtype=dtype)
+    if args.shared_bias:
+        bias = torch.randn(1, heads, seq_len, seq_len, device=device, dtype=dtype)
+    else:
+        bias = torch.randn(bsz * heads, seq_len, seq_len, device=device, dtype=dtype)
+    # the expressions have between half and all of the text tokens
+    text_lengths = torch.randint(args.text_tokens // 2, args.text_tokens + 1, (bsz,), device=device)
+    padding_mask = torch.zeros(bsz, seq_len, dtype=torch.bool, device=device)
+    padding_mask[:, args.image_tokens:] = (
+        torch.arange(args.text_tokens, device=device)[None, :] >= text_lengths[:, None]
+    )
+    inputs = (x, bias, padding_mask)
+
+    (ref_out, ref_grads), t_eager, m_eager = measure(attn, "eager", inputs, args.backward, args.iters, device)
+    (out, grads), t_sdpa, m_sdpa = measure(attn, "sdpa", inputs, args.backward, args.iters, device)
+
+    print(f"device={device} dtype={args.dtype} batch_size={bsz} seq_len={seq_len} heads={heads} "
+          f"shared_bias={args.shared_bias} backward={args.backward}")
+    print(f"{'backend':>8} {'ms/iter':>9} {'peak MB':>9}")
+    print(f"{'eager':>8} {t_eager * 1000:>9.2f} {m_eager:>9.0f}")
+    print(f"{'sdpa':>8} {t_sdpa * 1000:>9.2f} {m_sdpa:>9.0f}")
+    print(f"max relative difference: output {max_rel_diff(out, ref_out):.2e}", end="")
+    if args.backward:
+        print(f", input grad {max_rel_diff(grads[0], ref_grads[0]):.2e}, "
+              f"bias grad {max_rel_diff(grads[1], ref_grads[1]):.2e}", end="")
+    print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_checkpoint_load.py
+
+Load time and memory of N processes loading the same model at once, from a
+training checkpoint (unpickled by every process) versus from the inference
+checkpoint exported by ``tools/checkpoints/export_inference_checkpoint.py``
+(memory-mapped, shared through the page cache).
+
+Every worker loads the model with ``load_model_ensemble_and_task``, reports
+its memory from /proc and waits until all workers have loaded, so the shared
+pages are counted while all of them are alive. PSS splits shared pages
+between the processes mapping them; the sum of PSS is the memory the workers
+take together.
+
+Typical usage:
+
+  python tools/checkpoints/export_inference_checkpoint.py --input weights/polyformer_b_refcoco.pt \
+    --out weights/polyformer_b_refcoco.infer --dtype fp32
+  python benchmarks/bench_checkpoint_load.py --checkpoint weights/polyformer_b_refcoco.pt \
+    --inference-checkpoint weights/polyformer_b_refcoco.infer --workers 1,4
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+
+def memory_mb() -> dict:
+    """RssAnon / RssFile / VmHWM of this process and its PSS, in MB."""
+    result = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile", "VmHWM"):
+                result[key] = int(value.split()[0]) / 1024
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                if line.startswith("Pss:"):
+                    result["Pss"] = int(line.split()[1]) / 1024
+    except FileNotFoundError:
+        result["Pss"] = float("nan")
+    return result
+
+
+def worker(checkpoint: str) -> None:
+    from fairseq import utils
+
+    import models  # noqa: F401  (registers the polyformer architectures)
+    import tasks  # noqa: F401  (registers the refcoco task)
+    from utils.checkpoint_utils import load_model_ensemble_and_task
+
+    start = time.perf_counter()
+    models_, _, _ = load_model_ensemble_and_task(
+        utils.split_paths(checkpoint), arg_overrides={"bpe_dir": str(REPO_ROOT / "utils" / "BPE")}
+    )
+    models_[0].eval()
+    result = {"load_s": time.perf_counter() - start}
+    result.update(memory_mb())
+    print(json.dumps(result), flush=True)
+    # stay alive until every worker has loaded
+    sys.stdin.read()
+
+
+def run(checkpoint: str, workers: int) -> list:
+    procs = [
+        subprocess.Popen(
+            [sys.executable, __file__, "--worker", checkpoint],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, cwd=REPO_ROOT,
+        )
+        for _ in range(workers)
+    ]
+    results = []
+    for proc in procs:
+        line = proc.stdout.readline()
+        if not line:
+            raise RuntimeError("worker for {} failed".format(checkpoint))
+        results.append(json.loads(line))
+    for proc in procs:
+        proc.stdin.close()
+        proc.wait()
+    return results
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark training vs inference checkpoint loading")
+    ap.add_argument("--checkpoint", help="Training checkpoint")
+    ap.add_argument("--inference-checkpoint", help="The same checkpoint, exported for inference")
+    ap.add_argument("--workers", default="1,4", help="Comma separated numbers of concurrent loading processes")
+    ap.add_argument("--worker", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker is not None:
+        worker(args.worker)
+        return
+    if args.checkpoint is None or args.inference_checkpoint is None:
+        ap.error("--checkpoint and --inference-checkpoint are required")
+
+    # warm the file cache
+    run(args.checkpoint, 1)
+    run(args.inference_checkpoint, 1)
+
+    print(f"{'format':>9} {'workers':>7} {'load s':>7} {'anon MB':>8} {'file MB':>8} {'peak MB':>8} {'total PSS MB':>12}")
+    for workers in [int(w) for w in args.workers.split(",")]:
+        for name, checkpoint in (("training", args.checkpoint), ("inference", args.inference_checkpoint)):
+            results = run(checkpoint, workers)
+            mean = {key: sum(r[key] for r in results) / len(results) for key in results[0]}
+            total_pss = sum(r["Pss"] for r in results)
+            print(f"{name:>9} {workers:>7} {mean['load_s']:>7.2f} {mean['RssAnon']:>8.0f} {mean['RssFile']:>8.0f} "
+                  f"{mean['VmHWM']:>8.0f} {total_pss:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
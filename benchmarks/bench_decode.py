@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_decode.py
+
+Per-image latency of ``RefcocoTask.inference_step`` versus decode length, with
+and without the incremental (key/value cached) decoder.
+
+``min_len`` is set to the max length so that every sample decodes exactly
+``max_len`` steps; this makes the timings independent of when the model
+happens to predict EOS on the synthetic inputs.
+
+Typical usage:
+
+  python benchmarks/bench_decode.py \
+    --checkpoint weights/polyformer_b_refcoco.pt \
+    --batch-size 1 --max-lens 16,32,64,128,210
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+
+def load_model(checkpoint: str, use_cuda: bool, use_fp16: bool):
+    from fairseq import utils
+
+    import models  # noqa: F401  (registers the polyformer architectures)
+    import tasks  # noqa: F401  (registers the refcoco task)
+    from utils.checkpoint_utils import load_model_ensemble_and_task
+
+    overrides = {"bpe_dir": str(REPO_ROOT / "utils" / "BPE")}
+    models_, cfg, task = load_model_ensemble_and_task(utils.split_paths(checkpoint), arg_overrides=overrides)
+    model = models_[0]
+    model.eval()
+    if use_fp16:
+        model.half()
+    if use_cuda:
+        model.cuda()
+    return model, cfg, task
+
+
+def build_sample(task, batch_size: int, device: torch.device, dtype: torch.dtype):
+    from bert.tokenization_bert import BertTokenizer
+
+    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+    size = task.cfg.patch_image_size
+    prompt = ' which region does the text " {} " describe?'.format("the dog on the left")
+    tokenized = tokenizer.batch_encode_plus([prompt] * batch_size, padding="longest", return_tensors="pt")
+    att_masks = tokenized["attention_mask"]
+    generator = torch.Generator().manual_seed(7)
+    return {
+        "net_input": {
+            "src_tokens": tokenized["input_ids"].to(device),
+            "src_lengths": att_masks.ne(0).long().sum(1).to(device),
+            "att_masks": att_masks.to(device),
+            "patch_images": (torch.rand(batch_size, 3, size, size, generator=generator) * 2 - 1).to(device, dtype),
+            "patch_masks": torch.ones(batch_size, dtype=torch.bool, device=device),
+        }
+    }
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def time_decode(task, model, sample, max_len: int, incremental: bool, repeat: int, device: torch.device):
+    gen_out = task.inference_step(model, sample, min_len=max_len, max_len=max_len, incremental=incremental)
+    _sync(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        task.inference_step(model, sample, min_len=max_len, max_len=max_len, incremental=incremental)
+    _sync(device)
+    elapsed = (time.perf_counter() - start) / repeat
+    return elapsed, gen_out
+
+
+def max_coord_diff(gen_a, gen_b) -> float:
+    diff = 0.0
+    for a, b in zip(gen_a, gen_b):
+        a = np.asarray(a, dtype=np.float64)
+        b = np.asarray(b, dtype=np.float64)
+        if a.shape != b.shape:
+            return float("inf")
+        if a.size:
+            diff = max(diff, float(np.abs(a - b).max()))
+    return diff
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark full-prefix vs incremental polygon decoding")
+    ap.add_argument("--checkpoint", required=True, help="PolyFormer checkpoint (.pt)")
+    ap.add_argument("--batch-size", default=1, type=int)
+    ap.add_argument("--max-lens", default="16,32,64,128,210", help="Comma separated decode lengths")
+    ap.add_argument("--repeat", default=3, type=int, help="Timed repetitions per setting")
+    ap.add_argument("--cpu", action="store_true", help="Run on CPU even if CUDA is available")
+    ap.add_argument("--fp16", action="store_true", help="Cast the model to fp16 (CUDA only)")
+    args = ap.parse_args()
+
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    use_fp16 = args.fp16 and use_cuda
+    device = torch.device("cuda" if use_cuda else "cpu")
+    dtype = torch.half if use_fp16 else torch.float
+
+    model, _, task = load_model(args.checkpoint, use_cuda, use_fp16)
+    sample = build_sample(task, args.batch_size, device, dtype)
+
+    print(f"device={device} dtype={dtype} batch_size={args.batch_size}")
+    print(f"{'max_len':>8} {'full ms/img':>12} {'incr ms/img':>12} {'speedup':>8} {'max |dcoord|':>13}")
+    for max_len in [int(x) for x in args.max_lens.split(",")]:
+        t_full, out_full = time_decode(task, model, sample, max_len, False, args.repeat, device)
+        t_incr, out_incr = time_decode(task, model, sample, max_len, True, args.repeat, device)
+        per_img_full = t_full * 1000 / args.batch_size
+        per_img_incr = t_incr * 1000 / args.batch_size
+        print(
+            f"{max_len:>8} {per_img_full:>12.2f} {per_img_incr:>12.2f} "
+            f"{t_full / t_incr:>7.2f}x {max_coord_diff(out_full, out_incr):>13.2e}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_mask_scoring.py
+
+Time of rasterizing and scoring the predicted polygons of an evaluation batch
+with the per-sample ``skimage.draw.polygon2mask`` path that ``eval_refcoco``
+used before, versus the batched ``utils.mask_scoring`` engine, and a check
+that both give the same masks and overlap counts.
+
+Polygons are random star-shaped polygons around random centers, with the
+number of polygons per sample and vertices per polygon drawn from the given
+ranges; a few are clipped by the image border.
+
+Typical usage:
+
+  python benchmarks/bench_mask_scoring.py --batch-size 16 --image-size 512
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from skimage import draw
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from utils.mask_scoring import convert_pts, mask_overlaps, rasterize_polygons  # noqa: E402
+
+
+def reference_mask(codes, img_size):
+    # the per-sample path formerly used by eval_refcoco
+    masks = [np.zeros(img_size)]
+    for code in codes:
+        if len(code) > 0:
+            try:
+                mask = draw.polygon2mask(img_size, convert_pts(code))
+                mask = np.array(mask, np.uint8)
+            except Exception:
+                mask = np.zeros(img_size)
+            masks.append(mask)
+    mask = sum(masks)
+    mask = mask > 0
+    return mask.astype(np.uint8)
+
+
+def reference_overlaps(pred_mask, gt_mask):
+    return (
+        np.sum(np.logical_and(pred_mask, gt_mask)),
+        np.sum(np.logical_or(pred_mask, gt_mask)),
+        pred_mask.sum(),
+        gt_mask.sum(),
+    )
+
+
+def random_polygon(rng: np.random.Generator, size: int, num_vertices: int) -> np.ndarray:
+    center = rng.uniform(0, size, 2)
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices))
+    radii = rng.uniform(0.05, 0.4, num_vertices) * size
+    xs = np.clip(center[0] + radii * np.cos(angles), 0, size)
+    ys = np.clip(center[1] + radii * np.sin(angles), 0, size)
+    return np.stack([xs, ys], 1).reshape(-1)
+
+
+def build_batch(rng: np.random.Generator, batch_size: int, size: int, max_polygons: int, max_vertices: int):
+    hyps = [
+        [
+            random_polygon(rng, size, int(rng.integers(3, max_vertices + 1)))
+            for _ in range(int(rng.integers(1, max_polygons + 1)))
+        ]
+        for _ in range(batch_size)
+    ]
+    refs = np.stack([reference_mask([random_polygon(rng, size, 32)], (size, size)) for _ in range(batch_size)])
+    return hyps, refs
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark per-sample vs batched polygon rasterization and scoring")
+    ap.add_argument("--batch-size", default=16, type=int)
+    ap.add_argument("--image-size", default=512, type=int)
+    ap.add_argument("--max-polygons", default=3, type=int, help="Maximum polygons per sample")
+    ap.add_argument("--max-vertices", default=100, type=int, help="Maximum vertices per polygon")
+    ap.add_argument("--batches", default=10, type=int, help="Timed batches")
+    ap.add_argument("--cpu", action="store_true", help="Score on CPU even if CUDA is available")
+    args = ap.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    rng = np.random.default_rng(7)
+    size = (args.image_size, args.image_size)
+    batches = [
+        build_batch(rng, args.batch_size, args.image_size, args.max_polygons, args.max_vertices)
+        for _ in range(args.batches)
+    ]
+
+    start = time.perf_counter()
+    expected = []
+    for hyps, refs in batches:
+        expected.append([reference_overlaps(reference_mask(h, size), r) for h, r in zip(hyps, refs)])
+    t_ref = time.perf_counter() - start
+
+    # warm up
+    rasterize_polygons(batches[0][0], size, device=device)
+    _sync(device)
+    start = time.perf_counter()
+    results = []
+    for hyps, refs in batches:
+        gt_masks = torch.from_numpy(refs).to(device)
+        pred_masks = rasterize_polygons(hyps, size, device=device)
+        results.append(torch.stack(mask_overlaps(pred_masks, gt_masks), dim=1).cpu().numpy())
+    _sync(device)
+    t_batched = time.perf_counter() - start
+
+    mismatches = sum(
+        int(not np.array_equal(np.asarray(exp, dtype=np.int64), res)) for exp, res in zip(expected, results)
+    )
+    per_img = 1000 / (args.batches * args.batch_size)
+    print(f"device={device} batch_size={args.batch_size} image_size={args.image_size}")
+    print(f"{'per-sample ms/img':>18} {'batched ms/img':>15} {'speedup':>8} {'mismatched batches':>19}")
+    print(f"{t_ref * per_img:>18.2f} {t_batched * per_img:>15.2f} {t_ref / t_batched:>7.2f}x {mismatches:>19}")
+
+
+if __name__ == "__main__":
+    main()
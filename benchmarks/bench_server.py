@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_server.py
+
+Throughput and latency of a running ``serve.py`` under concurrent load: N
+client threads post the same (image, expression) request in a loop, and the
+server's batch size statistics are read from ``/metrics`` afterwards.
+
+Typical usage:
+
+  python serve.py --checkpoint weights/polyformer_b_refcoco.pt --max-batch-size 8 &
+  python benchmarks/bench_server.py --image demo/dog.jpg --text "the dog wearing glasses" \
+    --concurrency 1,4,16 --requests 64
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import http.client
+import json
+import threading
+import time
+
+import numpy as np
+
+
+def post_loop(host: str, port: int, body: bytes, count: int, latencies: list, errors: list) -> None:
+    conn = http.client.HTTPConnection(host, port, timeout=600)
+    for _ in range(count):
+        start = time.perf_counter()
+        conn.request("POST", "/predict", body=body, headers={"Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        if response.status != 200:
+            errors.append(response.status)
+        else:
+            latencies.append(time.perf_counter() - start)
+    conn.close()
+
+
+def get_metrics(host: str, port: int) -> str:
+    conn = http.client.HTTPConnection(host, port, timeout=60)
+    conn.request("GET", "/metrics")
+    text = conn.getresponse().read().decode("utf-8")
+    conn.close()
+    return text
+
+
+def mean_batch_size(metrics: str) -> float:
+    for line in metrics.splitlines():
+        if line.startswith("polyformer_mean_batch_size "):
+            return float(line.split()[1])
+    return float("nan")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Load test a running PolyFormer inference server")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", default=8000, type=int)
+    ap.add_argument("--image", default="demo/dog.jpg")
+    ap.add_argument("--text", default="the dog wearing glasses")
+    ap.add_argument("--concurrency", default="1,4,16", help="Comma separated numbers of concurrent clients")
+    ap.add_argument("--requests", default=64, type=int, help="Requests per concurrency level")
+    ap.add_argument("--no-mask", action="store_true", help="Do not ask for the output masks")
+    args = ap.parse_args()
+
+    with open(args.image, "rb") as f:
+        image = base64.b64encode(f.read()).decode("ascii")
+    body = json.dumps({"image": image, "text": args.text, "return_mask": not args.no_mask}).encode("utf-8")
+
+    # warm up
+    post_loop(args.host, args.port, body, 2, [], [])
+
+    print(f"{'clients':>7} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'mean batch':>10} {'errors':>6}")
+    for concurrency in [int(c) for c in args.concurrency.split(",")]:
+        latencies, errors = [], []
+        per_client = max(1, args.requests // concurrency)
+        threads = [
+            threading.Thread(target=post_loop, args=(args.host, args.port, body, per_client, latencies, errors))
+            for _ in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - start
+        # the server's mean batch size is cumulative, it includes the earlier levels
+        batch = mean_batch_size(get_metrics(args.host, args.port))
+        ms = np.quantile(np.asarray(latencies), [0.5, 0.9, 0.99]) * 1000 if latencies else [float("nan")] * 3
+        print(f"{concurrency:>7} {len(latencies) / elapsed:>8.2f} {ms[0]:>8.1f} {ms[1]:>8.1f} {ms[2]:>8.1f} "
+              f"{batch:>10.2f} {len(errors):>6}")
+
+
+if __name__ == "__main__":
+    main()
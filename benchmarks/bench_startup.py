@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_startup.py
+
+Cold start time of loading a checkpoint with ``load_model_ensemble_and_task``,
+with the regular model construction (pretrained BERT / Swin weights and random
+initialization, all overwritten by the checkpoint) versus the fast
+construction of ``models/fast_init.py``, and a check that both give the same
+weights.
+
+Every load runs in a fresh Python process, so the timings include importing
+torch / fairseq and nothing is reused between runs; the file cache is warm
+after the first run.
+
+Typical usage:
+
+  python benchmarks/bench_startup.py --checkpoint weights/polyformer_b_refcoco.pt --repeat 3
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+
+def load_once(checkpoint: str, fast_init: bool, digest: bool) -> dict:
+    start = time.perf_counter()
+    import resource
+
+    import torch
+    from fairseq import utils
+
+    import models  # noqa: F401  (registers the polyformer architectures)
+    import tasks  # noqa: F401  (registers the refcoco task)
+    from utils import checkpoint_utils
+
+    imported = time.perf_counter()
+    state = checkpoint_utils.load_checkpoint_to_cpu(checkpoint, {"bpe_dir": str(REPO_ROOT / "utils" / "BPE")})
+    read = time.perf_counter()
+    models_, _, _ = checkpoint_utils.load_model_ensemble_and_task(
+        utils.split_paths(checkpoint), state=state, fast_init=fast_init
+    )
+    built = time.perf_counter()
+
+    result = {
+        "import_s": imported - start,
+        "read_s": read - imported,
+        "build_load_s": built - read,
+        "total_s": built - start,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if digest:
+        # per-tensor sums, to compare the weights of both construction paths
+        with torch.no_grad():
+            result["digest"] = {
+                name: float(t.double().sum()) for name, t in models_[0].state_dict().items() if t.is_floating_point()
+            }
+    return result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark checkpoint cold start with and without fast model construction")
+    ap.add_argument("--checkpoint", required=True)
+    ap.add_argument("--repeat", default=3, type=int, help="Fresh processes per mode")
+    ap.add_argument("--worker", choices=["regular", "fast"], help=argparse.SUPPRESS)
+    ap.add_argument("--digest", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.worker is not None:
+        print(json.dumps(load_once(args.checkpoint, args.worker == "fast", args.digest)))
+        return
+
+    def run(mode: str, digest: bool = False) -> dict:
+        cmd = [sys.executable, __file__, "--checkpoint", args.checkpoint, "--worker", mode]
+        if digest:
+            cmd.append("--digest")
+        out = subprocess.run(cmd, check=True, capture_output=True, text=True, cwd=REPO_ROOT).stdout
+        return json.loads(out.strip().splitlines()[-1])
+
+    # warms the file cache, and compares the weights
+    regular, fast = run("regular", digest=True), run("fast", digest=True)
+    mismatched = [name for name, value in regular["digest"].items() if fast["digest"].get(name) != value]
+
+    print(f"{'mode':>8} {'import s':>9} {'read s':>8} {'build+load s':>13} {'total s':>8} {'max RSS MB':>11}")
+    for mode in ("regular", "fast"):
+        runs = [run(mode) for _ in range(args.repeat)]
+        mean = {key: sum(r[key] for r in runs) / len(runs) for key in runs[0]}
+        print(f"{mode:>8} {mean['import_s']:>9.2f} {mean['read_s']:>8.2f} {mean['build_load_s']:>13.2f} "
+              f"{mean['total_s']:>8.2f} {mean['max_rss_mb']:>11.0f}")
+    print(f"mismatched tensors: {len(mismatched)} of {len(regular['digest'])}" +
+          (f" (e.g. {mismatched[0]})" if mismatched else ""))
+
+
+if __name__ == "__main__":
+    main()
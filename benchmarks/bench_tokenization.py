@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""bench_tokenization.py
+
+Time of tokenizing batches of referring expression prompts with the generic
+``BertTokenizer.batch_encode_plus`` (as ``RefcocoDataset.collate`` did) versus
+``PromptTokenizer`` (utils/prompt_tokenizer.py) without its caption cache
+(trie WordPiece and pre-tokenized template only) and with its cache, and
+whether all of them give the same token ids.
+
+Expressions are read from a data file (TSV, JSONL or sample store) and
+normalized like the dataset does; several epochs over the same expressions
+are what the cache sees in training.
+
+Typical usage:
+
+  python benchmarks/bench_tokenization.py --input datasets/finetune/refcoco/refcoco_val.tsv --selected-cols 0,5,6,2,4,3
+  python benchmarks/bench_tokenization.py --input datasets/finetune/refcoco/refcoco_val.tsv --max-text-len 20
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from bert.tokenization_bert import BertTokenizer  # noqa: E402
+from data.file_dataset import FileDataset  # noqa: E402
+from data.refcoco_dataset import _row_text  # noqa: E402
+from data.sample_store import SampleStore, is_sample_store  # noqa: E402
+from utils.inference import pre_caption  # noqa: E402
+from utils.prompt_tokenizer import PROMPT_TEMPLATE, PromptTokenizer  # noqa: E402
+
+
+def read_captions(path: str, selected_cols: str, max_src_length: int, limit: int) -> list:
+    if is_sample_store(path):
+        texts = SampleStore(path).texts()[:limit]
+    else:
+        dataset = FileDataset(path, selected_cols)
+        texts = [_row_text(dataset[i]) for i in range(min(limit, len(dataset)))]
+    return [pre_caption(text, max_src_length) for text in texts]
+
+
+def slow_batch(tokenizer, captions, max_text_len):
+    prompts = [PROMPT_TEMPLATE.format(caption) for caption in captions]
+    if max_text_len > 0:
+        tokenized = tokenizer.batch_encode_plus(
+            prompts, padding="longest", truncation=True, max_length=max_text_len, return_tensors="pt"
+        )
+    else:
+        tokenized = tokenizer.batch_encode_plus(prompts, padding="longest", return_tensors="pt")
+    return tokenized["input_ids"], tokenized["attention_mask"]
+
+
+def measure(encode_batch, batches, epochs):
+    outs = []
+    start = time.perf_counter()
+    for _ in range(epochs):
+        outs = [encode_batch(batch) for batch in batches]
+    return outs, (time.perf_counter() - start) / (epochs * sum(len(batch) for batch in batches))
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Benchmark generic vs prompt tokenization of referring expressions")
+    ap.add_argument("--input", required=True, help="Data file (.tsv / .jsonl) or sample store")
+    ap.add_argument("--selected-cols", default="0,5,6,2,4,3", help="TSV columns as for evaluation")
+    ap.add_argument("--vocab-file", default=None, help="BERT vocab.txt (default: bert-base-uncased)")
+    ap.add_argument("--max-src-length", default=80, type=int)
+    ap.add_argument("--max-text-len", default=0, type=int)
+    ap.add_argument("--limit", default=10000, type=int, help="Number of expressions")
+    ap.add_argument("--batch-size", default=32, type=int)
+    ap.add_argument("--epochs", default=3, type=int, help="Passes over the expressions")
+    args = ap.parse_args()
+
+    if args.vocab_file is not None:
+        tokenizer = BertTokenizer(args.vocab_file)
+        tokenizer.sanitize_special_tokens()
+    else:
+        tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+    captions = read_captions(args.input, args.selected_cols, args.max_src_length, args.limit)
+    batches = [captions[i:i + args.batch_size] for i in range(0, len(captions), args.batch_size)]
+
+    ref, t_slow = measure(lambda batch: slow_batch(tokenizer, batch, args.max_text_len), batches, args.epochs)
+    uncached = PromptTokenizer(tokenizer, max_text_len=args.max_text_len, cache_size=0)
+    out_uncached, t_uncached = measure(uncached.batch_encode, batches, args.epochs)
+    cached = PromptTokenizer(tokenizer, max_text_len=args.max_text_len)
+    out_cached, t_cached = measure(cached.batch_encode, batches, args.epochs)
+
+    def same(outs):
+        return all(a[0].equal(b[0]) and a[1].equal(b[1]) for a, b in zip(outs, ref))
+
+    print(f"expressions={len(captions)} unique={len(set(captions))} batch_size={args.batch_size} epochs={args.epochs}")
+    print(f"{'tokenizer':>18} {'us/prompt':>10} {'same ids':>9}")
+    print(f"{'batch_encode_plus':>18} {t_slow * 1e6:>10.1f} {'-':>9}")
+    print(f"{'prompt, no cache':>18} {t_uncached * 1e6:>10.1f} {str(same(out_uncached)):>9}")
+    print(f"{'prompt, cached':>18} {t_cached * 1e6:>10.1f} {str(same(out_cached)):>9}")
+    print(f"cache hits {cached.hits} misses {cached.misses}")
+
+
+if __name__ == "__main__":
+    main()
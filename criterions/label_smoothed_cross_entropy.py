@@ -207,6 +207,7 @@ class AdjustLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
                 "nll_loss": logging_output_v1["nll_loss"].data / sample_size_v1 + logging_output_v2[
                     "nll_loss"].data / sample_size_v2,
                 "ntokens": logging_output_v1["ntokens"] + logging_output_v2["ntokens"],
+                "ntokens_padded": logging_output_v1["ntokens_padded"] + logging_output_v2["ntokens_padded"],
                 "nsentences": logging_output_v1["nsentences"] + logging_output_v2["nsentences"],
                 "sample_size": 1,
                 "sample_size_v1": sample_size_v1,
@@ -227,6 +228,7 @@ class AdjustLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
             "loss": loss.data,
             "nll_loss": nll_loss.data,
             "ntokens": sample["ntokens"],
+            "ntokens_padded": sample.get("ntokens_padded", sample["ntokens"]),
             "nsentences": sample["nsentences"],
             "sample_size": sample_size,
         }
@@ -331,6 +333,7 @@ class AdjustLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         loss_sum_v2 = sum(log.get("loss_v2", 0) for log in logging_outputs)
         nll_loss_sum = sum(log.get("nll_loss", 0) for log in logging_outputs)
         ntokens = sum(log.get("ntokens", 0) for log in logging_outputs)
+        ntokens_padded = sum(log.get("ntokens_padded", 0) for log in logging_outputs)
         nsentences = sum(log.get("nsentences", 0) for log in logging_outputs)
         sample_size = sum(log.get("sample_size", 0) for log in logging_outputs)
         sample_size_v1 = sum(log.get("sample_size_v1", 0) for log in logging_outputs)
@@ -355,6 +358,11 @@ class AdjustLabelSmoothedCrossEntropyCriterion(FairseqCriterion):
         metrics.log_scalar(
             "ntokens", ntokens, 1, round=3
         )
+        if ntokens_padded > 0:
+            # share of the padded decoder target positions that are real tokens
+            metrics.log_scalar(
+                "pad_eff", ntokens / ntokens_padded, ntokens_padded, round=3
+            )
         metrics.log_scalar(
             "nsentences", nsentences, 1, round=3
         )
@@ -1,12 +1,16 @@
 from refer.refer import REFER
 import numpy as np
 from PIL import Image
+import argparse
+import json
 import random
 import os
+import shutil
+from multiprocessing import Pool
 from tqdm import tqdm
 
 import pickle
-from poly_utils import is_clockwise, revert_direction, check_length, reorder_points, \
+from poly_utils import is_clockwise, revert_direction, reorder_points, \
     approximate_polygons, interpolate_polygons, image_to_base64, polygons_to_string
 
 
@@ -18,106 +22,210 @@ datasets = ['refcoco', 'refcoco+', 'refcocog']
 image_dir = './datasets/images/mscoco/train2014'
 val_test_files = pickle.load(open("data/val_test_files.p", "rb"))
 
-combined_train_data = []
-
-for dataset in datasets:
-    if dataset == 'refcoco':
-        splits = ['train', 'val', 'testA', 'testB']
-        splitBy = 'unc'
-    elif dataset == 'refcoco+':
-        splits = ['train', 'val', 'testA', 'testB']
-        splitBy = 'unc'
-    elif dataset == 'refcocog':
-        splits = ['train', 'val']
-        splitBy = 'umd'
-
-    save_dir = f'datasets/finetune/{dataset}'
-    os.makedirs(save_dir, exist_ok=True)
-    for split in splits:
-        num_pts = []
-        max_num_pts = 0
-        file_name = os.path.join(save_dir, f"{dataset}_{split}.tsv")
-        print("creating ", file_name)
-
-        uniq_ids = []
-        image_ids = []
-        sents = []
-        coeffs_strings = []
-        img_strings = []
-
-        writer = open(file_name, 'w')
-        refer = REFER(data_root, dataset, splitBy)
-
-        ref_ids = refer.getRefIds(split=split)
-
-        for this_ref_id in tqdm(ref_ids):
-            this_img_id = refer.getImgIds(this_ref_id)
-            this_img = refer.Imgs[this_img_id[0]]
-            fn = this_img['file_name']
-            img_id = fn.split(".")[0].split("_")[-1]
-
-            # load image
+SPLITS = {
+    'refcoco': (['train', 'val', 'testA', 'testB'], 'unc'),
+    'refcoco+': (['train', 'val', 'testA', 'testB'], 'unc'),
+    'refcocog': (['train', 'val'], 'umd'),
+}
+
+# REFER instance of the dataset a pool worker is building
+_refer = None
+
+
+def _init_worker(dataset, splitBy):
+    global _refer
+    _refer = REFER(data_root, dataset, splitBy)
+
+
+def ref_instances(refer, this_ref_id, img_base64):
+    this_img_id = refer.getImgIds(this_ref_id)
+
+    # load mask
+    ref = refer.loadRefs(this_ref_id)
+    ref_mask = np.array(refer.getMask(ref[0])['mask'])
+    annot = np.zeros(ref_mask.shape)
+    annot[ref_mask == 1] = 1  # 255
+    annot_img = Image.fromarray(annot.astype(np.uint8), mode="P")
+    annot_base64 = image_to_base64(annot_img, format='png')
+
+    polygons = refer.getPolygon(ref[0])['polygon']
+
+    polygons_processed = []
+    for polygon in polygons:
+        # make the polygon clockwise
+        if not is_clockwise(polygon):
+            polygon = revert_direction(polygon)
+
+        # reorder the polygon so that the first vertex is the one closest to image origin
+        polygon = reorder_points(polygon)
+        polygons_processed.append(polygon)
+
+    polygons = sorted(polygons_processed, key=lambda x: (x[0] ** 2 + x[1] ** 2, x[0], x[1]))
+    polygons_interpolated = interpolate_polygons(polygons)
+
+    polygons = approximate_polygons(polygons, 5, max_length)
+
+    pts_string = polygons_to_string(polygons)
+    pts_string_interpolated = polygons_to_string(polygons_interpolated)
+
+    # load box
+    box = refer.getRefBox(this_ref_id)  # x,y,w,h
+    x, y, w, h = box
+    box_string = f'{x},{y},{x + w},{y + h}'
+
+    # load text
+    instances = []
+    ref_sent = refer.Refs[this_ref_id]
+    for i, (sent, sent_id) in enumerate(zip(ref_sent['sentences'], ref_sent['sent_ids'])):
+        uniq_id = f"{this_ref_id}_{i}"
+        instance = '\t'.join(
+            [uniq_id, str(this_img_id[0]), sent['sent'], box_string, pts_string, img_base64, annot_base64,
+             pts_string_interpolated]) + '\n'
+        instances.append(instance)
+    return instances
+
+
+def build_shard(job):
+    """Write the rows of a group of images to ``<shard>.tsv``, and the rows that go to the
+    combined training set to ``<shard>.combined.tsv``."""
+    shard_path, split, image_groups = job
+    tmp_path = shard_path + '.tmp'
+    num_rows = 0
+    num_combined = 0
+    with open(tmp_path + '.tsv', 'w') as writer, open(tmp_path + '.combined.tsv', 'w') as combined_writer:
+        for image_id, ref_ids in image_groups:
+            this_img = _refer.Imgs[image_id]
+            img_id = this_img['file_name'].split(".")[0].split("_")[-1]
+
+            # every image is loaded and encoded once for all of its refs
             img = Image.open(os.path.join(image_dir, this_img['file_name'])).convert("RGB")
-
-            # convert image to string
             img_base64 = image_to_base64(img, format='jpeg')
 
-            # load mask
-            ref = refer.loadRefs(this_ref_id)
-            ref_mask = np.array(refer.getMask(ref[0])['mask'])
-            annot = np.zeros(ref_mask.shape)
-            annot[ref_mask == 1] = 1  # 255
-            annot_img = Image.fromarray(annot.astype(np.uint8), mode="P")
-            annot_base64 = image_to_base64(annot_img, format='png')
-
-            polygons = refer.getPolygon(ref[0])['polygon']
-
-            polygons_processed = []
-            for polygon in polygons:
-                # make the polygon clockwise
-                if not is_clockwise(polygon):
-                    polygon = revert_direction(polygon)
-
-                # reorder the polygon so that the first vertex is the one closest to image origin
-                polygon = reorder_points(polygon)
-                polygons_processed.append(polygon)
-
-            polygons = sorted(polygons_processed, key=lambda x: (x[0] ** 2 + x[1] ** 2, x[0], x[1]))
-            polygons_interpolated = interpolate_polygons(polygons)
-
-            polygons = approximate_polygons(polygons, 5, max_length)
-
-            pts_string = polygons_to_string(polygons)
-            pts_string_interpolated = polygons_to_string(polygons_interpolated)
-
-            # load box
-            box = refer.getRefBox(this_ref_id)  # x,y,w,h
-            x, y, w, h = box
-            box_string = f'{x},{y},{x + w},{y + h}'
-
-            max_num_pts = max(max_num_pts, check_length(polygons))
-
-            num_pts.append(check_length(polygons))
-            # load text
-            ref_sent = refer.Refs[this_ref_id]
-            for i, (sent, sent_id) in enumerate(zip(ref_sent['sentences'], ref_sent['sent_ids'])):
-                uniq_id = f"{this_ref_id}_{i}"
-                instance = '\t'.join(
-                    [uniq_id, str(this_img_id[0]), sent['sent'], box_string, pts_string, img_base64, annot_base64,
-                     pts_string_interpolated]) + '\n'
-                writer.write(instance)
-
-                if img_id not in val_test_files and split == 'train':  # filtered out val/test files
-                    combined_train_data.append(instance)
-        writer.close()
-
-random.shuffle(combined_train_data)
-file_name = os.path.join("datasets/finetune/refcoco+g_train_shuffled.tsv")
-print("creating ", file_name)
-writer = open(file_name, 'w')
-writer.writelines(combined_train_data)
-writer.close()
-
-
-
+            for this_ref_id in ref_ids:
+                for instance in ref_instances(_refer, this_ref_id, img_base64):
+                    writer.write(instance)
+                    num_rows += 1
+                    if img_id not in val_test_files and split == 'train':  # filtered out val/test files
+                        combined_writer.write(instance)
+                        num_combined += 1
+    os.replace(tmp_path + '.tsv', shard_path + '.tsv')
+    os.replace(tmp_path + '.combined.tsv', shard_path + '.combined.tsv')
+    return shard_path, num_rows, num_combined
+
+
+class Manifest:
+    """Shards that have been written completely, so that an interrupted build can resume."""
+
+    def __init__(self, path, images_per_shard):
+        self.path = path
+        self.images_per_shard = images_per_shard
+        self.shards = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            # shards of a build with a different shard size cover different images
+            if manifest['images_per_shard'] == images_per_shard:
+                self.shards = manifest['shards']
+
+    def done(self, shard_path):
+        return shard_path in self.shards and os.path.exists(shard_path + '.tsv') \
+            and os.path.exists(shard_path + '.combined.tsv')
+
+    def add(self, shard_path, num_rows, num_combined):
+        self.shards[shard_path] = {'rows': num_rows, 'combined_rows': num_combined}
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'images_per_shard': self.images_per_shard, 'shards': self.shards}, f, indent=2)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def concat_files(paths, out_path):
+    with open(out_path, 'wb') as writer:
+        for path in paths:
+            with open(path, 'rb') as reader:
+                shutil.copyfileobj(reader, writer)
+
+
+def external_shuffle(paths, out_path, work_dir, seed, bucket_bytes):
+    """Shuffle the lines of *paths* into *out_path* without holding all of them in memory:
+    lines are scattered to random bucket files, then every bucket is shuffled on its own."""
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    num_buckets = max(1, -(-total_bytes // bucket_bytes))
+    rng = random.Random(seed)
+    bucket_paths = [os.path.join(work_dir, f'shuffle_bucket_{i:04d}.tsv') for i in range(num_buckets)]
+    buckets = [open(path, 'w') for path in bucket_paths]
+    for path in paths:
+        with open(path) as reader:
+            for line in reader:
+                buckets[rng.randrange(num_buckets)].write(line)
+    for bucket in buckets:
+        bucket.close()
+
+    with open(out_path, 'w') as writer:
+        for path in bucket_paths:
+            with open(path) as reader:
+                lines = reader.readlines()
+            rng.shuffle(lines)
+            writer.writelines(lines)
+            os.remove(path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the RefCOCO / RefCOCO+ / RefCOCOg finetuning tsv files")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument('--images-per-shard', type=int, default=200,
+                        help="number of images whose rows are written to one shard file")
+    parser.add_argument('--work-dir', default='datasets/finetune/shards',
+                        help="directory for shard files and the resume manifest")
+    parser.add_argument('--seed', type=int, default=1, help="seed for shuffling the combined training set")
+    parser.add_argument('--shuffle-bucket-mb', type=int, default=1024,
+                        help="approximate memory used to shuffle one bucket of the combined training set")
+    args = parser.parse_args()
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(args.work_dir, 'manifest.json'), args.images_per_shard)
+    combined_shards = []
+
+    for dataset in datasets:
+        splits, splitBy = SPLITS[dataset]
+        save_dir = f'datasets/finetune/{dataset}'
+        os.makedirs(save_dir, exist_ok=True)
+        refer = REFER(data_root, dataset, splitBy)
 
+        split_shards = {}
+        jobs = []
+        for split in splits:
+            # work is sharded by image and the rows of an image stay consecutive, so that
+            # evaluation batches share images and the image embedding cache
+            # (--image-embed-cache-mb) gets hits
+            image_to_refs = {}
+            for ref_id in refer.getRefIds(split=split):
+                image_to_refs.setdefault(refer.Refs[ref_id]['image_id'], []).append(ref_id)
+            image_groups = sorted((image_id, sorted(ref_ids)) for image_id, ref_ids in image_to_refs.items())
+
+            split_shards[split] = []
+            for i in range(0, len(image_groups), args.images_per_shard):
+                shard_path = os.path.join(args.work_dir, f"{dataset}_{split}_{i // args.images_per_shard:05d}")
+                split_shards[split].append(shard_path)
+                if not manifest.done(shard_path):
+                    jobs.append((shard_path, split, image_groups[i:i + args.images_per_shard]))
+
+        print(f"{dataset}: {len(jobs)} shards to build, {sum(map(len, split_shards.values())) - len(jobs)} done")
+        if len(jobs) > 0:
+            with Pool(args.workers, initializer=_init_worker, initargs=(dataset, splitBy)) as pool:
+                for shard_path, num_rows, num_combined in tqdm(pool.imap_unordered(build_shard, jobs),
+                                                               total=len(jobs)):
+                    manifest.add(shard_path, num_rows, num_combined)
+
+        for split in splits:
+            file_name = os.path.join(save_dir, f"{dataset}_{split}.tsv")
+            print("creating ", file_name)
+            concat_files([shard + '.tsv' for shard in split_shards[split]], file_name)
+            combined_shards.extend(shard + '.combined.tsv' for shard in split_shards[split])
+
+    file_name = os.path.join("datasets/finetune/refcoco+g_train_shuffled.tsv")
+    print("creating ", file_name)
+    external_shuffle(combined_shards, file_name, args.work_dir, args.seed, args.shuffle_bucket_mb * 1024 * 1024)
+
+
+if __name__ == '__main__':
+    main()
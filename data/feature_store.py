@@ -0,0 +1,206 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Memory-mapped store of frozen encoder features for decoder finetuning.
+
+When the visual backbone (``encoder.embed_images``) and BERT
+(``encoder.bert``) are frozen, their outputs only depend on the image and
+the expression, so they are computed once and read back at every epoch
+instead of decoding and normalizing pixels and running both networks.
+
+A store is a directory holding
+
+  meta.json            format version, counts, feature shapes and the settings
+                       the features were computed with
+  image_features.bin   float16 (num_images, C, h, w) backbone output (the input
+                       of ``image_proj``), each distinct image stored once no
+                       matter how many samples share it
+  image_sizes.npy      int64 (num_images, 2): original width, height
+  text_features.bin    float16 (num_tokens, D) BERT output of every token of
+                       every expression prompt, concatenated
+  text_tokens.npy      int64 (num_tokens,) BERT token ids of the same tokens
+  samples.npy          one structured row per sample (see SAMPLE_DTYPE)
+  strings.bin          utf-8 sample ids
+
+Every file is memory-mapped by :class:`FeatureStore`. Stores are written with
+:class:`FeatureStoreWriter`, see ``tools/feature_store/precompute_features.py``.
+"""
+
+import json
+import os
+
+import numpy as np
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+FEATURE_DTYPE = np.float16
+
+SAMPLE_DTYPE = np.dtype([
+    ("id", np.int64, (2,)),  # offset, length in strings.bin
+    ("image", np.int64),  # row of image_features.bin
+    ("tokens", np.int64, (2,)),  # first token, number of tokens in text_features.bin
+])
+
+
+def is_feature_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+class FeatureStoreWriter:
+    def __init__(self, path, settings=None):
+        """Write a feature store to the directory *path*.
+
+        Args:
+            path (str): output directory
+            settings (dict, optional): settings the features depend on (e.g.
+                the checkpoint, ``patch_image_size``, ``max_text_len``),
+                stored in meta.json and checked when the store is used
+        """
+        self.path = path
+        self.settings = dict(settings or {})
+        os.makedirs(path, exist_ok=True)
+
+        self.samples = []
+        self.sample_ids = set()
+        self.image_rows = {}
+        self.image_sizes = []
+        self.image_shape = None
+        self.text_tokens = []
+        self.num_tokens = 0
+        self.hidden_size = None
+        self._image_features = open(os.path.join(path, "image_features.bin"), "wb")
+        self._text_features = open(os.path.join(path, "text_features.bin"), "wb")
+        self._strings = open(os.path.join(path, "strings.bin"), "wb")
+        self._strings_bytes = 0
+
+    def _add_string(self, s):
+        data = s.encode("utf-8")
+        self._strings.write(data)
+        offset = self._strings_bytes
+        self._strings_bytes += len(data)
+        return offset, len(data)
+
+    def has_image(self, image_key):
+        return image_key in self.image_rows
+
+    def add_image(self, image_key, features, size):
+        """Store the backbone output of an image unless it was stored before; return its row.
+
+        Args:
+            image_key (str): identifies the image content
+            features (np.ndarray): backbone output of shape (C, h, w)
+            size (sequence of int): original width, height of the image
+        """
+        row = self.image_rows.get(image_key)
+        if row is not None:
+            return row
+        features = np.ascontiguousarray(features, dtype=FEATURE_DTYPE)
+        if self.image_shape is None:
+            self.image_shape = list(features.shape)
+        elif list(features.shape) != self.image_shape:
+            raise ValueError("image features of shape {} in a store of shape {}".format(
+                list(features.shape), self.image_shape))
+        self._image_features.write(features.tobytes())
+        row = len(self.image_sizes)
+        self.image_sizes.append((int(size[0]), int(size[1])))
+        self.image_rows[image_key] = row
+        return row
+
+    def add(self, uniq_id, image_key, token_ids, token_features):
+        """Append one sample.
+
+        Args:
+            uniq_id (str): sample id, the key the sample is read by
+            image_key (str): key of an image stored with :meth:`add_image`
+            token_ids (np.ndarray): BERT token ids of the prompt, without padding
+            token_features (np.ndarray): BERT output of the same tokens, (L, D)
+        """
+        if uniq_id in self.sample_ids:
+            raise ValueError("duplicate sample id {}".format(uniq_id))
+        token_features = np.ascontiguousarray(token_features, dtype=FEATURE_DTYPE)
+        if self.hidden_size is None:
+            self.hidden_size = token_features.shape[1]
+        assert token_features.shape == (len(token_ids), self.hidden_size), \
+            "token features of shape {} for {} tokens".format(token_features.shape, len(token_ids))
+        self._text_features.write(token_features.tobytes())
+        self.text_tokens.append(np.asarray(token_ids, dtype=np.int64))
+        self.samples.append((self._add_string(uniq_id), self.image_rows[image_key], (self.num_tokens, len(token_ids))))
+        self.sample_ids.add(uniq_id)
+        self.num_tokens += len(token_ids)
+
+    def close(self):
+        self._image_features.close()
+        self._text_features.close()
+        self._strings.close()
+        np.save(os.path.join(self.path, "samples.npy"), np.array(self.samples, dtype=SAMPLE_DTYPE))
+        np.save(os.path.join(self.path, "image_sizes.npy"), np.array(self.image_sizes, dtype=np.int64).reshape(-1, 2))
+        text_tokens = np.concatenate(self.text_tokens) if self.text_tokens else np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(self.path, "text_tokens.npy"), text_tokens)
+        meta = {
+            "version": STORE_VERSION,
+            "num_samples": len(self.samples),
+            "num_images": len(self.image_sizes),
+            "num_tokens": self.num_tokens,
+            "image_shape": self.image_shape,
+            "hidden_size": self.hidden_size,
+            "settings": self.settings,
+        }
+        # written last: a directory without meta.json is not a complete store
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+
+class FeatureStore:
+    def __init__(self, path):
+        """Memory-mapped reader of a store written by :class:`FeatureStoreWriter`, indexed by sample id."""
+        self.path = path
+        assert is_feature_store(path), "Error: {} is not a feature store!".format(path)
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        assert self.meta["version"] == STORE_VERSION, \
+            "unsupported feature store version {}".format(self.meta["version"])
+        self.settings = self.meta["settings"]
+
+        self.samples = np.load(os.path.join(path, "samples.npy"), mmap_mode="r")
+        self.image_sizes = np.load(os.path.join(path, "image_sizes.npy"), mmap_mode="r")
+        self.text_tokens = np.load(os.path.join(path, "text_tokens.npy"), mmap_mode="r")
+        self.image_features = self._map_features(
+            "image_features.bin", [self.meta["num_images"]] + (self.meta["image_shape"] or [0, 0, 0])
+        )
+        self.text_features = self._map_features(
+            "text_features.bin", [self.meta["num_tokens"], self.meta["hidden_size"] or 0]
+        )
+        with open(os.path.join(path, "strings.bin"), "rb") as f:
+            strings = f.read()
+        self.rows = {
+            strings[offset:offset + length].decode("utf-8"): row
+            for row, (offset, length) in enumerate(self.samples["id"].tolist())
+        }
+        print("feature store {} samples {} images {}".format(self.path, len(self.rows), self.meta["num_images"]))
+
+    def _map_features(self, name, shape):
+        file_path = os.path.join(self.path, name)
+        if os.path.getsize(file_path) == 0:
+            return np.zeros(shape, dtype=FEATURE_DTYPE)
+        return np.memmap(file_path, dtype=FEATURE_DTYPE, mode="r", shape=tuple(shape))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, uniq_id):
+        return uniq_id in self.rows
+
+    def __getitem__(self, uniq_id):
+        if uniq_id not in self.rows:
+            raise KeyError("sample {} is not in the feature store {}".format(uniq_id, self.path))
+        sample = self.samples[self.rows[uniq_id]]
+        image = int(sample["image"])
+        start, length = (int(x) for x in sample["tokens"])
+        return {
+            "image_features": np.array(self.image_features[image]),
+            "image_size": tuple(int(x) for x in self.image_sizes[image]),
+            "token_ids": np.array(self.text_tokens[start:start + length]),
+            "token_features": np.array(self.text_features[start:start + length]),
+        }
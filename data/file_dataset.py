@@ -12,6 +12,29 @@ import os
 import torch
 import pickle
 
+import numpy as np
+
+
+def build_line_offsets(file_path, chunk_size=64 * 1024 * 1024):
+    """Byte offset of the start of every line of *file_path*, followed by the file size."""
+    offsets = [np.zeros(1, dtype=np.int64)]
+    pos = 0
+    last = b""
+    with open(file_path, "rb") as fp:
+        while True:
+            chunk = fp.read(chunk_size)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            offsets.append(newlines.astype(np.int64) + pos + 1)
+            pos += len(chunk)
+            last = chunk[-1:]
+    offsets = np.concatenate(offsets)
+    if pos > 0 and last != b"\n":
+        # the last line has no trailing newline
+        offsets = np.append(offsets, pos)
+    return offsets
+
 
 class FileDataset:
     def __init__(self, file_path, selected_col_ids=None, dtypes=None, separator="\t", cached_index=False):
@@ -32,7 +55,6 @@ class FileDataset:
             self.dtypes = [eval(col_dtype) for col_dtype in dtypes.split(",")]
             assert len(self.dtypes) == len(self.selected_col_ids)
 
-        self.data_cnt = 0
         try:
             self.slice_id = torch.distributed.get_rank()
             self.slice_count = torch.distributed.get_world_size()
@@ -41,7 +63,8 @@ class FileDataset:
             self.slice_count = 1
         self.cached_index = cached_index
         self._init_seek_index()
-        self._reader = self._get_reader()
+        self._fd = None
+        self._fd_pid = None
         print("file {} slice_id {} row count {} total row count {}".format(
             self.file_path, self.slice_id, self.row_count, self.total_row_count)
         )
@@ -50,25 +73,108 @@ class FileDataset:
         if self.cached_index:
             cache_path = "{}.index".format(self.file_path)
             assert os.path.exists(cache_path), "cache file {} not exists!".format(cache_path)
-            self.total_row_count, self.lineid_to_offset = pickle.load(open(cache_path, "rb"))
+            total_row_count, lineid_to_offset = pickle.load(open(cache_path, "rb"))
+            self.line_offsets = np.append(
+                np.asarray(lineid_to_offset, dtype=np.int64), os.path.getsize(self.file_path)
+            )
             print("local datafile {} slice_id {} use cached row_count and line_idx-to-offset mapping".format(
                 self.file_path, self.slice_id))
         else:
-            # make an iteration over the file to get row_count and line_idx-to-offset mapping
-            fp = open(self.file_path, "r")
-            print("local datafile {} slice_id {} begin to initialize row_count and line_idx-to-offset mapping".format(
-                self.file_path, self.slice_id))
-            self.total_row_count = 0
-            offset = 0
-            self.lineid_to_offset = []
-            for line in fp:
-                self.lineid_to_offset.append(offset)
-                self.total_row_count += 1
-                offset += len(line.encode('utf-8'))
+            self.line_offsets = self._load_offsets_sidecar()
+        self.total_row_count = len(self.line_offsets) - 1
         self._compute_start_pos_and_row_count()
         print("local datafile {} slice_id {} finished initializing row_count and line_idx-to-offset mapping".format(
             self.file_path, self.slice_id))
 
+    def _load_offsets_sidecar(self):
+        # line offsets are kept in a memory-mapped ``<file>.offsets.npy`` next to the data
+        # file; it is rebuilt when missing or older than the data file
+        sidecar_path = "{}.offsets.npy".format(self.file_path)
+        file_size = os.path.getsize(self.file_path)
+        if os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(self.file_path):
+            line_offsets = np.load(sidecar_path, mmap_mode="r")
+            if len(line_offsets) > 0 and line_offsets[-1] == file_size:
+                print("local datafile {} slice_id {} use line offsets from {}".format(
+                    self.file_path, self.slice_id, sidecar_path))
+                return line_offsets
+
+        print("local datafile {} slice_id {} begin to initialize row_count and line_idx-to-offset mapping".format(
+            self.file_path, self.slice_id))
+        line_offsets = build_line_offsets(self.file_path)
+        tmp_path = "{}.{}.tmp.npy".format(sidecar_path[:-len(".npy")], os.getpid())
+        try:
+            np.save(tmp_path, line_offsets)
+            os.replace(tmp_path, sidecar_path)
+        except OSError as e:
+            print("local datafile {} slice_id {} could not write {}: {}".format(
+                self.file_path, self.slice_id, sidecar_path, e))
+        return line_offsets
+
+    def row_values(self, fn, name):
+        """``fn(columns)`` of every row of the file (all slices), as an int64 array.
+
+        The values are computed in one pass over the file and kept in a
+        ``<file>.<name>.npy`` sidecar, rebuilt when missing or older than the
+        data file, like the line offsets.
+        """
+        sidecar_path = "{}.{}.npy".format(self.file_path, name)
+        if os.path.exists(sidecar_path) and os.path.getmtime(sidecar_path) >= os.path.getmtime(self.file_path):
+            values = np.load(sidecar_path)
+            if len(values) == self.total_row_count:
+                return values
+
+        print("local datafile {} slice_id {} begin to compute {} of {} rows".format(
+            self.file_path, self.slice_id, name, self.total_row_count))
+        values = np.empty(self.total_row_count, dtype=np.int64)
+        with open(self.file_path, "rb") as fp:
+            for row in range(self.total_row_count):
+                column_l = fp.readline().decode("utf-8").rstrip("\r\n").split(self.separator)
+                values[row] = fn([dtype(column_l[col_id]) for col_id, dtype in zip(self.selected_col_ids, self.dtypes)])
+        tmp_path = "{}.{}.tmp.npy".format(sidecar_path[:-len(".npy")], os.getpid())
+        try:
+            np.save(tmp_path, values)
+            os.replace(tmp_path, sidecar_path)
+        except OSError as e:
+            print("local datafile {} slice_id {} could not write {}: {}".format(
+                self.file_path, self.slice_id, sidecar_path, e))
+        return values
+
+    def row_sequences(self, fn, name):
+        """``fn(columns)``, a sequence of ints, of every row of the file (all slices), as
+        ``(offsets, values)`` int64 arrays: the values of row i are ``values[offsets[i]:offsets[i + 1]]``.
+
+        Kept in ``<file>.<name>.npy`` / ``<file>.<name>.offsets.npy`` sidecars like :meth:`row_values`.
+        """
+        values_path = "{}.{}.npy".format(self.file_path, name)
+        offsets_path = "{}.{}.offsets.npy".format(self.file_path, name)
+        data_mtime = os.path.getmtime(self.file_path)
+        if all(os.path.exists(path) and os.path.getmtime(path) >= data_mtime for path in (values_path, offsets_path)):
+            offsets = np.load(offsets_path)
+            values = np.load(values_path)
+            if len(offsets) == self.total_row_count + 1 and offsets[-1] == len(values):
+                return offsets, values
+
+        print("local datafile {} slice_id {} begin to compute {} of {} rows".format(
+            self.file_path, self.slice_id, name, self.total_row_count))
+        offsets = np.zeros(self.total_row_count + 1, dtype=np.int64)
+        values = []
+        with open(self.file_path, "rb") as fp:
+            for row in range(self.total_row_count):
+                column_l = fp.readline().decode("utf-8").rstrip("\r\n").split(self.separator)
+                row_values = fn([dtype(column_l[col_id]) for col_id, dtype in zip(self.selected_col_ids, self.dtypes)])
+                values.extend(row_values)
+                offsets[row + 1] = offsets[row] + len(row_values)
+        values = np.array(values, dtype=np.int64)
+        try:
+            for path, array in ((values_path, values), (offsets_path, offsets)):
+                tmp_path = "{}.{}.tmp.npy".format(path[:-len(".npy")], os.getpid())
+                np.save(tmp_path, array)
+                os.replace(tmp_path, path)
+        except OSError as e:
+            print("local datafile {} slice_id {} could not write {}: {}".format(
+                self.file_path, self.slice_id, values_path, e))
+        return offsets, values
+
     def _compute_start_pos_and_row_count(self):
         self.row_count = self.total_row_count // self.slice_count
         if self.slice_id < self.total_row_count - self.row_count * self.slice_count:
@@ -77,23 +183,26 @@ class FileDataset:
         else:
             self.start_pos = self.row_count * self.slice_id + (self.total_row_count - self.row_count * self.slice_count)
 
-    def _get_reader(self):
-        fp = open(self.file_path, "r")
-        fp.seek(self.lineid_to_offset[self.start_pos])
-        return fp
+    def _get_fd(self):
+        # opened lazily and per process, so that the dataset can be sent to dataloader workers
+        if self._fd is None or self._fd_pid != os.getpid():
+            self._fd = os.open(self.file_path, os.O_RDONLY)
+            self._fd_pid = os.getpid()
+        return self._fd
 
     def _seek(self, offset=0):
-        try:
-            print("slice_id {} seek offset {}".format(self.slice_id, self.start_pos + offset))
-            self._reader.seek(self.lineid_to_offset[self.start_pos + offset])
-            self.data_cnt = offset
-        except Exception:
-            print("slice_id {} seek offset {}".format(self.slice_id, offset))
-            self._reader.seek(self.lineid_to_offset[offset])
-            self.data_cnt = offset
+        # rows are read by index, there is no reader position to move
+        pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_fd"] = None
+        state["_fd_pid"] = None
+        return state
 
     def __del__(self):
-        self._reader.close()
+        if getattr(self, "_fd", None) is not None and self._fd_pid == os.getpid():
+            os.close(self._fd)
 
     def __len__(self):
         return self.row_count
@@ -102,11 +211,9 @@ class FileDataset:
         return self.total_row_count
 
     def __getitem__(self, index):
-        if self.data_cnt == self.row_count:
-            print("reach the end of datafile, start a new reader")
-            self.data_cnt = 0
-            self._reader = self._get_reader()
-        column_l = self._reader.readline().rstrip("\n").split(self.separator)
-        self.data_cnt += 1
+        row = self.start_pos + index
+        start, end = int(self.line_offsets[row]), int(self.line_offsets[row + 1])
+        line = os.pread(self._get_fd(), end - start, start).decode("utf-8")
+        column_l = line.rstrip("\r\n").split(self.separator)
         column_l = [dtype(column_l[col_id]) for col_id, dtype in zip(self.selected_col_ids, self.dtypes)]
         return column_l
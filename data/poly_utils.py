@@ -31,6 +31,53 @@ def points_to_token_string(box, polygons):
     return token_string, token_type
 
 
+def points_to_token_ids(box, polygons, num_bins, bin_offset=4, sep_index=3):
+    """Vectorized counterpart of quantizing *box* and *polygons* (points normalized to [0, 1])
+    with floor / ceil, formatting them with points_to_token_string and encoding the result with
+    the target dictionary, where <bin_i_j> has index i * num_bins + j + bin_offset and
+    <separator> maps to sep_index.
+
+    Returns the token ids of the 11 / 12 / 21 / 22 copies as an int64 array of shape (4, L),
+    the x / y bilinear deltas with a leading 0 for the bos token (shape (L + 1,) each) and
+    the token types (0 coordinate, 1 separator).
+
+    Points outside the image (e.g. a box with x + w past the width) are clipped to the
+    first / last bin, so that every coordinate token is a valid <bin_i_j> of the same row.
+    """
+    parts = [np.asarray(box, dtype=np.float64).reshape(-1, 2)]
+    sep_pos = []
+    length = parts[0].shape[0]
+    for i, polygon in enumerate(polygons):
+        if i > 0:
+            sep_pos.append(length)
+            parts.append(np.zeros((1, 2)))
+            length += 1
+        polygon = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+        parts.append(polygon)
+        length += polygon.shape[0]
+    points = np.clip(np.concatenate(parts, 0) * (num_bins - 1), 0, num_bins - 1)
+    is_sep = np.zeros(length, dtype=bool)
+    is_sep[sep_pos] = True
+
+    floor_pts = np.floor(points)
+    ceil_pts = np.ceil(points)
+    floor_x, floor_y = floor_pts[:, 0].astype(np.int64), floor_pts[:, 1].astype(np.int64)
+    ceil_x, ceil_y = ceil_pts[:, 0].astype(np.int64), ceil_pts[:, 1].astype(np.int64)
+    tokens = np.stack([
+        floor_x * num_bins + floor_y,
+        floor_x * num_bins + ceil_y,
+        ceil_x * num_bins + floor_y,
+        ceil_x * num_bins + ceil_y,
+    ]) + bin_offset
+    tokens[:, is_sep] = sep_index
+
+    deltas = np.zeros((length + 1, 2), dtype=np.float64)  # row 0 for the bos token
+    deltas[1:] = points - floor_pts
+    deltas[1:][is_sep] = 0
+    token_type = is_sep.astype(np.int64).tolist()
+    return tokens, deltas[:, 0], deltas[:, 1], token_type
+
+
 def resize_binary_mask(array, new_size):
     image = Image.fromarray(array.astype(np.uint8) * 255)
     image = image.resize(new_size)
@@ -19,13 +19,14 @@ import numpy as np
 import torch
 import base64
 import utils.transforms as T
-import math
 from PIL import Image, ImageFile
 
 from data import data_utils
 from data.base_dataset import BaseDataset
+from data.sample_store import SampleStore
 from bert.tokenization_bert import BertTokenizer
-from data.poly_utils import string_to_polygons, downsample_polygons, polygons_to_string, points_to_token_string
+from utils.prompt_tokenizer import PROMPT_TEMPLATE, PromptTokenizer
+from data.poly_utils import string_to_polygons, downsample_polygons, polygons_to_string, points_to_token_ids
 import cv2
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -39,6 +40,20 @@ IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
 IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
 
 
+def _row_text(columns):
+    if len(columns) == 1:
+        return (json.loads(columns[0]).get('expr') or '').strip()
+    return columns[3]
+
+
+def _row_target_length(columns):
+    # box corners, then the vertices of every polygon followed by a separator (eos after the last one)
+    if len(columns) == 1:
+        polygons = json.loads(columns[0]).get('polygons') or []
+        return 2 + sum(len(polygon) + 1 for polygon in polygons)
+    return 2 + sum((pts_string.count(",") + 1) // 2 + 1 for pts_string in columns[4].split(" ")[:-1])
+
+
 class RefcocoDataset(BaseDataset):
     def __init__(
         self,
@@ -54,7 +69,10 @@ class RefcocoDataset(BaseDataset):
         num_bins=1000,
         max_text_len=0,
         no_augment=False,
-        max_image_size=512
+        max_image_size=512,
+        feature_store=None,
+        fast_tokenizer=True,
+        pretokenize=False
     ):
         super().__init__(split, dataset, bpe, src_dict, tgt_dict)
         self.max_src_length = max_src_length
@@ -63,6 +81,8 @@ class RefcocoDataset(BaseDataset):
         self.num_bins = num_bins
         self.max_text_len = max_text_len
         self.no_augment = no_augment
+        # frozen backbone / BERT features (data/feature_store.py) read instead of pixels and token ids
+        self.feature_store = feature_store
 
         if imagenet_default_mean_and_std:
             mean = IMAGENET_DEFAULT_MEAN
@@ -78,11 +98,60 @@ class RefcocoDataset(BaseDataset):
             T.Normalize(mean=mean, std=std, max_image_size=max_image_size)
         ])
         self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.prompt_tokenizer = PromptTokenizer(self.tokenizer, max_text_len=max_text_len) if fast_tokenizer else None
+        # (offsets, ids) of the prompt of every row, so that batching only pads ids
+        self.prompt_tokens = self.pretokenize_prompts() if pretokenize else None
+
+    def encode_prompt(self, caption):
+        """BERT token ids of the prompt of an already normalized *caption*."""
+        if self.prompt_tokenizer is not None:
+            return self.prompt_tokenizer.encode(caption)
+        prompt = PROMPT_TEMPLATE.format(caption)
+        if self.max_text_len and self.max_text_len > 0:
+            return self.tokenizer.encode(prompt, truncation=True, max_length=self.max_text_len)
+        return self.tokenizer.encode(prompt)
+
+    def pretokenize_prompts(self):
+        """Prompt token ids of every row of the data file (all slices), as flat ids and (rows + 1) offsets."""
+
+        def row_ids(text):
+            return self.encode_prompt(self.pre_caption(text, self.max_src_length))
+
+        if isinstance(self.dataset, SampleStore):
+            token_ids = [row_ids(text) for text in self.dataset.texts()]
+            offsets = np.zeros(len(token_ids) + 1, dtype=np.int64)
+            offsets[1:] = np.cumsum([len(ids) for ids in token_ids])
+            values = np.array([i for ids in token_ids for i in ids], dtype=np.int64)
+            return offsets, values
+        name = "prompt_tokens_s{}_t{}".format(self.max_src_length, self.max_text_len)
+        return self.dataset.row_sequences(lambda columns: row_ids(_row_text(columns)), name)
+
+    def target_lengths(self):
+        """Decoder target length of every row of the data file (all slices), from its original polygons.
+
+        Training samples that are augmented with downsampled interpolated
+        polygons get a different length, so this is an estimate for them.
+        """
+        if isinstance(self.dataset, SampleStore):
+            return self.dataset.target_lengths()
+        return self.dataset.row_values(_row_target_length, "tgt_lengths")
 
     def __getitem__(self, index):
         data = self.dataset[index]
         jsonl_sample = None
-        if len(data) == 1:
+        stored_sample = None
+        polygons_original = None
+        polygons_interpolated = None
+        if isinstance(data, dict):
+            # binary sample store (data/sample_store.py): raw file bytes and float polygons
+            stored_sample = data
+            uniq_id = data['uniq_id']
+            text = data['text']
+            region = data['region']
+            polygons_original = data['polygons']
+            polygons_interpolated = data['polygons_interpolated']
+            train = data['train_format'] if data['train_format'] is not None else self.split == 'train'
+        elif len(data) == 1:
             # JSONL mode (remote sensing reproduction): each line is a JSON dict.
             jsonl_sample = json.loads(data[0])
             uniq_id = jsonl_sample.get('sample_id')
@@ -113,8 +182,26 @@ class RefcocoDataset(BaseDataset):
             uniq_id, base64_str, seg64_str, text, poly, region_coord = data
             train = False
 
+        features = self.feature_store[str(uniq_id)] if self.feature_store is not None else None
+
         # load image and segmentation labels
-        if jsonl_sample is not None:
+        if features is not None:
+            # the mask is only used for evaluation metrics, not by the training loss
+            image = None
+            label = None
+        elif stored_sample is not None:
+            image = Image.open(BytesIO(stored_sample['image'])).convert('RGB')
+            if stored_sample['mask'] is not None:
+                label = np.asarray(Image.open(BytesIO(stored_sample['mask'])))
+            else:
+                w, h = image.size
+                label = np.zeros((h, w), dtype=np.uint8)
+                for polygon in polygons_original:
+                    if len(polygon) < 6:
+                        continue
+                    pts = np.asarray(polygon, dtype=np.int32).reshape((-1, 1, 2))
+                    cv2.fillPoly(label, [pts], 1)
+        elif jsonl_sample is not None:
             image_path = jsonl_sample.get('image_path')
             if not image_path or not os.path.exists(image_path):
                 raise FileNotFoundError(f'Missing image_path for sample_id={uniq_id}: {image_path}')
@@ -136,11 +223,16 @@ class RefcocoDataset(BaseDataset):
             image = Image.open(BytesIO(base64.urlsafe_b64decode(base64_str))).convert('RGB')
             label = np.asarray(Image.open(BytesIO(base64.urlsafe_b64decode(seg64_str))))
 
-        label = (label > 0).astype(np.uint8)
-        label = cv2.resize(label, [self.patch_image_size, self.patch_image_size], interpolation=cv2.INTER_NEAREST)
+        if label is not None:
+            label = (label > 0).astype(np.uint8)
+            label = cv2.resize(label, [self.patch_image_size, self.patch_image_size], interpolation=cv2.INTER_NEAREST)
 
-        w, h = image.size
-        patch_image = self.positioning_transform(image, target=None)
+        if features is not None:
+            w, h = features["image_size"]
+            patch_image = None
+        else:
+            w, h = image.size
+            patch_image = self.positioning_transform(image, target=None)
         resize_h = self.patch_image_size
         resize_w = self.patch_image_size
         patch_mask = torch.tensor([True])
@@ -148,14 +240,19 @@ class RefcocoDataset(BaseDataset):
         if train and not self.no_augment:
             prob = np.random.uniform()
             if prob < 0.5:
-                polygons_interpolated = string_to_polygons(poly_interpolated)
+                if polygons_interpolated is None:
+                    polygons_interpolated = string_to_polygons(poly_interpolated)
                 ds_rate = np.random.randint(25, 41)
-                polygons_augmented = downsample_polygons(polygons_interpolated, ds_rate)
-                poly = polygons_to_string(polygons_augmented)
+                polygons = downsample_polygons(polygons_interpolated, ds_rate)
+            elif polygons_original is not None:
+                polygons = polygons_original
             else:
-                poly = poly_original
+                polygons = string_to_polygons(poly_original)
+        elif polygons_original is not None:
+            polygons = polygons_original
+        else:
+            polygons = string_to_polygons(poly)
 
-        polygons = string_to_polygons(poly)
         polygons_scaled = []
         for polygon in polygons:
             n_point = len(polygon) // 2
@@ -164,60 +261,30 @@ class RefcocoDataset(BaseDataset):
             polygon = polygon.reshape(n_point, 2)
             polygons_scaled.append(polygon)
 
-        x0, y0, x1, y1 = region_coord.strip().split(',')
-        region_points = [float(x0), float(y0), float(x1), float(y1)]
-        region = np.array(region_points)
+        if stored_sample is None:
+            x0, y0, x1, y1 = region_coord.strip().split(',')
+            region = np.array([float(x0), float(y0), float(x1), float(y1)])
 
-        region_points = region_points / np.array([w, h, w, h])  # scaled to [0,1]
+        region_points = region / np.array([w, h, w, h])  # scaled to [0,1]
         region_points = torch.tensor(region_points.reshape(2, 2))
 
-        quant_box = region_points * (self.num_bins - 1)
-        quant_box11 = [[math.floor(p[0]), math.floor(p[1])] for p in quant_box]
-        quant_box21 = [[math.ceil(p[0]), math.floor(p[1])] for p in quant_box]
-        quant_box12 = [[math.floor(p[0]), math.ceil(p[1])] for p in quant_box]
-        quant_box22 = [[math.ceil(p[0]), math.ceil(p[1])] for p in quant_box]
-
-        quant_poly = [poly * (self.num_bins - 1) for poly in polygons_scaled]
-        quant_poly11 = [[[math.floor(p[0]), math.floor(p[1])] for p in poly] for poly in quant_poly]
-        quant_poly21 = [[[math.ceil(p[0]), math.floor(p[1])] for p in poly] for poly in quant_poly]
-        quant_poly12 = [[[math.floor(p[0]), math.ceil(p[1])] for p in poly] for poly in quant_poly]
-        quant_poly22 = [[[math.ceil(p[0]), math.ceil(p[1])] for p in poly] for poly in quant_poly]
-
-        region_coord11, _ = points_to_token_string(quant_box11, quant_poly11)
-        region_coord21, _ = points_to_token_string(quant_box21, quant_poly21)
-        region_coord12, _ = points_to_token_string(quant_box12, quant_poly12)
-        region_coord22, token_type = points_to_token_string(quant_box22, quant_poly22)
-
-        # compute bilinear interpolation coefficient
-        delta_x1 = [0] + [p[0] - math.floor(p[0]) for p in quant_box]  # [0] for bos token
-        for polygon in quant_poly:
-            delta = [poly_point[0] - math.floor(poly_point[0]) for poly_point in polygon]
-            delta_x1.extend(delta)
-            delta_x1.extend([0])  # for separator token
-        delta_x1 = delta_x1[:-1]  # there is no separator token in the end
-        delta_x1 = torch.tensor(delta_x1)
+        # token ids of the four bilinear neighbours of every vertex, and the interpolation weights
+        tokens, delta_x1, delta_y1, token_type = points_to_token_ids(
+            region_points.numpy(), polygons_scaled, self.num_bins
+        )
+        delta_x1 = torch.from_numpy(delta_x1)
         delta_x2 = 1 - delta_x1
-
-        delta_y1 = [0] + [p[1] - math.floor(p[1]) for p in quant_box]  # [0] for bos token
-        for polygon in quant_poly:
-            delta = [poly_point[1] - math.floor(poly_point[1]) for poly_point in polygon]
-            delta_y1.extend(delta)
-            delta_y1.extend([0])  # for separator token
-        delta_y1 = delta_y1[:-1]  # there is no separator token in the end
-        delta_y1 = torch.tensor(delta_y1)
+        delta_y1 = torch.from_numpy(delta_y1)
         delta_y2 = 1 - delta_y1
 
         token_type.append(2)  # 2 for eos token
 
         src_caption = self.pre_caption(text, self.max_src_length)
 
-        prompt = ' which region does the text " {} " describe?'.format(src_caption)
+        prompt = PROMPT_TEMPLATE.format(src_caption)
 
         # tgt for input
-        tgt_item11 = self.encode_text(region_coord11, use_bpe=False)
-        tgt_item12 = self.encode_text(region_coord12, use_bpe=False)
-        tgt_item21 = self.encode_text(region_coord21, use_bpe=False)
-        tgt_item22 = self.encode_text(region_coord22, use_bpe=False)
+        tgt_item11, tgt_item12, tgt_item21, tgt_item22 = torch.from_numpy(tokens)
 
         # tgt for output
         target_item = region_points
@@ -253,6 +320,14 @@ class RefcocoDataset(BaseDataset):
             "n_poly": len(polygons),
             "text": src_caption
         }
+        if features is not None:
+            example["src_tokens"] = torch.from_numpy(features["token_ids"])
+            example["token_features"] = torch.from_numpy(features["token_features"])
+            example["image_features"] = torch.from_numpy(features["image_features"])
+        elif self.prompt_tokens is not None:
+            offsets, values = self.prompt_tokens
+            row = self.dataset.start_pos + index
+            example["src_tokens"] = torch.from_numpy(np.array(values[offsets[row]:offsets[row + 1]]))
         return example
 
     def collate(self, samples, pad_idx, eos_idx):
@@ -267,22 +342,38 @@ class RefcocoDataset(BaseDataset):
             )
 
         id = np.array([s["id"] for s in samples])
-        captions = [s["source"] for s in samples]
-        if self.max_text_len and self.max_text_len > 0:
-            tokenized = self.tokenizer.batch_encode_plus(
-                captions,
-                padding='longest',
-                truncation=True,
-                max_length=self.max_text_len,
-                return_tensors='pt',
-            )
+        use_features = "token_features" in samples[0]
+        if "src_tokens" in samples[0]:
+            # tokenized before batching (pre-tokenized prompts or a feature store), only the ids are padded
+            src_tokens = merge("src_tokens", 0)
+            att_masks = src_tokens.ne(0).long()
+        elif self.prompt_tokenizer is not None:
+            src_tokens, att_masks = self.prompt_tokenizer.batch_encode([s["text"] for s in samples])
         else:
-            tokenized = self.tokenizer.batch_encode_plus(captions, padding='longest', return_tensors='pt')
-        src_tokens = tokenized["input_ids"]
-        att_masks = tokenized["attention_mask"]
+            captions = [s["source"] for s in samples]
+            if self.max_text_len and self.max_text_len > 0:
+                tokenized = self.tokenizer.batch_encode_plus(
+                    captions,
+                    padding='longest',
+                    truncation=True,
+                    max_length=self.max_text_len,
+                    return_tensors='pt',
+                )
+            else:
+                tokenized = self.tokenizer.batch_encode_plus(captions, padding='longest', return_tensors='pt')
+            src_tokens = tokenized["input_ids"]
+            att_masks = tokenized["attention_mask"]
+        if use_features:
+            # the prompts were encoded by BERT when the feature store was written
+            token_embeddings = samples[0]["token_features"].new_zeros(
+                src_tokens.size(0), src_tokens.size(1), samples[0]["token_features"].size(1)
+            )
+            for i, s in enumerate(samples):
+                token_embeddings[i, :s["token_features"].size(0)] = s["token_features"]
+            token_embeddings = token_embeddings.float()
+            image_features = torch.stack([s["image_features"] for s in samples], dim=0).float()
         src_lengths = torch.LongTensor(att_masks.ne(0).long().sum())
 
-        patch_images = torch.stack([sample['patch_image'] for sample in samples], dim=0)
         patch_masks = torch.cat([sample['patch_mask'] for sample in samples])
 
         w_resize_ratios = torch.stack([s["w_resize_ratio"] for s in samples], dim=0)
@@ -309,17 +400,17 @@ class RefcocoDataset(BaseDataset):
         h = torch.stack([s["h"] for s in samples], dim=0)
         n_poly = [s['n_poly'] for s in samples]
 
-        labels = np.stack([sample['label'] for sample in samples], 0)
+        labels = np.stack([sample['label'] for sample in samples], 0) if samples[0]['label'] is not None else None
         text = [s["text"] for s in samples]
         batch = {
             "id": id,
             "nsentences": len(samples),
             "ntokens": ntokens,
+            "ntokens_padded": target.size(0) * target.size(1),
             "net_input": {
                 "src_tokens": src_tokens,
                 "src_lengths": src_lengths,
                 "att_masks": att_masks,
-                "patch_images": patch_images,
                 "patch_masks": patch_masks,
                 "prev_output_tokens_11": prev_output_tokens_11,
                 "prev_output_tokens_12": prev_output_tokens_12,
@@ -341,6 +432,11 @@ class RefcocoDataset(BaseDataset):
             "n_poly": n_poly,
             "text": text
         }
+        if use_features:
+            batch["net_input"]["token_embeddings"] = token_embeddings
+            batch["net_input"]["image_features"] = image_features
+        else:
+            batch["net_input"]["patch_images"] = torch.stack([s["patch_image"] for s in samples], dim=0)
 
         return batch
 
@@ -0,0 +1,303 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Binary indexed sample store for referring segmentation data.
+
+A store is a directory holding
+
+  meta.json          format version, record/blob counts, shard names
+  blobs_XXXXX.bin    raw (not base64) image and mask file bytes, each distinct
+                     file stored once no matter how many samples share it
+  blobs.npy          int64 (num_blobs, 3): shard, offset, length
+  records.npy        one structured row per sample (see RECORD_DTYPE)
+  strings.bin        utf-8 sample ids and texts
+  polygons.npy       int64 (num_polygons, 2): offset, length into coords.npy
+  coords.npy         float64 flat x, y polygon coordinates
+
+Every file is memory-mapped by :class:`SampleStore`, so opening a store costs
+nothing and samples can be read in any order. Stores are written with
+:class:`SampleStoreWriter`, see ``tools/sample_store/convert_to_sample_store.py``,
+which streams every file to disk as samples are added.
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import shutil
+
+import numpy as np
+import torch
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+
+RECORD_DTYPE = np.dtype([
+    ("id", np.int64, (2,)),  # offset, length in strings.bin
+    ("text", np.int64, (2,)),  # offset, length in strings.bin
+    ("image", np.int64),  # blob index
+    ("mask", np.int64),  # blob index, -1 if the mask is rasterized from the polygons
+    ("region", np.float64, (4,)),  # x0, y0, x1, y1
+    ("polygons", np.int64, (2,)),  # first polygon, number of polygons
+    ("polygons_interpolated", np.int64, (2,)),  # first polygon, number of polygons
+])
+
+
+def is_sample_store(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+class _ArrayWriter:
+    def __init__(self, path, dtype, row_shape=()):
+        """Rows of an .npy array appended to a raw file, which gets the .npy header once the row count is known."""
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.row_shape = tuple(row_shape)
+        self.num_rows = 0
+        self._tmp_path = "{}.tmp".format(path)
+        self._file = open(self._tmp_path, "wb")
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype=self.dtype).reshape((-1,) + self.row_shape)
+        self._file.write(rows.tobytes())
+        self.num_rows += len(rows)
+
+    def close(self):
+        self._file.close()
+        header = {
+            "descr": np.lib.format.dtype_to_descr(self.dtype),
+            "fortran_order": False,
+            "shape": (self.num_rows,) + self.row_shape,
+        }
+        with open(self.path, "wb") as f, open(self._tmp_path, "rb") as data:
+            np.lib.format.write_array_header_1_0(f, header)
+            shutil.copyfileobj(data, f, 16 * 1024 * 1024)
+        os.remove(self._tmp_path)
+
+
+class SampleStoreWriter:
+    def __init__(self, path, train_format=None, max_shard_bytes=2 ** 31):
+        """Write a sample store to the directory *path*.
+
+        Args:
+            path (str): output directory
+            train_format (bool, optional): whether samples are read like the
+                7-column training TSV (True), the 6-column evaluation TSV
+                (False) or, as for JSONL, according to the split (None)
+            max_shard_bytes (int, optional): size after which a new blob
+                shard is started
+        """
+        self.path = path
+        self.train_format = train_format
+        self.max_shard_bytes = max_shard_bytes
+        os.makedirs(path, exist_ok=True)
+
+        # only the blob hashes (for deduplication) are kept in memory, everything else is written as it is added
+        self.records = _ArrayWriter(os.path.join(path, "records.npy"), RECORD_DTYPE)
+        self.blob_index = _ArrayWriter(os.path.join(path, "blobs.npy"), np.int64, (3,))
+        self.blob_ids = {}
+        self.polygon_index = _ArrayWriter(os.path.join(path, "polygons.npy"), np.int64, (2,))
+        self.coords = _ArrayWriter(os.path.join(path, "coords.npy"), np.float64)
+        self.shards = []
+        self._shard = None
+        self._shard_bytes = 0
+        self._strings = open(os.path.join(path, "strings.bin"), "wb")
+        self._strings_bytes = 0
+
+    def _add_string(self, s):
+        data = s.encode("utf-8")
+        self._strings.write(data)
+        offset = self._strings_bytes
+        self._strings_bytes += len(data)
+        return offset, len(data)
+
+    def add_blob(self, data):
+        """Store *data* unless identical bytes were stored before; return its blob index."""
+        key = hashlib.sha1(data).digest()
+        blob_id = self.blob_ids.get(key)
+        if blob_id is not None:
+            return blob_id
+        if self._shard is None or (self._shard_bytes > 0 and self._shard_bytes + len(data) > self.max_shard_bytes):
+            if self._shard is not None:
+                self._shard.close()
+            self.shards.append("blobs_{:05d}.bin".format(len(self.shards)))
+            self._shard = open(os.path.join(self.path, self.shards[-1]), "wb")
+            self._shard_bytes = 0
+        self._shard.write(data)
+        blob_id = self.blob_index.num_rows
+        self.blob_index.append((len(self.shards) - 1, self._shard_bytes, len(data)))
+        self._shard_bytes += len(data)
+        self.blob_ids[key] = blob_id
+        return blob_id
+
+    def _add_polygons(self, polygons):
+        start = self.polygon_index.num_rows
+        for polygon in polygons:
+            polygon = np.asarray(polygon, dtype=np.float64).reshape(-1)
+            self.polygon_index.append((self.coords.num_rows, polygon.size))
+            self.coords.append(polygon)
+        return start, len(polygons)
+
+    def add(self, uniq_id, text, image, mask, region, polygons, polygons_interpolated=None):
+        """Append one sample.
+
+        Args:
+            uniq_id (str): sample id
+            text (str): referring expression
+            image (bytes): encoded image file
+            mask (bytes or None): encoded mask file, None to rasterize the
+                polygons when reading
+            region (sequence of float): box as x0, y0, x1, y1
+            polygons (list): flat x, y coordinates of every polygon
+            polygons_interpolated (list, optional): densely interpolated
+                polygons used for augmentation (default: *polygons*)
+        """
+        poly_range = self._add_polygons(polygons)
+        if polygons_interpolated is None:
+            interp_range = poly_range
+        else:
+            interp_range = self._add_polygons(polygons_interpolated)
+        self.records.append(np.array((
+            self._add_string(uniq_id),
+            self._add_string(text),
+            self.add_blob(image),
+            self.add_blob(mask) if mask is not None else -1,
+            tuple(float(x) for x in region),
+            poly_range,
+            interp_range,
+        ), dtype=RECORD_DTYPE))
+
+    def close(self):
+        if self._shard is not None:
+            self._shard.close()
+        self._strings.close()
+        for array in (self.records, self.blob_index, self.polygon_index, self.coords):
+            array.close()
+        meta = {
+            "version": STORE_VERSION,
+            "num_records": self.records.num_rows,
+            "num_blobs": self.blob_index.num_rows,
+            "train_format": self.train_format,
+            "shards": self.shards,
+        }
+        # written last: a directory without meta.json is not a complete store
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+
+class SampleStore:
+    def __init__(self, path):
+        """Random-access, memory-mapped reader of a store written by :class:`SampleStoreWriter`.
+
+        Like :class:`~data.file_dataset.FileDataset`, each distributed rank
+        only sees its own contiguous slice of the records.
+        """
+        self.path = path
+        assert is_sample_store(path), "Error: {} is not a sample store!".format(path)
+        with open(os.path.join(path, META_FILE)) as f:
+            self.meta = json.load(f)
+        assert self.meta["version"] == STORE_VERSION, \
+            "unsupported sample store version {}".format(self.meta["version"])
+        self.train_format = self.meta["train_format"]
+        self._maps_pid = None
+
+        self.total_row_count = self.meta["num_records"]
+        try:
+            self.slice_id = torch.distributed.get_rank()
+            self.slice_count = torch.distributed.get_world_size()
+        except Exception:
+            self.slice_id = 0
+            self.slice_count = 1
+        self._compute_start_pos_and_row_count()
+        print("sample store {} slice_id {} row count {} total row count {}".format(
+            self.path, self.slice_id, self.row_count, self.total_row_count)
+        )
+
+    @staticmethod
+    def _map(file_path):
+        if os.path.getsize(file_path) == 0:
+            return b""
+        with open(file_path, "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _open(self):
+        # mapped lazily and per process, so that the store can be sent to dataloader workers
+        if self._maps_pid == os.getpid():
+            return
+        self.records = np.load(os.path.join(self.path, "records.npy"), mmap_mode="r")
+        self.blob_index = np.load(os.path.join(self.path, "blobs.npy"), mmap_mode="r")
+        self.polygon_index = np.load(os.path.join(self.path, "polygons.npy"), mmap_mode="r")
+        self.coords = np.load(os.path.join(self.path, "coords.npy"), mmap_mode="r")
+        self._strings = self._map(os.path.join(self.path, "strings.bin"))
+        self._shards = [self._map(os.path.join(self.path, shard)) for shard in self.meta["shards"]]
+        self._maps_pid = os.getpid()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ("records", "blob_index", "polygon_index", "coords", "_strings", "_shards"):
+            state.pop(name, None)
+        state["_maps_pid"] = None
+        return state
+
+    def _compute_start_pos_and_row_count(self):
+        self.row_count = self.total_row_count // self.slice_count
+        if self.slice_id < self.total_row_count - self.row_count * self.slice_count:
+            self.row_count += 1
+            self.start_pos = self.row_count * self.slice_id
+        else:
+            self.start_pos = self.row_count * self.slice_id + (self.total_row_count - self.row_count * self.slice_count)
+
+    def _seek(self, offset=0):
+        # rows are read by index, there is no reader position to move
+        pass
+
+    def __len__(self):
+        return self.row_count
+
+    def get_total_row_count(self):
+        return self.total_row_count
+
+    def target_lengths(self):
+        """Decoder target length of every record (all slices): box corners, then every polygon and a separator / eos."""
+        self._open()
+        vertices = self.polygon_index[:, 1] // 2 + 1
+        cumsum = np.concatenate([[0], np.cumsum(vertices)])
+        first, count = self.records["polygons"][:, 0], self.records["polygons"][:, 1]
+        return 2 + cumsum[first + count] - cumsum[first]
+
+    def texts(self):
+        """Referring expression of every record (all slices)."""
+        self._open()
+        return [self._string(span) for span in self.records["text"]]
+
+    def _string(self, span):
+        offset, length = int(span[0]), int(span[1])
+        return self._strings[offset:offset + length].decode("utf-8")
+
+    def _blob(self, blob_id):
+        shard, offset, length = (int(x) for x in self.blob_index[blob_id])
+        return self._shards[shard][offset:offset + length]
+
+    def _polygons(self, span):
+        start, count = int(span[0]), int(span[1])
+        polygons = []
+        for offset, length in self.polygon_index[start:start + count]:
+            polygons.append(np.array(self.coords[offset:offset + length]))
+        return polygons
+
+    def __getitem__(self, index):
+        self._open()
+        record = self.records[self.start_pos + index]
+        mask_id = int(record["mask"])
+        return {
+            "uniq_id": self._string(record["id"]),
+            "text": self._string(record["text"]),
+            "image": self._blob(int(record["image"])),
+            "mask": self._blob(mask_id) if mask_id >= 0 else None,
+            "region": np.array(record["region"]),
+            "polygons": self._polygons(record["polygons"]),
+            "polygons_interpolated": self._polygons(record["polygons_interpolated"]),
+            "train_format": self.train_format,
+        }
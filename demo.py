@@ -34,7 +34,9 @@ cfg.generation.no_repeat_ngram_size = 3
 cfg.task.patch_image_size = 512
 
 from bert.tokenization_bert import BertTokenizer
+from utils.prompt_tokenizer import PromptTokenizer
 tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+prompt_tokenizer = PromptTokenizer(tokenizer)
 
 # Fix seed for stochastic decoding
 if cfg.common.seed is not None and not cfg.generation.no_seed_provided:
@@ -82,10 +84,7 @@ def construct_sample(image: Image, text: str):
     patch_image = patch_resize_transform(image).unsqueeze(0)
     patch_mask = torch.tensor([True])
     
-    prompt = ' which region does the text " {} " describe?'.format(text)
-    tokenized = tokenizer.batch_encode_plus([prompt], padding="longest", return_tensors="pt")
-    src_tokens = tokenized["input_ids"]
-    att_masks = tokenized["attention_mask"]
+    src_tokens, att_masks = prompt_tokenizer.batch_encode([text])
     src_lengths = torch.LongTensor(att_masks.ne(0).long().sum())
     
     sample = {
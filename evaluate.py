@@ -17,7 +17,9 @@ from fairseq.utils import reset_logging
 from omegaconf import DictConfig
 
 from utils import checkpoint_utils
-from utils.eval_utils import eval_step, merge_results
+from utils.eval_utils import ScoringPipeline, decode_step, eval_step, merge_results, sample_to_cpu, score_step
+from utils.prediction_store import PredictionShardWriter, shard_path
+from utils.vis_writer import VisWriter
 
 logging.basicConfig(
     format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
@@ -57,6 +59,8 @@ def main(cfg: DictConfig, **kwargs):
 
     # Load ensemble
     overrides = eval(cfg.common_eval.model_overrides)
+    # models finetuned on a feature store are evaluated on the images and expressions
+    overrides.setdefault("feature_store", None)
     # Deal with beam-search / all-candidate VQA eval
     if cfg.task._name == "vqa_gen":
         overrides['val_inference_type'] = "beamsearch" if kwargs['beam_search_vqa_eval'] else "allcand"
@@ -133,7 +137,6 @@ def main(cfg: DictConfig, **kwargs):
     #
     # merge_results(task, cfg, logger, kwargs['result_dir'])
 
-    results = []
     prec_list = [.5, .6, .7, .8, .9]
     prec_score_sum = [torch.FloatTensor([0]).cuda() for _ in prec_list]
     f_score_sum = torch.FloatTensor([0]).cuda()
@@ -142,14 +145,14 @@ def main(cfg: DictConfig, **kwargs):
     score_cnt = torch.FloatTensor([0]).cuda()
     cum_I_sum = torch.FloatTensor([0]).cuda()
     cum_U_sum = torch.FloatTensor([0]).cuda()
-    for sample in progress:
-        if "net_input" not in sample:
-            continue
-        sample = utils.move_to_cuda(sample) if use_cuda else sample
-        sample = utils.apply_to_sample(apply_half, sample) if cfg.common.fp16 else sample
-        with torch.no_grad():
-            result, scores, f_scores, ap_scores, cum_I, cum_U = eval_step(task, generator, models, sample, **kwargs)
-        results += result
+
+    # predictions are streamed to this rank's shard of the store instead of being kept in memory
+    prediction_dir = os.path.join(kwargs['result_dir'] or cfg.common_eval.results_path, "predictions")
+    prediction_writer = PredictionShardWriter(shard_path(prediction_dir, cfg.distributed_training.distributed_rank))
+
+    def accumulate(result, scores, f_scores, ap_scores, cum_I, cum_U):
+        nonlocal cum_I_sum, cum_U_sum, score_sum, f_score_sum, ap_det_score_sum, score_cnt
+        prediction_writer.append(result)
         for prec_score, prec in zip(prec_score_sum, prec_list):
             prec_score += sum(scores >= prec) if scores is not None else 0
         cum_I_sum += sum(cum_I) if scores is not None else 0
@@ -158,9 +161,42 @@ def main(cfg: DictConfig, **kwargs):
         f_score_sum += sum(f_scores) if scores is not None else 0
         ap_det_score_sum += sum(ap_scores) if scores is not None else 0
         score_cnt += len(scores) if scores is not None else 0
+
+    if kwargs['vis']:
+        # overlays are drawn and written by background processes
+        kwargs['vis_writer'] = VisWriter(kwargs['vis_dir'], num_workers=kwargs['vis_workers'],
+                                         every=kwargs['vis_every'], iou_below=kwargs['vis_iou_below'])
+
+    # with --pipeline-workers, batch N is scored on the host while batch N+1 decodes
+    pipeline = ScoringPipeline(kwargs['pipeline_workers']) if kwargs['pipeline_workers'] > 0 else None
+    for sample in progress:
+        if "net_input" not in sample:
+            continue
+        sample = utils.move_to_cuda(sample) if use_cuda else sample
+        sample = utils.apply_to_sample(apply_half, sample) if cfg.common.fp16 else sample
+        with torch.no_grad():
+            if pipeline is None:
+                accumulate(*eval_step(task, generator, models, sample, **kwargs))
+            else:
+                gen_out = decode_step(task, generator, models, sample, **kwargs)
+                for outputs in pipeline.submit(score_step, task, gen_out, sample_to_cpu(sample, kwargs['vis']),
+                                               **kwargs):
+                    accumulate(*outputs)
         progress.log({"sentences": sample["nsentences"]})
+    if pipeline is not None:
+        for outputs in pipeline.drain():
+            accumulate(*outputs)
+    if kwargs['vis']:
+        kwargs['vis_writer'].close()
+    prediction_writer.close()
+
+    merge_results(task, cfg, logger, score_cnt, score_sum, f_score_sum, ap_det_score_sum, prec_score_sum, cum_I_sum,
+                  cum_U_sum, prediction_dir=prediction_dir)
 
-    merge_results(task, cfg, logger, score_cnt, score_sum, f_score_sum, ap_det_score_sum,prec_score_sum, cum_I_sum, cum_U_sum, results)
+    image_embed_cache = getattr(models[0].encoder, "image_embed_cache", None)
+    if image_embed_cache is not None:
+        logger.info("image embedding cache: {} hits, {} backbone runs, {:.1f} MB cached".format(
+            image_embed_cache.hits, image_embed_cache.misses, image_embed_cache.num_bytes / 2 ** 20))
 
 
 def cli_main():
@@ -171,6 +207,12 @@ def cli_main():
     parser.add_argument("--vis_dir", type=str, default=None)
     parser.add_argument("--result_dir", type=str, default=None)
     parser.add_argument("--vis", action='store_true', default=False)
+    parser.add_argument("--vis-workers", type=int, default=2,
+                        help="processes writing --vis images in the background (0: write inline)")
+    parser.add_argument("--vis-every", type=int, default=1,
+                        help="visualize about one in N samples (picked by sample id)")
+    parser.add_argument("--vis-iou-below", type=float, default=None,
+                        help="only visualize samples with a mask IoU below this threshold")
     parser.add_argument(
         '--rs-eval-mode',
         type=str,
@@ -178,13 +220,21 @@ def cli_main():
         choices=['ris', 'vg'],
         help='Evaluation mode for RS reproduction: ris uses mask IoU; vg uses box IoU.',
     )
+    parser.add_argument(
+        '--pipeline-workers',
+        type=int,
+        default=0,
+        help='Score decoded batches on this many host threads while the next batches decode (0: score inline).',
+    )
     args = options.parse_args_and_arch(parser)
     cfg = convert_namespace_to_omegaconf(args)
     if args.result_dir is None:
         args.result_dir = args.vis_dir
     distributed_utils.call_main(
         cfg, main, ema_eval=args.ema_eval, beam_search_vqa_eval=args.beam_search_vqa_eval, zero_shot=args.zero_shot,
-        vis_dir=args.vis_dir, vis=args.vis, result_dir=args.result_dir, rs_eval_mode=args.rs_eval_mode
+        vis_dir=args.vis_dir, vis=args.vis, result_dir=args.result_dir, rs_eval_mode=args.rs_eval_mode,
+        pipeline_workers=args.pipeline_workers, vis_workers=args.vis_workers, vis_every=args.vis_every,
+        vis_iou_below=args.vis_iou_below
     )
 
 
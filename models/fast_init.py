@@ -0,0 +1,89 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Fast construction of models whose weights are restored from a checkpoint.
+
+Building a PolyFormer model the regular way downloads / reads the pretrained
+BERT weights, looks for pretrained Swin weights on disk and randomly
+initializes some hundred million parameters, all of which the checkpoint
+overwrites right away. Inside :func:`checkpoint_restore_init`
+
+* the encoder builds BERT from the bert-base-uncased config and neither the
+  encoder nor ``RefcocoTask.build_model`` look for pretrained weights
+  (:func:`restoring_from_checkpoint`)
+* parameters are created on the meta device, so their initialization costs
+  nothing; buffers are built as usual, since many of them are computed in
+  ``__init__`` (relative position buckets, ...)
+
+:func:`materialize_parameters_` then allocates the parameters, uninitialized,
+for the checkpoint to be copied into.
+"""
+
+import contextlib
+from typing import Dict, Optional
+
+import torch
+import torch.nn as nn
+
+_restore_depth = 0
+
+
+def restoring_from_checkpoint() -> bool:
+    """True while building a model inside :func:`checkpoint_restore_init`."""
+    return _restore_depth > 0
+
+
+@contextlib.contextmanager
+def checkpoint_restore_init():
+    """Build models on the meta device and without pretrained weights, see the module docstring."""
+    global _restore_depth
+    original_new = nn.Parameter.__dict__["__new__"]
+    parameter_new = nn.Parameter.__new__
+
+    def meta_parameter_new(cls, data=None, requires_grad=True):
+        if data is not None and data.device.type != "meta":
+            data = torch.empty_like(data, device="meta")
+        return parameter_new(cls, data, requires_grad)
+
+    _restore_depth += 1
+    if _restore_depth == 1:
+        nn.Parameter.__new__ = staticmethod(meta_parameter_new)
+    try:
+        yield
+    finally:
+        _restore_depth -= 1
+        if _restore_depth == 0:
+            nn.Parameter.__new__ = original_new
+
+
+def meta_parameter_names(module: nn.Module):
+    return [name for name, param in module.named_parameters() if param.device.type == "meta"]
+
+
+def materialize_parameters_(module: nn.Module, device="cpu", tensors: Optional[Dict[str, torch.Tensor]] = None):
+    """Replace the meta parameters of *module* with uninitialized ones on *device*, keeping tied parameters tied.
+
+    A parameter named in *tensors* (e.g. the state dict about to be loaded)
+    whose tensor there has its shape and dtype and is on *device* wraps that
+    tensor instead of allocating a new one.
+    """
+    tensors = tensors or {}
+    device = torch.device(device)
+    materialized: Dict[int, nn.Parameter] = {}
+    for prefix, submodule in module.named_modules():
+        for name, param in list(submodule._parameters.items()):
+            if param is None or param.device.type != "meta":
+                continue
+            if id(param) not in materialized:
+                tensor = tensors.get(prefix + "." + name if prefix else name)
+                if (
+                    tensor is None
+                    or tensor.shape != param.shape
+                    or tensor.dtype != param.dtype
+                    or tensor.device != device
+                ):
+                    tensor = torch.empty_like(param, device=device)
+                materialized[id(param)] = nn.Parameter(tensor, requires_grad=param.requires_grad)
+            submodule._parameters[name] = materialized[id(param)]
+    return module
@@ -0,0 +1,56 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from typing import List
+
+from torch import Tensor
+
+
+class DecodeSession(object):
+    def __init__(self, pos_embed: Tensor, self_attn_bias: List[Tensor], cross_pos_q: Tensor, cross_pos_k: Tensor):
+        """Position dependent inputs of the decoder for every step of one incremental decoding batch.
+
+        The decoder position embeddings and position biases only depend on
+        the target positions and on the encoder position embeddings, so they
+        are computed once per batch, for all positions up to the maximum
+        decoding length, instead of over the whole prefix at every step.
+        The self attention biases are kept per layer and a step takes its row.
+        The cross attention bias of all steps, (bsz, num_heads, max_len,
+        src_len), is too large to keep, so the position queries and keys are
+        kept instead and the row of a step is a single matmul.
+        Built by ``TransformerDecoder.begin_decode_session``.
+
+        Args:
+            pos_embed (Tensor): target position embeddings, (1, max_len, C)
+            self_attn_bias (List[Tensor]): per layer, absolute plus relative
+                self attention position bias, (num_heads, max_len, max_len)
+            cross_pos_q (Tensor): scaled cross attention position queries,
+                (1, num_heads, max_len, head_dim)
+            cross_pos_k (Tensor): cross attention position keys of the
+                encoder positions, (bsz, num_heads, src_len, head_dim)
+        """
+        self.pos_embed = pos_embed
+        self.self_attn_bias = self_attn_bias
+        self.cross_pos_q = cross_pos_q
+        self.cross_pos_k = cross_pos_k
+
+    @property
+    def max_len(self) -> int:
+        return self.pos_embed.size(1)
+
+    def step_pos_embed(self, step: int) -> Tensor:
+        """Position embedding of *step*, (1, 1, C)."""
+        return self.pos_embed[:, step:step + 1]
+
+    def step_self_attn_bias(self, idx: int, step: int) -> Tensor:
+        """Self attention bias of *step* over the prefix in layer *idx*, (1, num_heads, 1, step + 1)."""
+        return self.self_attn_bias[idx][None, :, step:step + 1, :step + 1]
+
+    def step_cross_attn_bias(self, step: int) -> Tensor:
+        """Cross attention bias of *step*, (bsz, num_heads, 1, src_len)."""
+        return self.cross_pos_q[:, :, step:step + 1].matmul(self.cross_pos_k.transpose(2, 3))
+
+    def reorder(self, new_order: Tensor):
+        """Keep the rows of *new_order* of the batch."""
+        self.cross_pos_k = self.cross_pos_k.index_select(0, new_order)
@@ -0,0 +1,99 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+import torch
+from torch import Tensor
+
+
+class ImageEmbedCache(object):
+    def __init__(self, max_bytes: int):
+        """LRU cache of visual backbone features keyed by image content.
+
+        Every expression of an image is stored as its own sample with its own
+        copy of the image, so without a cache the backbone runs once per
+        expression. Keys are a hash of the preprocessed image tensor, so the
+        cache is only correct for deterministic preprocessing (i.e. not for
+        training with augmentation). Entries are dropped when the backbone
+        weights change (see :meth:`weights_version`), e.g. between the
+        validations of a training run.
+
+        Args:
+            max_bytes (int): upper bound on the memory held by cached
+                features; least recently used entries are evicted first
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tensor]" = OrderedDict()
+        self.version = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self.num_bytes = 0
+
+    @staticmethod
+    def weights_version(module: torch.nn.Module) -> tuple:
+        """Changes whenever a parameter of *module* is modified in place (an
+        optimizer step, loading a state dict) or moved to another device / dtype."""
+        return tuple((p.data_ptr(), p._version, p.dtype) for p in module.parameters())
+
+    @staticmethod
+    def image_keys(images: Tensor) -> List[str]:
+        # a single device-to-host copy for the whole batch
+        images = images.detach().float().cpu().numpy()
+        shape = "x".join(str(s) for s in images.shape[1:])
+        return ["{}-{}".format(hashlib.sha1(image.tobytes()).hexdigest(), shape) for image in images]
+
+    def embed(self, images: Tensor, embed_fn: Callable[[Tensor], Tensor], version: Optional[tuple] = None) -> Tensor:
+        """Return ``embed_fn(images)``, running *embed_fn* only on images
+        that are neither cached nor repeated earlier in the batch.
+
+        *version* identifies the weights of *embed_fn*; the cache is cleared
+        when it differs from the version the cached entries were computed with.
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+        keys = self.image_keys(images)
+        outs = [None] * len(keys)
+        missing = OrderedDict()  # key -> batch rows with that image
+        for i, key in enumerate(keys):
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                outs[i] = entry
+                self.hits += 1
+            else:
+                missing.setdefault(key, []).append(i)
+
+        if len(missing) > 0:
+            rows = [idx[0] for idx in missing.values()]
+            feats = embed_fn(images[rows])
+            for feat, (key, idx) in zip(feats, missing.items()):
+                # clone so that the entry does not keep the whole batch output alive
+                feat = feat.detach().clone()
+                for i in idx:
+                    outs[i] = feat
+                self._put(key, feat)
+                self.misses += 1
+                self.hits += len(idx) - 1
+        return torch.stack(outs, dim=0)
+
+    def _put(self, key: str, feat: Tensor):
+        nbytes = feat.numel() * feat.element_size()
+        if nbytes > self.max_bytes:
+            return
+        while self.num_bytes + nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.num_bytes -= evicted.numel() * evicted.element_size()
+        self._entries[key] = feat
+        self.num_bytes += nbytes
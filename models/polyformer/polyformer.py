@@ -21,6 +21,7 @@ from fairseq import utils
 from fairseq.models import register_model, register_model_architecture
 from fairseq.modules.transformer_sentence_encoder import init_bert_params
 
+from models.fast_init import restoring_from_checkpoint
 from .unify_transformer import TransformerModel
 
 logger = logging.getLogger(__name__)
@@ -34,7 +35,8 @@ class PolyFormerModel(TransformerModel):
         super().__init__(args, encoder, decoder)
 
         # We follow BERT's random weight initialization
-        self.apply(init_bert_params)
+        if not restoring_from_checkpoint():
+            self.apply(init_bert_params)
 
         self.classification_heads = nn.ModuleDict()
         if hasattr(self.encoder, "dictionary"):
@@ -93,6 +95,7 @@ class PolyFormerModel(TransformerModel):
         return_all_hiddens: bool = False,
         alignment_layer: Optional[int] = None,
         alignment_heads: Optional[int] = None,
+        image_features: Optional[torch.Tensor] = None,
     ):
         if classification_head_name is not None:
             features_only = True
@@ -105,7 +108,8 @@ class PolyFormerModel(TransformerModel):
             patch_masks=patch_masks,
             token_embeddings=token_embeddings,
             return_all_hiddens=return_all_hiddens,
-            sample_patch_num=sample_patch_num
+            sample_patch_num=sample_patch_num,
+            image_features=image_features
         )
         x_cls, x_reg, extra = self.decoder(
             prev_output_tokens_11,
@@ -0,0 +1,50 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from typing import Callable, Dict, Tuple
+
+import torch
+from torch import Tensor
+
+
+def table_capacity(length: int, max_length: int, min_capacity: int = 64) -> int:
+    """Size a length-indexed table is computed for: the next power of two, so that growing lengths reuse it."""
+    capacity = min_capacity
+    while capacity < length:
+        capacity *= 2
+    return min(capacity, max_length)
+
+
+class PosBiasCache(object):
+    def __init__(self):
+        """Relative position bias tables of every layer, computed once at inference.
+
+        The relative position bias of a layer only depends on the positions
+        (the image grid, the text or target length) and on the layer's bias
+        embedding. At inference every sample of a batch has the same
+        positions, so the tables are computed once, without a batch
+        dimension, and added by broadcast.
+
+        An entry is recomputed when the embedding it was computed from has
+        been modified in place (e.g. by an optimizer step or by loading a
+        state dict) or moved to another device / dtype.
+        """
+        self.tables: Dict[tuple, Tuple[tuple, Tensor]] = {}
+
+    def __len__(self):
+        return len(self.tables)
+
+    def clear(self):
+        self.tables.clear()
+
+    def get(self, key: tuple, weight: Tensor, compute: Callable[[], Tensor]) -> Tensor:
+        """The table of *key* computed by *compute* from the embedding *weight*."""
+        key = key + (weight.device, weight.dtype)
+        version = (weight.data_ptr(), weight._version)
+        entry = self.tables.get(key)
+        if entry is None or entry[0] != version:
+            with torch.no_grad():
+                entry = (version, compute())
+            self.tables[key] = entry
+        return entry[1]
@@ -8,6 +8,8 @@
 # SPDX-License-Identifier: Apache-2.0
 
 
+from typing import Dict, Optional
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -17,6 +19,11 @@ from timm.models.layers import DropPath, to_2tuple, trunc_normal_
 
 from torch import distributed as dist
 
+from .pos_bias_cache import PosBiasCache
+
+# scaled_dot_product_attention with the ``scale`` argument
+_HAS_SDPA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
+
 
 def get_dist_info():
     if dist.is_available():
@@ -260,23 +267,45 @@ class WindowAttention(nn.Module):
         trunc_normal_(self.relative_position_bias_table, std=.02)
         self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, x, mask=None):
+        # set by SwinTransformer.set_inference_cache
+        self.bias_cache: Optional[PosBiasCache] = None
+
+    def get_relative_position_bias(self):
+        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
+            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
+        return relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+
+    def get_attn_bias(self, mask, mask_key, dtype):
+        """Relative position bias plus shift mask of every window, (nH, N, N) or (nW*nH, N, N), in *dtype*,
+        cached per padded feature map size *mask_key*."""
+        if mask is None:
+            return self.bias_cache.get(
+                ("window", dtype), self.relative_position_bias_table, lambda: self.get_relative_position_bias().to(dtype)
+            )
+        return self.bias_cache.get(
+            ("shifted_window", dtype) + tuple(mask_key), self.relative_position_bias_table,
+            lambda: (self.get_relative_position_bias().unsqueeze(0) + mask.unsqueeze(1)).flatten(0, 1).to(dtype)
+        )
+
+    def forward(self, x, mask=None, mask_key=None):
         """ Forward function.
 
         Args:
             x: input features with shape of (num_windows*B, N, C)
             mask: (0/-inf) mask with shape of (num_windows, Wh*Ww, Wh*Ww) or None
+            mask_key: (Hp, Wp) padded feature map size *mask* was computed for
         """
         B_, N, C = x.shape
         qkv = self.qkv(x).reshape(B_, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         q, k, v = qkv[0], qkv[1], qkv[2]  # make torchscript happy (cannot use tensor as tuple)
 
+        if self.bias_cache is not None and not self.training and not torch.is_grad_enabled():
+            return self.forward_cached(q, k, v, mask, mask_key)
+
         q = q * self.scale
         attn = (q @ k.transpose(-2, -1))
 
-        relative_position_bias = self.relative_position_bias_table[self.relative_position_index.view(-1)].view(
-            self.window_size[0] * self.window_size[1], self.window_size[0] * self.window_size[1], -1)  # Wh*Ww,Wh*Ww,nH
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # nH, Wh*Ww, Wh*Ww
+        relative_position_bias = self.get_relative_position_bias()
         attn = attn + relative_position_bias.unsqueeze(0)
 
         if mask is not None:
@@ -287,13 +316,33 @@ class WindowAttention(nn.Module):
         else:
             attn = self.softmax(attn)
 
-        attn = self.attn_drop(attn).half()
+        attn = self.attn_drop(attn).type_as(v)
 
         x = (attn @ v).transpose(1, 2).reshape(B_, N, C)
         x = self.proj(x)
         x = self.proj_drop(x)
         return x
 
+    def forward_cached(self, q, k, v, mask, mask_key):
+        """Inference forward with the cached attention bias; fused attention kernel on GPU."""
+        B_, nH, N, head_dim = q.shape
+        attn_bias = self.get_attn_bias(mask, mask_key, q.dtype)
+        if mask is not None:
+            # windows and heads as one dimension, so that the bias of every window broadcasts over the batch
+            nW = mask.shape[0]
+            q, k, v = [t.reshape(B_ // nW, nW * nH, N, head_dim) for t in (q, k, v)]
+        if _HAS_SDPA and q.is_cuda:
+            x = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_bias, scale=self.scale)
+        else:
+            # the fused CPU kernels are slower than matmul-softmax-matmul with an additive bias
+            attn = (q * self.scale) @ k.transpose(-2, -1)
+            attn += attn_bias
+            x = self.softmax(attn) @ v
+        x = x.reshape(B_, nH, N, head_dim).transpose(1, 2).reshape(B_, N, nH * head_dim)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
 
 class SwinTransformerBlock(nn.Module):
     """ Swin Transformer Block.
@@ -373,7 +422,7 @@ class SwinTransformerBlock(nn.Module):
         x_windows = x_windows.view(-1, self.window_size * self.window_size, C)  # nW*B, window_size*window_size, C
 
         # W-MSA/SW-MSA
-        attn_windows = self.attn(x_windows, mask=attn_mask)  # nW*B, window_size*window_size, C
+        attn_windows = self.attn(x_windows, mask=attn_mask, mask_key=(Hp, Wp))  # nW*B, window_size*window_size, C
 
         # merge windows
         attn_windows = attn_windows.view(-1, self.window_size, self.window_size, C)
@@ -501,18 +550,12 @@ class BasicLayer(nn.Module):
         else:
             self.downsample = None
 
-    def forward(self, x, H, W):
-        """ Forward function.
+        # SW-MSA attention masks by (Hp, Wp, device), set by SwinTransformer.set_inference_cache
+        self.attn_mask_cache: Optional[Dict[tuple, torch.Tensor]] = None
 
-        Args:
-            x: Input feature, tensor size (B, H*W, C).
-            H, W: Spatial resolution of the input feature.
-        """
-
-        # calculate attention mask for SW-MSA
-        Hp = int(np.ceil(H / self.window_size)) * self.window_size
-        Wp = int(np.ceil(W / self.window_size)) * self.window_size
-        img_mask = torch.zeros((1, Hp, Wp, 1), device=x.device)  # 1 Hp Wp 1
+    def get_attn_mask(self, Hp, Wp, device):
+        """ Attention mask for SW-MSA of a feature map padded to Hp x Wp, (nW, window_size**2, window_size**2)."""
+        img_mask = torch.zeros((1, Hp, Wp, 1), device=device)  # 1 Hp Wp 1
         h_slices = (slice(0, -self.window_size),
                     slice(-self.window_size, -self.shift_size),
                     slice(-self.shift_size, None))
@@ -529,6 +572,26 @@ class BasicLayer(nn.Module):
         mask_windows = mask_windows.view(-1, self.window_size * self.window_size)
         attn_mask = mask_windows.unsqueeze(1) - mask_windows.unsqueeze(2)
         attn_mask = attn_mask.masked_fill(attn_mask != 0, float(-100.0)).masked_fill(attn_mask == 0, float(0.0))
+        return attn_mask
+
+    def forward(self, x, H, W):
+        """ Forward function.
+
+        Args:
+            x: Input feature, tensor size (B, H*W, C).
+            H, W: Spatial resolution of the input feature.
+        """
+
+        # calculate attention mask for SW-MSA
+        Hp = int(np.ceil(H / self.window_size)) * self.window_size
+        Wp = int(np.ceil(W / self.window_size)) * self.window_size
+        if self.attn_mask_cache is not None and not self.training:
+            key = (Hp, Wp, x.device)
+            attn_mask = self.attn_mask_cache.get(key)
+            if attn_mask is None:
+                attn_mask = self.attn_mask_cache[key] = self.get_attn_mask(Hp, Wp, x.device)
+        else:
+            attn_mask = self.get_attn_mask(Hp, Wp, x.device)
 
         for blk in self.blocks:
             blk.H, blk.W = H, W
@@ -680,6 +743,15 @@ class SwinTransformer(nn.Module):
             self.add_module(layer_name, layer)
 
         self._freeze_stages()
+        self.set_inference_cache(True)
+
+    def set_inference_cache(self, enabled: bool):
+        """At inference, cache the SW-MSA masks and the relative position bias of every window attention
+        per feature map size and run the window attention as one fused kernel with an additive bias."""
+        for layer in self.layers:
+            layer.attn_mask_cache = {} if enabled else None
+            for blk in layer.blocks:
+                blk.attn.bias_cache = PosBiasCache() if enabled else None
 
     def _freeze_stages(self):
         if self.frozen_stages >= 0:
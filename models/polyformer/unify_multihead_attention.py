@@ -20,6 +20,10 @@ from fairseq.modules.quant_noise import quant_noise
 from torch import Tensor, nn
 from torch.nn import Parameter
 
+# scaled_dot_product_attention with the ``scale`` argument
+_HAS_SDPA = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 1)
+ATTN_BACKENDS = ("eager", "sdpa")
+
 
 @with_incremental_state
 class MultiheadAttention(nn.Module):
@@ -95,10 +99,27 @@ class MultiheadAttention(nn.Module):
         self.reset_parameters()
 
         self.onnx_trace = False
+        # "eager" (bmm, softmax, bmm) or "sdpa" (F.scaled_dot_product_attention), see set_attn_backend
+        self.attn_backend = "eager"
 
     def prepare_for_onnx_export_(self):
         self.onnx_trace = True
 
+    def set_attn_backend(self, backend: str):
+        """Compute attention with bmm-softmax-bmm ("eager") or with the fused
+        F.scaled_dot_product_attention kernel ("sdpa", PyTorch >= 2.1).
+
+        The sdpa backend takes the attention biases and masks as one
+        additive mask and does not materialize the float attention
+        probabilities, so it is only used when the attention weights are
+        not returned (e.g. not for ``need_weights`` or ``before_softmax``).
+        """
+        if backend not in ATTN_BACKENDS:
+            raise ValueError("unknown attention backend {}, expected one of {}".format(backend, ATTN_BACKENDS))
+        if backend == "sdpa" and not _HAS_SDPA:
+            raise ValueError("the sdpa attention backend needs PyTorch >= 2.1, found {}".format(torch.__version__))
+        self.attn_backend = backend
+
     def reset_parameters(self):
         if self.qkv_same_dim:
             # Empirically observed the convergence to be much better with
@@ -341,13 +362,31 @@ class MultiheadAttention(nn.Module):
                     dim=1,
                 )
 
+        if (
+            self.attn_backend == "sdpa"
+            and not need_weights
+            and not before_softmax
+            and not self.onnx_trace
+            and not is_tpu
+        ):
+            attn = self.fused_attention(
+                q, k, v, bsz, tgt_len, src_len, attn_bias, attn_mask, self_attn_mask, key_padding_mask
+            )
+            return self.project_output(attn, tgt_len, bsz, embed_dim), None
+
         attn_weights = torch.bmm(q, k.transpose(1, 2))
         attn_weights = self.apply_sparse_mask(attn_weights, tgt_len, src_len, bsz)
 
         assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
 
         if attn_bias is not None:
-            attn_weights += attn_bias
+            if attn_bias.dim() == 4:
+                # (1 or bsz, num_heads, tgt_len, src_len), added by broadcast over the batch
+                attn_weights = (
+                    attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + attn_bias
+                ).view(bsz * self.num_heads, tgt_len, src_len)
+            else:
+                attn_weights += attn_bias
 
         if attn_mask is not None:
             attn_mask = attn_mask.unsqueeze(0)
@@ -384,6 +423,65 @@ class MultiheadAttention(nn.Module):
 
         assert v is not None
         attn = torch.bmm(attn_probs, v)
+        attn = self.project_output(attn, tgt_len, bsz, embed_dim)
+        attn_weights: Optional[Tensor] = None
+        if need_weights:
+            attn_weights = attn_weights_float.view(
+                bsz, self.num_heads, tgt_len, src_len
+            ).transpose(1, 0)
+            if not need_head_weights:
+                # average attention weights over heads
+                attn_weights = attn_weights.mean(dim=0)
+
+        return attn, attn_weights
+
+    def fused_attention(
+        self,
+        q: Tensor,
+        k: Tensor,
+        v: Tensor,
+        bsz: int,
+        tgt_len: int,
+        src_len: int,
+        attn_bias: Optional[Tensor],
+        attn_mask: Optional[Tensor],
+        self_attn_mask: Optional[Tensor],
+        key_padding_mask: Optional[Tensor],
+    ) -> Tensor:
+        """Attention of the scaled *q* over *k* / *v* (bsz * num_heads, len, head_dim) with
+        F.scaled_dot_product_attention; the biases and masks are summed into one additive
+        mask broadcasting to (bsz, num_heads, tgt_len, src_len)."""
+        mask: Optional[Tensor] = None
+        if attn_bias is not None:
+            mask = attn_bias if attn_bias.dim() == 4 else attn_bias.view(bsz, self.num_heads, tgt_len, src_len)
+        if attn_mask is not None:
+            mask = attn_mask if mask is None else mask + attn_mask
+        if self_attn_mask is not None:
+            self_attn_mask = self_attn_mask.unsqueeze(1)
+            mask = self_attn_mask if mask is None else mask + self_attn_mask
+        if key_padding_mask is not None:
+            key_padding_mask = key_padding_mask.view(bsz, 1, 1, src_len).to(torch.bool)
+            if mask is None:
+                # boolean masks of scaled_dot_product_attention mark the keys to attend to
+                mask = ~key_padding_mask
+            else:
+                mask = mask.masked_fill(key_padding_mask, float("-inf"))
+        if mask is not None and mask.dtype != torch.bool:
+            mask = mask.to(q.dtype)
+
+        dropout_p = self.dropout_module.p if self.training or self.dropout_module.apply_during_inference else 0.0
+        attn = F.scaled_dot_product_attention(
+            q.view(bsz, self.num_heads, tgt_len, self.head_dim),
+            k.view(bsz, self.num_heads, src_len, self.head_dim),
+            v.view(bsz, self.num_heads, src_len, self.head_dim),
+            attn_mask=mask,
+            dropout_p=dropout_p,
+            scale=1.0,  # q is already scaled
+        )
+        return attn.view(bsz * self.num_heads, tgt_len, self.head_dim)
+
+    def project_output(self, attn: Tensor, tgt_len: int, bsz: int, embed_dim: int) -> Tensor:
+        """Merge the heads of *attn* (bsz * num_heads, tgt_len, head_dim) and apply the output projection."""
         assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
         if self.onnx_trace and attn.size(1) == 1:
             # when ONNX tracing a single decoder step (sequence length == 1)
@@ -395,17 +493,7 @@ class MultiheadAttention(nn.Module):
             attn = attn.view(tgt_len, bsz, self.num_heads, self.head_dim)
             attn = torch.einsum('tbhd,h->tbhd', attn, self.c_attn)
             attn = attn.reshape(tgt_len, bsz, self.embed_dim)
-        attn = self.out_proj(attn)
-        attn_weights: Optional[Tensor] = None
-        if need_weights:
-            attn_weights = attn_weights_float.view(
-                bsz, self.num_heads, tgt_len, src_len
-            ).transpose(1, 0)
-            if not need_head_weights:
-                # average attention weights over heads
-                attn_weights = attn_weights.mean(dim=0)
-
-        return attn, attn_weights
+        return self.out_proj(attn)
 
     @staticmethod
     def _append_prev_key_padding_mask(
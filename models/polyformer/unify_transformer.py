@@ -39,8 +39,14 @@ from fairseq.modules.quant_noise import quant_noise as apply_quant_noise_
 from torch import Tensor
 
 from .unify_transformer_layer import TransformerEncoderLayer, TransformerDecoderLayer
+from .unify_multihead_attention import MultiheadAttention
 from .swin import SwinTransformer
+from .image_embed_cache import ImageEmbedCache
+from .pos_bias_cache import PosBiasCache, table_capacity
+from .decode_session import DecodeSession
+from bert.configuration_bert import BertConfig
 from bert.modeling_bert import BertModel
+from models.fast_init import restoring_from_checkpoint
 
 
 
@@ -457,7 +463,7 @@ class TransformerEncoder(FairseqEncoder):
             if out_index == 2:
                 conv_dim = 512
             ckpt_path = "../../pretrained_weights/swin_base_patch4_window12_384_22k.pth"
-            if os.path.exists(ckpt_path):
+            if not restoring_from_checkpoint() and os.path.exists(ckpt_path):
                 self.embed_images.init_weights(pretrained=ckpt_path)
                 print("Loaded Swin Pretrained Weights", ckpt_path)
         elif args.vis_encoder_type == 'swin-large':
@@ -467,13 +473,15 @@ class TransformerEncoder(FairseqEncoder):
                                                 depths=[2, 2, 18, 2], num_heads=[6, 12, 24, 48])
             conv_dim = 768 if out_indices == 2 else 1536
             ckpt_path = "../../pretrained_weights/swin_large_patch4_window12_384_22k.pth"
-            if os.path.exists(ckpt_path):
+            if not restoring_from_checkpoint() and os.path.exists(ckpt_path):
                 self.embed_images.init_weights(pretrained=ckpt_path)
                 print("Loaded Swin Pretrained Weights", ckpt_path)
         else:
             raise NotImplementedError
 
         self.image_proj = Linear(conv_dim, embed_dim)
+        # content-keyed backbone feature cache, only consulted in eval mode
+        self.image_embed_cache: Optional[ImageEmbedCache] = None
         if getattr(args, "patch_layernorm_embedding", False):
             self.patch_layernorm_embedding = LayerNorm(embed_dim)
         else:
@@ -528,8 +536,15 @@ class TransformerEncoder(FairseqEncoder):
 
         self.register_buffer("token_rp_bucket", token_rp_bucket)
         self.register_buffer("image_rp_bucket", image_rp_bucket)
+        # relative position bias tables, only used in eval mode without gradients
+        self.pos_bias_cache: Optional[PosBiasCache] = PosBiasCache()
         self.entangle_position_embedding = args.entangle_position_embedding
-        self.bert = BertModel.from_pretrained("bert-base-uncased")
+        if restoring_from_checkpoint():
+            # the weights come from the checkpoint; the bert-base-uncased config is BertConfig's default
+            self.bert = BertModel(BertConfig())
+            self.bert.eval()
+        else:
+            self.bert = BertModel.from_pretrained("bert-base-uncased")
 
     def train(self, mode=True):
         super(TransformerEncoder, self).train(mode)
@@ -555,16 +570,47 @@ class TransformerEncoder(FairseqEncoder):
         layer = fsdp_wrap(layer, min_num_params=min_params_to_wrap)
         return layer
 
+    def set_attn_backend(self, backend: str):
+        """Attention backend of every layer, see MultiheadAttention.set_attn_backend."""
+        for module in self.layers.modules():
+            if isinstance(module, MultiheadAttention):
+                module.set_attn_backend(backend)
+
+    def set_pos_bias_cache(self, enabled: bool):
+        """Compute the relative position bias tables once and add them by broadcast at inference."""
+        self.pos_bias_cache = PosBiasCache() if enabled else None
+
+    def use_pos_bias_cache(self):
+        return self.pos_bias_cache is not None and not self.training and not torch.is_grad_enabled()
+
     def get_rel_pos_bias(self, x, idx):
         seq_len = x.size(1)
+        weight = self.token_rel_pos_table_list[idx].weight
+        if self.use_pos_bias_cache():
+            capacity = table_capacity(seq_len, self.token_rp_bucket.size(0))
+            table = self.pos_bias_cache.get(
+                ("token", idx, capacity), weight,
+                lambda: F.embedding(self.token_rp_bucket[:capacity, :capacity], weight).permute(2, 0, 1).contiguous()
+            )
+            return table[None, :, :seq_len, :seq_len]
         rp_bucket = self.token_rp_bucket[:seq_len, :seq_len]
-        values = F.embedding(rp_bucket, self.token_rel_pos_table_list[idx].weight)
+        values = F.embedding(rp_bucket, weight)
         values = values.unsqueeze(0).expand(x.size(0), -1, -1, -1)
         values = values.permute([0, 3, 1, 2])
         return values.contiguous()
 
-    def get_image_rel_pos_bias(self, image_position_ids, idx):
+    def get_image_rel_pos_bias(self, image_position_ids, idx, image_grid: Optional[Tuple[int, int]] = None):
+        """Relative position bias of the image patches; with *image_grid* (every sample has the same
+        h x w grid of patches), a cached table that broadcasts over the batch."""
         bsz, seq_len = image_position_ids.shape
+        if image_grid is not None and self.use_pos_bias_cache():
+            weight = self.image_rel_pos_table_list[idx].weight
+            position_ids = image_position_ids[0]
+            return self.pos_bias_cache.get(
+                ("image", idx) + tuple(image_grid), weight,
+                lambda: F.embedding(self.image_rp_bucket[position_ids][:, position_ids], weight).permute(2, 0, 1)
+                .unsqueeze(0).contiguous()
+            )
         rp_bucket_size = self.image_rp_bucket.size(1)
 
         rp_bucket = self.image_rp_bucket.unsqueeze(0).expand(
@@ -575,21 +621,37 @@ class TransformerEncoder(FairseqEncoder):
         values = values.permute(0, 3, 1, 2)
         return values
 
-    def get_patch_images_info(self, patch_images, sample_patch_num, device):
-        image_embed = self.embed_images(patch_images)
+    def set_image_embed_cache(self, max_bytes: int):
+        """Cache backbone features of up to *max_bytes* for repeated images at inference (0 disables)."""
+        self.image_embed_cache = ImageEmbedCache(max_bytes) if max_bytes > 0 else None
+
+    def get_patch_images_info(self, patch_images, sample_patch_num, device, patch_image_index=None,
+                              image_features: Optional[torch.Tensor] = None):
+        if image_features is not None:
+            # precomputed backbone output, see data/feature_store.py
+            image_embed = image_features
+        elif self.image_embed_cache is not None and not self.training:
+            image_embed = self.image_embed_cache.embed(
+                patch_images, self.embed_images, ImageEmbedCache.weights_version(self.embed_images)
+            )
+        else:
+            image_embed = self.embed_images(patch_images)
+        num_images = image_embed.size(0)
+        bsz = num_images if patch_image_index is None else patch_image_index.size(0)
         h, w = image_embed.shape[-2:]
         image_num_patches = h * w
-        image_padding_mask = patch_images.new_zeros((patch_images.size(0), image_num_patches)).bool()
+        image_padding_mask = image_embed.new_zeros((bsz, image_num_patches)).bool()
         image_position_idx = torch.arange(w).unsqueeze(0).expand(h, w) + \
                              torch.arange(h).unsqueeze(1) * self.args.image_bucket_size + 1
         image_position_idx = image_position_idx.view(-1).to(device)
-        image_position_ids = image_position_idx[None, :].expand(patch_images.size(0), image_num_patches)
+        image_position_ids = image_position_idx[None, :].expand(bsz, image_num_patches)
 
         image_embed = image_embed.flatten(2).transpose(1, 2)
         if sample_patch_num is not None:
+            assert patch_image_index is None, "patch sampling needs one image per sample"
             patch_orders = [
                 random.sample(range(image_num_patches), k=sample_patch_num)
-                for _ in range(patch_images.size(0))
+                for _ in range(num_images)
             ]
             patch_orders = torch.LongTensor(patch_orders).to(device)
             image_embed = image_embed.gather(
@@ -600,7 +662,7 @@ class TransformerEncoder(FairseqEncoder):
             image_position_ids = image_position_ids.gather(1, patch_orders)
         image_pos_embed = self.embed_image_positions(image_position_ids)
 
-        return image_embed, image_num_patches, image_padding_mask, image_position_ids, image_pos_embed
+        return image_embed, image_num_patches, image_padding_mask, image_position_ids, image_pos_embed, (h, w)
 
     def forward_embedding(
         self,
@@ -609,7 +671,8 @@ class TransformerEncoder(FairseqEncoder):
         image_embed: Optional[torch.Tensor] = None,
         token_embedding: Optional[torch.Tensor] = None,
         pos_embed: Optional[torch.Tensor] = None,
-        image_pos_embed: Optional[torch.Tensor] = None
+        image_pos_embed: Optional[torch.Tensor] = None,
+        patch_image_index: Optional[torch.Tensor] = None
     ):
         # embed tokens and positions
         if token_embedding is None:
@@ -629,6 +692,9 @@ class TransformerEncoder(FairseqEncoder):
         # embed raw images
         if image_embed is not None:
             image_embed = self.image_proj(image_embed)
+            if patch_image_index is not None:
+                # projected once per distinct image, then repeated for each of its expressions
+                image_embed = image_embed.index_select(0, patch_image_index)
             image_x = image_embed = image_embed
             if self.entangle_position_embedding and image_pos_embed is not None:
                 image_x += image_pos_embed
@@ -654,7 +720,9 @@ class TransformerEncoder(FairseqEncoder):
         code_masks: Optional[torch.Tensor] = None,
         return_all_hiddens: bool = False,
         token_embeddings: Optional[torch.Tensor] = None,
-        sample_patch_num: Optional[int] = None
+        sample_patch_num: Optional[int] = None,
+        patch_image_index: Optional[torch.Tensor] = None,
+        image_features: Optional[torch.Tensor] = None
     ):
         """
         Args:
@@ -666,6 +734,13 @@ class TransformerEncoder(FairseqEncoder):
                 intermediate hidden states (default: False).
             token_embeddings (torch.Tensor, optional): precomputed embeddings
                 default `None` will recompute embeddings
+            patch_image_index (LongTensor, optional): image of every sample
+                as an index into *patch_images* of shape `(batch)`, so that
+                samples sharing an image pass it once; the visual backbone and
+                the image projection then run once per image
+            image_features (torch.Tensor, optional): precomputed output of
+                the visual backbone of shape `(batch, channels, h, w)`, used
+                instead of running it on *patch_images*
 
         Returns:
             dict:
@@ -686,7 +761,9 @@ class TransformerEncoder(FairseqEncoder):
                                        patch_masks,
                                        return_all_hiddens,
                                        token_embeddings,
-                                       sample_patch_num)
+                                       sample_patch_num,
+                                       patch_image_index,
+                                       image_features)
 
     # TorchScript doesn't support super() method so that the scriptable Subclass
     # can't access the base class model in Torchscript.
@@ -701,7 +778,9 @@ class TransformerEncoder(FairseqEncoder):
         patch_masks: Optional[torch.Tensor] = None,
         return_all_hiddens: bool = False,
         token_embeddings: Optional[torch.Tensor] = None,
-        sample_patch_num: Optional[int] = None
+        sample_patch_num: Optional[int] = None,
+        patch_image_index: Optional[torch.Tensor] = None,
+        image_features: Optional[torch.Tensor] = None
     ):
         """
         Args:
@@ -713,6 +792,13 @@ class TransformerEncoder(FairseqEncoder):
                 intermediate hidden states (default: False).
             token_embeddings (torch.Tensor, optional): precomputed embeddings
                 default `None` will recompute embeddings
+            patch_image_index (LongTensor, optional): image of every sample
+                as an index into *patch_images* of shape `(batch)`, so that
+                samples sharing an image pass it once; the visual backbone and
+                the image projection then run once per image
+            image_features (torch.Tensor, optional): precomputed output of
+                the visual backbone of shape `(batch, channels, h, w)`, used
+                instead of running it on *patch_images*
 
         Returns:
             dict:
@@ -728,21 +814,25 @@ class TransformerEncoder(FairseqEncoder):
         """
         image_embed = None
         image_pos_embed = None
-        if patch_images is not None:
-            image_embed, image_num_patches, image_padding_mask, image_position_ids, image_pos_embed = \
-                self.get_patch_images_info(patch_images, sample_patch_num, src_tokens.device)
+        image_grid = None
+        has_images = patch_images is not None or image_features is not None
+        if has_images:
+            image_embed, image_num_patches, image_padding_mask, image_position_ids, image_pos_embed, image_grid = \
+                self.get_patch_images_info(
+                    patch_images, sample_patch_num, src_tokens.device, patch_image_index, image_features
+                )
             image_padding_mask[~patch_masks] = True
 
         encoder_padding_mask = src_tokens.eq(0)
         #encoder_padding_mask = src_tokens.eq(self.padding_idx)
-        if patch_images is not None:
+        if has_images:
             encoder_padding_mask = torch.cat([image_padding_mask, encoder_padding_mask], dim=1)
         has_pads = (src_tokens.device.type == "xla" or encoder_padding_mask.any())
 
         pos_embed = self.embed_positions(utils.new_arange(src_tokens))
         x, encoder_embedding = self.forward_embedding(
             src_tokens, att_masks, image_embed, token_embeddings,
-            pos_embed, image_pos_embed
+            pos_embed, image_pos_embed, patch_image_index
         )
 
         # account for padding while computing the representation
@@ -753,17 +843,23 @@ class TransformerEncoder(FairseqEncoder):
         x = x.transpose(0, 1)
 
         pos_embed = self.pos_ln(pos_embed)
-        if patch_images is not None:
+        if has_images:
             image_pos_embed = self.image_pos_ln(image_pos_embed)
             pos_embed = torch.cat([image_pos_embed, pos_embed], dim=1)
 
-        pos_q = self.pos_q_linear(pos_embed).view(
-            x.size(1), x.size(0), self.num_attention_heads, -1
+        # at inference every sample has the same positions, so the position bias is
+        # computed for one sample and added to the attention weights by broadcast
+        shared_pos_bias = self.use_pos_bias_cache() and sample_patch_num is None
+        bias_pos_embed = pos_embed[:1] if shared_pos_bias else pos_embed
+        pos_q = self.pos_q_linear(bias_pos_embed).view(
+            bias_pos_embed.size(0), x.size(0), self.num_attention_heads, -1
         ).transpose(1, 2) * self.pos_scaling
-        pos_k = self.pos_k_linear(pos_embed).view(
-            x.size(1), x.size(0), self.num_attention_heads, -1
+        pos_k = self.pos_k_linear(bias_pos_embed).view(
+            bias_pos_embed.size(0), x.size(0), self.num_attention_heads, -1
         ).transpose(1, 2)
         abs_pos_bias = torch.matmul(pos_q, pos_k.transpose(2, 3))
+        if not shared_pos_bias:
+            image_grid = None
 
         encoder_states = []
 
@@ -775,10 +871,11 @@ class TransformerEncoder(FairseqEncoder):
             self_attn_bias = abs_pos_bias.clone()
             self_attn_bias[:, :, -src_tokens.size(1):, -src_tokens.size(1):] += self.get_rel_pos_bias(src_tokens, idx)
 
-            if patch_images is not None:
+            if has_images:
                 self_attn_bias[:, :, :x.size(0) - src_tokens.size(1), :x.size(0) - src_tokens.size(1)] += \
-                    self.get_image_rel_pos_bias(image_position_ids, idx)
-            self_attn_bias = self_attn_bias.reshape(-1, x.size(0), x.size(0))
+                    self.get_image_rel_pos_bias(image_position_ids, idx, image_grid)
+            if not shared_pos_bias:
+                self_attn_bias = self_attn_bias.reshape(-1, x.size(0), x.size(0))
 
             x = layer(
                 x, encoder_padding_mask=encoder_padding_mask if has_pads else None, self_attn_bias=self_attn_bias
@@ -1046,6 +1143,8 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         self.register_buffer("token_rp_bucket", token_rp_bucket)
         self.register_buffer("image_rp_bucket", image_rp_bucket)
         self.register_buffer("image_position_idx", image_position_idx)
+        # relative position bias tables, only used in eval mode without gradients
+        self.pos_bias_cache: Optional[PosBiasCache] = PosBiasCache()
         self.entangle_position_embedding = args.entangle_position_embedding
 
     def build_output_projection(self, args, dictionary, embed_tokens):
@@ -1080,15 +1179,47 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         layer = fsdp_wrap(layer, min_num_params=min_params_to_wrap)
         return layer
 
+    def set_attn_backend(self, backend: str):
+        """Attention backend of every layer, see MultiheadAttention.set_attn_backend."""
+        for module in self.layers.modules():
+            if isinstance(module, MultiheadAttention):
+                module.set_attn_backend(backend)
+
+    def set_pos_bias_cache(self, enabled: bool):
+        """Compute the relative position bias tables once and slice them at inference."""
+        self.pos_bias_cache = PosBiasCache() if enabled else None
+
+    def use_pos_bias_cache(self):
+        return self.pos_bias_cache is not None and not self.training and not torch.is_grad_enabled()
+
     def get_rel_pos_bias(self, x, idx):
         seq_len = x.size(1)
+        weight = self.token_rel_pos_table_list[idx].weight
+        if self.use_pos_bias_cache():
+            # the bias of a prefix is the top left block of the table, which grows with the decoded length
+            capacity = table_capacity(seq_len, self.token_rp_bucket.size(0))
+            table = self.pos_bias_cache.get(
+                ("token", idx, capacity), weight,
+                lambda: F.embedding(self.token_rp_bucket[:capacity, :capacity], weight).permute(2, 0, 1).contiguous()
+            )
+            return table[:, :seq_len, :seq_len]
         rp_bucket = self.token_rp_bucket[:seq_len, :seq_len]
-        values = F.embedding(rp_bucket, self.token_rel_pos_table_list[idx].weight)
+        values = F.embedding(rp_bucket, weight)
         values = values.permute([2, 0, 1])
         return values.contiguous()
 
     def get_image_rel_pos_bias(self, x, idx):
         seq_len = x.size(1)
+        if self.use_pos_bias_cache():
+            weight = self.image_rel_pos_table_list[idx].weight
+            capacity = table_capacity(seq_len, self.image_position_idx.size(0))
+            position_idx = self.image_position_idx[:capacity]
+            table = self.pos_bias_cache.get(
+                ("image", idx, capacity), weight,
+                lambda: F.embedding(self.image_rp_bucket[position_idx][:, position_idx], weight).permute(2, 0, 1)
+                .contiguous()
+            )
+            return table[:, :seq_len, :seq_len]
         image_position_idx = self.image_position_idx[:seq_len]
         rp_bucket = self.image_rp_bucket[image_position_idx][:, image_position_idx]
         values = F.embedding(rp_bucket, self.image_rel_pos_table_list[idx].weight)
@@ -1118,6 +1249,64 @@ class TransformerDecoder(FairseqIncrementalDecoder):
         abs_pos_bias = torch.matmul(pos_q, pos_k.transpose(2, 3))
         return abs_pos_bias
 
+    def get_self_attn_bias(self, self_abs_pos_bias, tokens, code_masks: Optional[Tensor], idx: int):
+        """Self attention position bias of layer *idx*, (bsz * num_heads, tgt_len, tgt_len)."""
+        self_attn_bias = self_abs_pos_bias.clone()
+        if code_masks is None or not code_masks.any():
+            self_attn_bias += self.get_rel_pos_bias(tokens, idx).unsqueeze(0)
+        elif code_masks is not None and code_masks.all():
+            self_attn_bias += self.get_image_rel_pos_bias(tokens, idx).unsqueeze(0)
+        else:
+            self_attn_bias[~code_masks] += self.get_rel_pos_bias(tokens, idx).unsqueeze(0)
+            self_attn_bias[code_masks] += self.get_image_rel_pos_bias(tokens, idx).unsqueeze(0)
+        return self_attn_bias.reshape(-1, *self_attn_bias.size()[-2:])
+
+    @torch.no_grad()
+    def begin_decode_session(
+        self,
+        encoder_out: Dict[str, List[Tensor]],
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        max_len: int,
+    ):
+        """Precompute the position embeddings and biases of the first *max_len* decoding
+        steps (see DecodeSession); incremental decoding with *incremental_state* then
+        indexes them instead of recomputing them over the prefix at every step.
+        Only used while code_masks is None."""
+        src_pos_embed = encoder_out["position_embeddings"][0]
+        bsz, src_len = src_pos_embed.size(0), src_pos_embed.size(1)
+        positions = torch.arange(max_len, device=src_pos_embed.device).unsqueeze(0)
+        pos_embed = self.embed_positions(positions)
+
+        self_abs_pos_bias = self.get_pos_info(positions, pos_embed, use_image=False)[0]
+        self_attn_bias = [
+            self_abs_pos_bias + self.get_rel_pos_bias(positions, idx) for idx in range(self.num_layers)
+        ]
+        cross_pos_q = self.cross_pos_q_linear(self.pos_ln(pos_embed)).view(
+            1, max_len, self.num_attention_heads, -1
+        ).transpose(1, 2) * self.pos_scaling
+        cross_pos_k = self.cross_pos_k_linear(src_pos_embed).view(
+            bsz, src_len, self.num_attention_heads, -1
+        ).transpose(1, 2)
+        session = DecodeSession(pos_embed, self_attn_bias, cross_pos_q, cross_pos_k)
+        self.set_incremental_state(incremental_state, "decode_session", session)
+        return session
+
+    def get_decode_session(
+        self, incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]]
+    ) -> Optional[DecodeSession]:
+        if incremental_state is None:
+            return None
+        return self.get_incremental_state(incremental_state, "decode_session")
+
+    def reorder_incremental_state(
+        self,
+        incremental_state: Dict[str, Dict[str, Optional[Tensor]]],
+        new_order: Tensor,
+    ):
+        session = self.get_decode_session(incremental_state)
+        if session is not None:
+            session.reorder(new_order)
+
     def forward(
         self,
         prev_output_tokens_11,
@@ -1273,30 +1462,50 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             padding_mask = encoder_out["encoder_padding_mask"][0]
 
         bsz, tgt_len = prev_output_tokens.shape
-        token_position_idx = utils.new_arange(prev_output_tokens)
-        tgt_pos_embed = self.embed_positions(token_position_idx)
-        if code_masks is not None and torch.any(code_masks):
-            image_position_idx = self.image_position_idx[:prev_output_tokens.size(1)].unsqueeze(0).expand(bsz, tgt_len)
-            tgt_pos_embed[code_masks] = self.embed_image_positions(image_position_idx)[code_masks]
-
-        # self attn position bias
-        self_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, use_image=False)
-        if code_masks is not None and torch.any(code_masks):
-            self_image_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, use_image=True)
-            self_abs_pos_bias[code_masks] = self_image_abs_pos_bias[code_masks]
-        # cross attn position bias
-        src_pos_embed = encoder_out['position_embeddings'][0]
-        cross_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, src_pos_embed=src_pos_embed)
-        if code_masks is not None and torch.any(code_masks):
-            cross_image_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, src_pos_embed=src_pos_embed, use_image=True)
-            cross_abs_pos_bias[code_masks] = cross_image_abs_pos_bias[code_masks]
-        cross_abs_pos_bias = cross_abs_pos_bias.reshape(-1, *cross_abs_pos_bias.size()[-2:])
+        # position embeddings and biases of this step, precomputed for the batch
+        session = self.get_decode_session(incremental_state) if code_masks is None else None
+        step = tgt_len - 1
+        if session is not None:
+            assert step < session.max_len, f"decoding step {step} beyond the decode session length {session.max_len}"
+            tgt_pos_embed = session.step_pos_embed(step)
+            self_abs_pos_bias = None
+            cross_abs_pos_bias = session.step_cross_attn_bias(step)
+        else:
+            token_position_idx = utils.new_arange(prev_output_tokens)
+            tgt_pos_embed = self.embed_positions(token_position_idx)
+            if code_masks is not None and torch.any(code_masks):
+                image_position_idx = self.image_position_idx[:prev_output_tokens.size(1)].unsqueeze(0).expand(bsz, tgt_len)
+                tgt_pos_embed[code_masks] = self.embed_image_positions(image_position_idx)[code_masks]
+
+            # self attn position bias
+            self_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, use_image=False)
+            if code_masks is not None and torch.any(code_masks):
+                self_image_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, use_image=True)
+                self_abs_pos_bias[code_masks] = self_image_abs_pos_bias[code_masks]
+            # cross attn position bias
+            src_pos_embed = encoder_out['position_embeddings'][0]
+            cross_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, src_pos_embed=src_pos_embed)
+            if code_masks is not None and torch.any(code_masks):
+                cross_image_abs_pos_bias = self.get_pos_info(prev_output_tokens, tgt_pos_embed, src_pos_embed=src_pos_embed, use_image=True)
+                cross_abs_pos_bias[code_masks] = cross_image_abs_pos_bias[code_masks]
+            cross_abs_pos_bias = cross_abs_pos_bias.reshape(-1, *cross_abs_pos_bias.size()[-2:])
 
         all_prev_output_tokens = prev_output_tokens.clone()
         if incremental_state is not None:
+            # only the newest position is fed through the layers, earlier keys/values
+            # are served from the per-layer attention cache
             prev_output_tokens = prev_output_tokens[:, -1:]
-            cross_abs_pos_bias = cross_abs_pos_bias[:, -1:, :]
-            tgt_pos_embed = tgt_pos_embed[:, -1:, :]
+            prev_output_tokens_11 = prev_output_tokens_11[:, -1:]
+            prev_output_tokens_12 = prev_output_tokens_12[:, -1:]
+            prev_output_tokens_21 = prev_output_tokens_21[:, -1:]
+            prev_output_tokens_22 = prev_output_tokens_22[:, -1:]
+            delta_x1 = delta_x1[:, -1:]
+            delta_y1 = delta_y1[:, -1:]
+            delta_x2 = delta_x2[:, -1:]
+            delta_y2 = delta_y2[:, -1:]
+            if session is None:
+                cross_abs_pos_bias = cross_abs_pos_bias[:, -1:, :]
+                tgt_pos_embed = tgt_pos_embed[:, -1:, :]
 
         # embed tokens and positions
         token_embedding_11 = self.embed_tokens(prev_output_tokens_11)
@@ -1324,7 +1533,7 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
         if self.layernorm_embedding is not None:
             if code_masks is None or not code_masks.any() or not getattr(self, "code_layernorm_embedding", False):
-                x = self.layernorm_embedding(x.half())
+                x = self.layernorm_embedding(x.type_as(self.layernorm_embedding.weight))
             elif code_masks is not None and code_masks.all():
                 x = self.code_layernorm_embedding(x)
             else:
@@ -1349,17 +1558,12 @@ class TransformerDecoder(FairseqIncrementalDecoder):
             else:
                 self_attn_mask = None
 
-            self_attn_bias = self_abs_pos_bias.clone()
-            if code_masks is None or not code_masks.any():
-                self_attn_bias += self.get_rel_pos_bias(all_prev_output_tokens, idx).unsqueeze(0)
-            elif code_masks is not None and code_masks.all():
-                self_attn_bias += self.get_image_rel_pos_bias(all_prev_output_tokens, idx).unsqueeze(0)
+            if session is not None:
+                self_attn_bias = session.step_self_attn_bias(idx, step)
             else:
-                self_attn_bias[~code_masks] += self.get_rel_pos_bias(all_prev_output_tokens, idx).unsqueeze(0)
-                self_attn_bias[code_masks] += self.get_image_rel_pos_bias(all_prev_output_tokens, idx).unsqueeze(0)
-            self_attn_bias = self_attn_bias.reshape(-1, *self_attn_bias.size()[-2:])
-            if incremental_state is not None:
-                self_attn_bias = self_attn_bias[:, -1:, :]
+                self_attn_bias = self.get_self_attn_bias(self_abs_pos_bias, all_prev_output_tokens, code_masks, idx)
+                if incremental_state is not None:
+                    self_attn_bias = self_attn_bias[:, -1:, :]
 
             x, layer_attn, _ = layer(
                 x,
@@ -0,0 +1,246 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+from typing import Dict, List, Optional
+
+import torch
+from torch import Tensor
+
+
+COO = 0  # <COO> class
+SEP = 1  # <SEP> class
+EOS = 2  # <EOS> class
+FINISHED = 3  # step taken after the sequence has already emitted <EOS>
+
+bos_index = 0  # index for bos token
+pad_index = 1  # index for padding token
+eos_index = 2  # index for eos token
+sep_index = 3  # index for separator token
+bin_offset = 4  # index of <bin_0_0>
+
+box_num_values = 4  # x1, y1, x2, y2 of the bounding box that precedes the polygons
+
+
+class PolygonGenerator(object):
+    def __init__(
+        self,
+        num_bins,
+        min_len=6,
+        max_len=210,
+        incremental=True,
+        sync_interval=8,
+        compact=True,
+        target="both",
+        decode_session=True,
+    ):
+        """Greedy polygon decoder for PolyFormer.
+
+        Token ids and bilinear deltas for the four quantized copies of every
+        vertex live in preallocated on-device buffers, and the COO/SEP/EOS
+        transitions are applied with masked tensor ops, so the decode loop
+        does not branch per sample in Python.
+
+        Args:
+            num_bins (int): number of quantization bins per axis
+            min_len (int, optional): <EOS> predicted before this step is
+                treated as a coordinate (default: 6)
+            max_len (int, optional): maximum number of decoding steps
+                (default: 210)
+            incremental (bool, optional): cache decoder keys/values across
+                steps instead of re-running the whole prefix (default: True)
+            sync_interval (int, optional): check whether every sample has
+                finished once every this many steps; this is the only
+                host-device sync inside the loop. 0 never checks and always
+                runs *max_len* steps (default: 8)
+            compact (bool, optional): at every sync point, drop the samples
+                that have emitted <EOS> from the decoder batch, the encoder
+                output and the incremental state, so that finished samples
+                stop paying for the slowest one in the batch (default: True)
+            target (str, optional): what the caller needs from the output,
+                one of "box", "polygon" or "both". "box" stops every sample
+                as soon as it has produced the four values of the bounding box;
+                "polygon" and "both" decode the full sequence, since the
+                model always emits the box before the polygons (default: "both")
+            decode_session (bool, optional): with *incremental*, compute the
+                decoder position embeddings and biases of all steps once per
+                batch (see ``TransformerDecoder.begin_decode_session``)
+                instead of over the whole prefix at every step (default: True)
+        """
+        self.num_bins = num_bins
+        self.min_len = min_len
+        self.max_len = max_len
+        self.incremental = incremental
+        self.sync_interval = sync_interval
+        self.compact = compact
+        assert target in ("box", "polygon", "both"), "unknown decode target: {}".format(target)
+        self.target = target
+        self.decode_session = decode_session
+
+    @torch.no_grad()
+    def generate(self, models, sample: Dict[str, Dict[str, Tensor]], **kwargs) -> List[List[float]]:
+        """Decode one batch.
+
+        Returns:
+            List[List[float]]: per sample, the predicted ``x, y`` pairs
+            (normalized to [0, 1]) with ``2`` marking a polygon separator and
+            ``-1`` marking <EOS> or a step taken after <EOS>.
+        """
+        model = models[0] if isinstance(models, list) else models
+        model.eval()
+        net_input = sample["net_input"]
+        encoder_out = model.encoder(
+            net_input["src_tokens"],
+            src_lengths=net_input["src_lengths"],
+            att_masks=net_input["att_masks"],
+            patch_images=net_input.get("patch_images"),
+            patch_masks=net_input["patch_masks"],
+            token_embeddings=net_input.get("token_embeddings"),
+            return_all_hiddens=False,
+            sample_patch_num=None,
+            patch_image_index=net_input.get("patch_image_index"),
+            image_features=net_input.get("image_features")
+        )
+        cls_types, coords, num_steps = self._decode(model, encoder_out, net_input["src_lengths"])
+        return self.to_gen_out(cls_types, coords, num_steps)
+
+    def _decode(self, model, encoder_out: Dict[str, List[Tensor]], src_lengths: Optional[Tensor]):
+        enc = encoder_out["encoder_out"][0]
+        bsz = enc.size(1)
+        device = enc.device
+        max_len = self.max_len
+        sync_interval = self.sync_interval
+        box_only = self.target == "box"
+        if box_only:
+            # every step adds at least one value, and most samples are done after two steps
+            max_len = min(max_len, box_num_values)
+            if sync_interval > 0:
+                sync_interval = 1
+        n_bins = self.num_bins
+
+        # 11 / 12 / 21 / 22 copies of the quantized vertex, and x1 / y1 / x2 / y2 deltas
+        tokens = torch.full((4, bsz, max_len + 1), pad_index, dtype=torch.long, device=device)
+        tokens[:, :, 0] = bos_index
+        deltas = torch.zeros((4, bsz, max_len + 1), dtype=torch.float, device=device)
+        deltas[2:, :, 0] = 1
+
+        cls_types = torch.full((bsz, max_len), FINISHED, dtype=torch.long, device=device)
+        coords = torch.zeros((bsz, max_len, 2), dtype=torch.float, device=device)
+        unfinished = torch.ones(bsz, dtype=torch.bool, device=device)
+        # original batch row of every row still in the decoder batch
+        row_index = torch.arange(bsz, device=device)
+        # number of values (2 per coordinate, 1 per separator) each sample has produced
+        num_values = torch.zeros(bsz, dtype=torch.long, device=device) if box_only else None
+        incremental_state: Optional[Dict[str, Dict[str, Optional[Tensor]]]] = {} if self.incremental else None
+        if incremental_state is not None and self.decode_session:
+            model.decoder.begin_decode_session(encoder_out, incremental_state, max_len)
+
+        num_steps = 0
+        for step in range(max_len):
+            if sync_interval > 0 and step > 0 and step % sync_interval == 0:
+                num_active = int(unfinished.sum())
+                if num_active == 0:
+                    break
+                if self.compact and num_active < unfinished.size(0):
+                    new_order = unfinished.nonzero().squeeze(1)
+                    tokens = tokens.index_select(1, new_order)
+                    deltas = deltas.index_select(1, new_order)
+                    unfinished = unfinished.index_select(0, new_order)
+                    row_index = row_index.index_select(0, new_order)
+                    if num_values is not None:
+                        num_values = num_values.index_select(0, new_order)
+                    encoder_out = model.encoder.reorder_encoder_out(encoder_out, new_order)
+                    if src_lengths is not None:
+                        src_lengths = src_lengths.index_select(0, new_order)
+                    if incremental_state is not None:
+                        model.decoder.reorder_incremental_state_scripting(incremental_state, new_order)
+            cur_len = step + 1
+            net_output = model.decoder(
+                tokens[0, :, :cur_len],
+                tokens[1, :, :cur_len],
+                tokens[2, :, :cur_len],
+                tokens[3, :, :cur_len],
+                deltas[0, :, :cur_len],
+                deltas[1, :, :cur_len],
+                deltas[2, :, :cur_len],
+                deltas[3, :, :cur_len],
+                code_masks=None,
+                encoder_out=encoder_out,
+                incremental_state=incremental_state,
+                features_only=False,
+                alignment_layer=None,
+                alignment_heads=None,
+                src_lengths=src_lengths,
+                return_all_hiddens=False
+            )
+            cls_type = net_output[0][:, -1].argmax(-1)
+            reg_output = net_output[1][:, -1].clamp(max=1)
+
+            is_coo = cls_type.eq(COO)
+            if step < self.min_len:
+                is_coo |= cls_type.eq(EOS)
+            is_coo &= unfinished
+            is_sep = cls_type.eq(SEP) & unfinished & ~is_coo
+            is_eos = unfinished & ~is_coo & ~is_sep
+
+            step_type = torch.full_like(cls_type, FINISHED)
+            step_type.masked_fill_(is_coo, COO)
+            step_type.masked_fill_(is_sep, SEP)
+            step_type.masked_fill_(is_eos, EOS)
+            cls_types[row_index, step] = step_type
+            coords[row_index, step] = reg_output.float()
+
+            # tokenization: bilinear neighbours of the predicted point
+            scaled = reg_output * (n_bins - 1)
+            floor = scaled.floor()
+            ceil = scaled.ceil()
+            floor_x, floor_y = floor[:, 0].long(), floor[:, 1].long()
+            ceil_x, ceil_y = ceil[:, 0].long(), ceil[:, 1].long()
+            next_tokens = torch.stack([
+                floor_x * n_bins + floor_y,
+                floor_x * n_bins + ceil_y,
+                ceil_x * n_bins + floor_y,
+                ceil_x * n_bins + ceil_y,
+            ]) + bin_offset
+            next_tokens.masked_fill_(~is_coo, pad_index)
+            next_tokens.masked_fill_(is_sep, sep_index)
+            next_tokens.masked_fill_(is_eos, eos_index)
+            tokens[:, :, cur_len] = next_tokens
+
+            delta = (scaled - floor).float().masked_fill_(~is_coo.unsqueeze(1), 0)
+            deltas[0, :, cur_len] = delta[:, 0]
+            deltas[1, :, cur_len] = delta[:, 1]
+            deltas[2, :, cur_len] = 1 - delta[:, 0]
+            deltas[3, :, cur_len] = 1 - delta[:, 1]
+
+            unfinished &= ~is_eos
+            if num_values is not None:
+                num_values += is_coo.long() * 2 + is_sep.long()
+                unfinished &= num_values < box_num_values
+            num_steps = cur_len
+
+        return cls_types[:, :num_steps], coords[:, :num_steps], num_steps
+
+    @staticmethod
+    def to_gen_out(cls_types: Tensor, coords: Tensor, num_steps: int) -> List[List[float]]:
+        """Convert decoded step types and coordinates to the list format used by the tasks."""
+        # a single device-to-host copy for the whole batch
+        cls_types = cls_types.tolist()
+        coords = coords.tolist()
+
+        # steps run past the point where every sample had finished are dropped
+        while num_steps > 0 and all(types[num_steps - 1] == FINISHED for types in cls_types):
+            num_steps -= 1
+
+        gen_out = []
+        for types, points in zip(cls_types, coords):
+            out = []
+            for step_type, point in zip(types[:num_steps], points[:num_steps]):
+                if step_type == COO:
+                    out.extend(point)
+                elif step_type == SEP:
+                    out.append(2)  # 2 indicates separator tokens
+                else:
+                    out.append(-1)  # eos and padding
+            gen_out.append(out)
+        return gen_out
@@ -39,6 +39,7 @@ python3 -m torch.distributed.launch --nproc_per_node=${GPUS_PER_NODE} --master_p
     --no-repeat-ngram-size=3 \
     --fp16 \
     --num-workers=0 \
+    --pipeline-workers=4 \
     --num-bins=${num_bins} \
     --vis_dir=${vis_dir} \
     --result_dir=${result_dir} \
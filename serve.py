@@ -0,0 +1,74 @@
+#!/usr/bin/env python3 -u
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Local HTTP inference server with dynamic batching, see utils/inference_server.py.
+
+  python serve.py --checkpoint weights/polyformer_l_refcocog.pt --port 8000 \
+    --max-batch-size 8 --max-latency-ms 10
+
+  curl -s localhost:8000/health
+  curl -s localhost:8000/predict -d "{\"image\": \"$(base64 -w0 demo/dog.jpg)\", \"text\": \"the dog wearing glasses\"}"
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+
+import torch
+
+from utils.inference import RefcocoPredictor
+from utils.inference_server import InferenceServer
+
+logging.basicConfig(
+    format="%(asctime)s | %(levelname)s | %(name)s | %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+    level=os.environ.get("LOGLEVEL", "INFO").upper(),
+    stream=sys.stdout,
+)
+logger = logging.getLogger("polyformer.serve")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dynamic-batching PolyFormer inference server")
+    parser.add_argument("--checkpoint", default="weights/polyformer_l_refcocog.pt")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--cpu", action="store_true", help="run the model on CPU even if CUDA is available")
+    parser.add_argument("--fp16", action="store_true", help="run the model in half precision (GPU only)")
+    parser.add_argument("--model-overrides", default="{}", type=str,
+                        help="a dictionary used to override model / task args at load time, "
+                             "e.g. \"{'decode_target': 'box'}\"")
+    parser.add_argument("--max-batch-size", default=8, type=int, help="largest decoded batch")
+    parser.add_argument("--max-latency-ms", default=10.0, type=float,
+                        help="longest wait for more requests after the first one of a batch arrived")
+    parser.add_argument("--max-queue-size", default=256, type=int,
+                        help="requests beyond this many waiting ones are rejected with 503")
+    parser.add_argument("--workers", default=4, type=int,
+                        help="threads decoding images, tokenizing and building masks")
+    parser.add_argument("--max-len", default=210, type=int, help="maximum polygon decoding steps")
+    parser.add_argument("--num-threads", default=0, type=int, help="torch intra-op threads on CPU (0: torch default)")
+    args = parser.parse_args()
+
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+    use_cuda = torch.cuda.is_available() and not args.cpu
+    if args.fp16 and not use_cuda:
+        logger.warning("--fp16 is ignored on CPU")
+    predictor = RefcocoPredictor.from_checkpoint(
+        args.checkpoint, use_cuda=use_cuda, use_fp16=args.fp16, model_overrides=eval(args.model_overrides),
+        max_len=args.max_len,
+    )
+    server = InferenceServer(predictor, max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms,
+                             max_queue_size=args.max_queue_size, num_workers=args.workers)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,7 @@ from dataclasses import dataclass, field
 import logging
 import os
 import math
+import numpy as np
 import torch
 from typing import Dict, Optional
 
@@ -23,6 +24,7 @@ from fairseq.tasks import FairseqTask, register_task
 from omegaconf import DictConfig
 from torch import Tensor, device, dtype, nn
 
+from data import data_utils
 
 
 logger = logging.getLogger(__name__)
@@ -209,15 +211,20 @@ class BaseTask(FairseqTask):
         # initialize the dataset with the correct starting epoch
         dataset.set_epoch(epoch)
 
-        # create mini-batches with given size constraints
-        batch_sampler = [
-            [j for j in range(i, min(i + max_sentences, len(dataset)))]
-            for i in range(0, len(dataset), max_sentences)
-        ]
-        total_row_count = dataset.dataset.get_total_row_count()
-        num_batches = math.ceil(math.ceil(total_row_count / num_shards) / max_sentences)
-        if len(batch_sampler) < num_batches:
-            batch_sampler.append([])
+        if max_tokens is not None and hasattr(dataset, "target_lengths"):
+            batch_sampler = self._length_bucketed_batches(
+                dataset, max_tokens, max_sentences, required_batch_size_multiple, seed, epoch
+            )
+        else:
+            # create mini-batches with given size constraints
+            batch_sampler = [
+                [j for j in range(i, min(i + max_sentences, len(dataset)))]
+                for i in range(0, len(dataset), max_sentences)
+            ]
+            total_row_count = dataset.dataset.get_total_row_count()
+            num_batches = math.ceil(math.ceil(total_row_count / num_shards) / max_sentences)
+            if len(batch_sampler) < num_batches:
+                batch_sampler.append([])
 
         # return a reusable, sharded iterator
         epoch_iter = iterators.EpochBatchIterator(
@@ -234,6 +241,63 @@ class BaseTask(FairseqTask):
 
         return epoch_iter
 
+    def _length_bucketed_batches(self, dataset, max_tokens, max_sentences, required_batch_size_multiple, seed, epoch):
+        """Token-budget batches of the local slice of *dataset*, bucketed by decoder target length.
+
+        Every rank still reads only its own contiguous slice of the data file.
+        The rows of each slice are sorted by target length (ties in a random
+        order that changes every epoch) and cut into batches of at most
+        *max_tokens* padded target tokens (batch size x longest target) and
+        *max_sentences* samples; a target longer than *max_tokens* gets a
+        batch of its own. The batches of all slices are computed, so that
+        every rank pads its own batches to the same number with empty ones.
+        """
+        lengths = dataset.target_lengths()
+        file_dataset = dataset.dataset
+        slice_count, slice_id = file_dataset.slice_count, file_dataset.slice_id
+        total_row_count = len(lengths)
+
+        batches_per_slice = []
+        for i in range(slice_count):
+            row_count = total_row_count // slice_count
+            if i < total_row_count - row_count * slice_count:
+                row_count += 1
+                start_pos = row_count * i
+            else:
+                start_pos = row_count * i + (total_row_count - row_count * slice_count)
+            slice_lengths = np.minimum(lengths[start_pos:start_pos + row_count], max_tokens)
+            with data_utils.numpy_seed(seed, epoch, i):
+                order = np.random.permutation(row_count)
+            order = order[np.argsort(slice_lengths[order], kind="mergesort")]
+            batches = data_utils.batch_by_size(
+                order,
+                None,
+                num_tokens_vec=slice_lengths[order],
+                max_tokens=max_tokens,
+                max_sentences=max_sentences,
+                required_batch_size_multiple=required_batch_size_multiple,
+            )
+            batches_per_slice.append((slice_lengths, batches))
+
+        slice_lengths, batch_sampler = batches_per_slice[slice_id]
+        assert len(slice_lengths) == len(dataset)
+        batch_sampler = [list(batch) for batch in batch_sampler]
+        num_batches = max(len(batches) for _, batches in batches_per_slice)
+        batch_sampler.extend([] for _ in range(num_batches - len(batch_sampler)))
+
+        def padding_efficiency(batches):
+            padded = sum(len(batch) * slice_lengths[batch].max() for batch in batches if len(batch) > 0)
+            return slice_lengths.sum() / max(padded, 1)
+
+        message = "length-bucketed batches of {} target tokens: {} batches, target padding efficiency {:.1%}".format(
+            max_tokens, len(batch_sampler), padding_efficiency(batch_sampler))
+        if max_sentences is not None:
+            sequential = [np.arange(i, min(i + max_sentences, len(dataset))) for i in range(0, len(dataset), max_sentences)]
+            message += " (batches of {} in file order: {} batches, {:.1%})".format(
+                max_sentences, len(sequential), padding_efficiency(sequential))
+        logger.info(message)
+        return batch_sampler
+
     def build_model(self, cfg: FairseqDataclass):
         model = super().build_model(cfg)
         bpe_dict = {
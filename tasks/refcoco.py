@@ -12,26 +12,23 @@ from dataclasses import dataclass, field
 import logging
 from typing import Optional
 import os
-import math
-import numpy as np
 import torch
 from fairseq import metrics
+from fairseq.dataclass import ChoiceEnum
 from fairseq.tasks import register_task
 
 from tasks.base_task import BaseTask, BaseConfig, load_bert_pretrained_weights
 from data.refcoco_dataset import RefcocoDataset
 from data.file_dataset import FileDataset
+from data.sample_store import SampleStore, is_sample_store
+from data.feature_store import FeatureStore
+from models.fast_init import restoring_from_checkpoint
+from models.polygon_generator import PolygonGenerator
 
 logger = logging.getLogger(__name__)
 
-
-COO = 0  # <COO> class
-SEP = 1  # <SEP> class
-EOS = 2  # <EOS> class
-bos_index = 0   # index for bos token
-sep_index = 3  # index for separator token
-
-
+DECODE_TARGET_CHOICES = ChoiceEnum(["box", "polygon", "both"])
+ATTN_BACKEND_CHOICES = ChoiceEnum(["eager", "sdpa"])
 
 
 @dataclass
@@ -71,12 +68,85 @@ class RefcocoConfig(BaseConfig):
             "help": 'generation args for Self-critical sequence training, as JSON string'
         },
     )
+    no_incremental_decode: bool = field(
+        default=False,
+        metadata={"help": "re-run the decoder on the whole prefix at every polygon decoding step "
+                          "instead of caching decoder keys/values"}
+    )
+    decode_sync_interval: int = field(
+        default=8,
+        metadata={"help": "check for finished polygon sequences every N decoding steps "
+                          "(0 always decodes the maximum length without syncing with the host)"}
+    )
+    no_decode_session: bool = field(
+        default=False,
+        metadata={"help": "recompute the decoder position embeddings and biases over the whole prefix at every "
+                          "incremental decoding step instead of precomputing them once per batch"}
+    )
+    no_decode_compaction: bool = field(
+        default=False,
+        metadata={"help": "keep finished polygon sequences in the decoder batch instead of dropping "
+                          "them at every --decode-sync-interval check"}
+    )
+    decode_target: DECODE_TARGET_CHOICES = field(
+        default="both",
+        metadata={"help": "outputs needed from polygon decoding; 'box' stops every sample after the "
+                          "two bounding box corners (REC / box metrics only)"}
+    )
+    image_embed_cache_mb: int = field(
+        default=0,
+        metadata={"help": "memory budget in MB of an LRU cache of visual backbone features keyed by "
+                          "image content, so that expressions sharing an image run the backbone once "
+                          "at inference (0 disables); repeated images only meet in the cache if the rows "
+                          "of an image are stored together, as in files built by create_finetuning_data.py"}
+    )
+    no_pos_bias_cache: bool = field(
+        default=False,
+        metadata={"help": "recompute the per-layer relative position bias for every batch at inference "
+                          "instead of caching one table per image grid / text length"}
+    )
+    no_swin_inference_cache: bool = field(
+        default=False,
+        metadata={"help": "rebuild the shifted window masks and relative position bias of the Swin backbone "
+                          "at every forward at inference and run its window attention unfused"}
+    )
+    attn_backend: ATTN_BACKEND_CHOICES = field(
+        default="eager",
+        metadata={"help": "attention of the encoder and decoder layers: 'eager' (bmm, softmax, bmm) or 'sdpa' "
+                          "(fused F.scaled_dot_product_attention with the position biases and padding as "
+                          "one additive mask, PyTorch >= 2.1)"}
+    )
+    no_fast_tokenizer: bool = field(
+        default=False,
+        metadata={"help": "tokenize every prompt with the generic BERT tokenizer instead of splicing the "
+                          "pre-tokenized template around trie-matched, memoized caption ids"}
+    )
+    pretokenize_prompts: bool = field(
+        default=False,
+        metadata={"help": "tokenize the expressions of the whole data file when the dataset is built (kept in a "
+                          "<file>.prompt_tokens_*.npy sidecar for data files), so that batching only pads ids"}
+    )
+    feature_store: Optional[str] = field(
+        default=None,
+        metadata={"help": "feature store written by tools/feature_store/precompute_features.py; the visual "
+                          "backbone and BERT are frozen and their stored outputs are read instead of the "
+                          "images and expressions, so only the fusion encoder layers and the decoder train"}
+    )
 
 
 @register_task("refcoco", dataclass=RefcocoConfig)
 class RefcocoTask(BaseTask):
     def __init__(self, cfg: RefcocoConfig, src_dict, tgt_dict):
         super().__init__(cfg, src_dict, tgt_dict)
+        self.feature_store = None
+        if cfg.feature_store is not None:
+            self.feature_store = FeatureStore(cfg.feature_store)
+            # the stored features are only valid for the preprocessing they were computed with
+            for key in ("patch_image_size", "max_text_len", "imagenet_default_mean_and_std"):
+                stored = self.feature_store.settings.get(key)
+                if stored != getattr(cfg, key):
+                    raise ValueError("feature store {} was computed with {}={}, but the task has {}".format(
+                        cfg.feature_store, key, stored, getattr(cfg, key)))
 
     def load_dataset(self, split, epoch=1, combine=False, **kwargs):
         paths = self.cfg.data.split(',')
@@ -86,7 +156,10 @@ class RefcocoTask(BaseTask):
             file_path = paths[(epoch - 1) % (len(paths) - 1)]
         else:
             file_path = paths[-1]
-        dataset = FileDataset(file_path, self.cfg.selected_cols)
+        if is_sample_store(file_path):
+            dataset = SampleStore(file_path)
+        else:
+            dataset = FileDataset(file_path, self.cfg.selected_cols)
 
         self.datasets[split] = RefcocoDataset(
             split,
@@ -101,20 +174,35 @@ class RefcocoTask(BaseTask):
             num_bins=self.cfg.num_bins,
             max_text_len=self.cfg.max_text_len,
             no_augment=self.cfg.no_augment,
-            max_image_size=self.cfg.max_image_size
+            max_image_size=self.cfg.max_image_size,
+            feature_store=self.feature_store,
+            fast_tokenizer=not self.cfg.no_fast_tokenizer,
+            pretokenize=self.cfg.pretokenize_prompts
         )
 
     def build_model(self, cfg):
         model = super().build_model(cfg)
-        bert_path = "../../pretrained_weights/bert-base-uncased-pytorch_model.bin"
-        if os.path.exists(bert_path):
-            load_bert_pretrained_weights(model.encoder.bert, bert_path)
-        if cfg._name == 'polyformer_b':
-            swin_path = "../../pretrained_weights/swin_base_patch4_window12_384_22k.pth"
-        else:
-            swin_path = "../../pretrained_weights/swin_large_patch4_window12_384_22k.pth"
-        if os.path.exists(swin_path):
-            model.encoder.embed_images.init_weights(pretrained=swin_path)
+        # skipped when all weights are about to be overwritten by a checkpoint
+        if not restoring_from_checkpoint():
+            bert_path = "../../pretrained_weights/bert-base-uncased-pytorch_model.bin"
+            if os.path.exists(bert_path):
+                load_bert_pretrained_weights(model.encoder.bert, bert_path)
+            if cfg._name == 'polyformer_b':
+                swin_path = "../../pretrained_weights/swin_base_patch4_window12_384_22k.pth"
+            else:
+                swin_path = "../../pretrained_weights/swin_large_patch4_window12_384_22k.pth"
+            if os.path.exists(swin_path):
+                model.encoder.embed_images.init_weights(pretrained=swin_path)
+        model.encoder.set_image_embed_cache(self.cfg.image_embed_cache_mb * 1024 * 1024)
+        model.encoder.set_pos_bias_cache(not self.cfg.no_pos_bias_cache)
+        model.decoder.set_pos_bias_cache(not self.cfg.no_pos_bias_cache)
+        model.encoder.embed_images.set_inference_cache(not self.cfg.no_swin_inference_cache)
+        model.encoder.set_attn_backend(self.cfg.attn_backend)
+        model.decoder.set_attn_backend(self.cfg.attn_backend)
+        if self.cfg.feature_store is not None:
+            # their outputs are read from the feature store
+            for module in (model.encoder.embed_images, model.encoder.bert):
+                module.requires_grad_(False)
         return model
 
     def _calculate_ap_score(self, hyps, refs, thresh=0.5):
@@ -163,7 +251,7 @@ class RefcocoTask(BaseTask):
             metrics.log_derived("score", compute_score)
 
     def _inference(self, sample, model):
-        gen_out = self.inference_step(model, sample)
+        gen_out = self.inference_step(model, sample, decode_target="box")
         refs = sample["region_coords"].float()
 
         # `inference_step()` for RefCOCO returns a variable-length sequence
@@ -182,130 +270,22 @@ class RefcocoTask(BaseTask):
         hyps[:, 1::2] /= sample["h_resize_ratios"].unsqueeze(1)
         return hyps, refs
 
-    def inference_step(self, model, sample):
-        with torch.no_grad():
-            if isinstance(model, list):
-                model = model[0]
-            min_len = 6
-            max_len = 210
-            model.eval()
-            img = sample["net_input"]["patch_images"]
-            b = img.shape[0]
-            prev_output_token_11 = [[bos_index] for _ in range(b)]
-            prev_output_token_12 = [[bos_index] for _ in range(b)]
-            prev_output_token_21 = [[bos_index] for _ in range(b)]
-            prev_output_token_22 = [[bos_index] for _ in range(b)]
-            delta_x1 = [[0] for _ in range(b)]
-            delta_y1 = [[0] for _ in range(b)]
-            delta_x2 = [[1] for _ in range(b)]
-            delta_y2 = [[1] for _ in range(b)]
-
-            gen_out = [[] for _ in range(b)]
-
-            n_bins = self.cfg.num_bins
-
-            unfinish_flag = np.ones(b)
-            i = 0
-
-            encoder_out = model.encoder(
-                sample['net_input']['src_tokens'],
-                src_lengths=sample['net_input']['src_lengths'],
-                att_masks=sample['net_input']['att_masks'],
-                patch_images=sample['net_input']['patch_images'],
-                patch_masks=sample['net_input']['patch_masks'],
-                token_embeddings=None,
-                return_all_hiddens=False,
-                sample_patch_num=None
-            )
-
-            while i < max_len and unfinish_flag.any():
-                prev_output_tokens_11_tensor = torch.tensor(np.array(prev_output_token_11)).to(img.device).long()
-                prev_output_tokens_12_tensor = torch.tensor(np.array(prev_output_token_12)).to(img.device).long()
-                prev_output_tokens_21_tensor = torch.tensor(np.array(prev_output_token_21)).to(img.device).long()
-                prev_output_tokens_22_tensor = torch.tensor(np.array(prev_output_token_22)).to(img.device).long()
-                delta_x1_tensor = torch.tensor(np.array(delta_x1)).to(img.device)
-                delta_x2_tensor = torch.tensor(np.array(delta_x2)).to(img.device)
-                delta_y1_tensor = torch.tensor(np.array(delta_y1)).to(img.device)
-                delta_y2_tensor = torch.tensor(np.array(delta_y2)).to(img.device)
-
-                net_output = model.decoder(
-                    prev_output_tokens_11_tensor,
-                    prev_output_tokens_12_tensor,
-                    prev_output_tokens_21_tensor,
-                    prev_output_tokens_22_tensor,
-                    delta_x1_tensor,
-                    delta_y1_tensor,
-                    delta_x2_tensor,
-                    delta_y2_tensor,
-                    code_masks=None,
-                    encoder_out=encoder_out,
-                    features_only=False,
-                    alignment_layer=None,
-                    alignment_heads=None,
-                    src_lengths=sample['net_input']['src_lengths'],
-                    return_all_hiddens=False
-                )
-
-                cls_output = net_output[0]
-                cls_type = torch.argmax(cls_output, 2)
-                reg_output = net_output[1]
-                for j in range(b):
-                    if unfinish_flag[j] == 1:  # prediction is not finished
-                        cls_j = cls_type[j, i].item()
-                        if cls_j == COO or (cls_j == EOS and i < min_len):
-                            output_j_x, output_j_y = reg_output[j, i].cpu().numpy()
-                            output_j_x = min(output_j_x, 1)
-                            output_j_y = min(output_j_y, 1)
-
-                            gen_out[j].extend([output_j_x, output_j_y])
-
-                            output_j_x = output_j_x * (n_bins - 1)
-                            output_j_y = output_j_y * (n_bins - 1)
-
-                            output_j_x_floor = math.floor(output_j_x)
-                            output_j_y_floor = math.floor(output_j_y)
-                            output_j_x_ceil = math.ceil(output_j_x)
-                            output_j_y_ceil = math.ceil(output_j_y)
-
-                            # tokenization
-                            prev_output_token_11[j].append(output_j_x_floor * n_bins + output_j_y_floor + 4)
-                            prev_output_token_12[j].append(output_j_x_floor * n_bins + output_j_y_ceil + 4)
-                            prev_output_token_21[j].append(output_j_x_ceil * n_bins + output_j_y_floor + 4)
-                            prev_output_token_22[j].append(output_j_x_ceil * n_bins + output_j_y_ceil + 4)
-
-                            delta_x = output_j_x - output_j_x_floor
-                            delta_y = output_j_y - output_j_y_floor
-
-                        elif cls_j == SEP:
-                            gen_out[j].append(2)  # insert 2 indicating separator tokens
-                            prev_output_token_11[j].append(sep_index)
-                            prev_output_token_12[j].append(sep_index)
-                            prev_output_token_21[j].append(sep_index)
-                            prev_output_token_22[j].append(sep_index)
-                            delta_x = 0
-                            delta_y = 0
-                        else:  # eos is predicted and i >= min_len
-                            unfinish_flag[j] = 0
-                            gen_out[j].append(-1)
-                            prev_output_token_11[j].append(2)  # 2 is eos token
-                            prev_output_token_12[j].append(2)  # 2 is eos token
-                            prev_output_token_21[j].append(2)  # 2 is eos token
-                            prev_output_token_22[j].append(2)  # 2 is eos token
-                            delta_x = 0
-                            delta_y = 0
-                    else:  # prediction is finished
-                        gen_out[j].append(-1)
-                        prev_output_token_11[j].append(1)  # 1 is padding token
-                        prev_output_token_12[j].append(1)
-                        prev_output_token_21[j].append(1)
-                        prev_output_token_22[j].append(1)
-                        delta_x = 0
-                        delta_y = 0
-                    delta_x1[j].append(delta_x)
-                    delta_y1[j].append(delta_y)
-                    delta_x2[j].append(1 - delta_x)
-                    delta_y2[j].append(1 - delta_y)
-                i += 1
-        print("inference step: ", i)
-        return gen_out
-
+    def build_generator(self, models, args=None, **extra_gen_kwargs):
+        gen_kwargs = {
+            "incremental": not self.cfg.no_incremental_decode,
+            "sync_interval": self.cfg.decode_sync_interval,
+            "compact": not self.cfg.no_decode_compaction,
+            "decode_session": not self.cfg.no_decode_session,
+            "target": self.cfg.decode_target,
+        }
+        gen_kwargs.update(extra_gen_kwargs)
+        return PolygonGenerator(self.cfg.num_bins, **gen_kwargs)
+
+    def inference_step(self, model, sample, min_len=6, max_len=210, incremental=None, decode_target=None):
+        gen_kwargs = {"min_len": min_len, "max_len": max_len}
+        if incremental is not None:
+            gen_kwargs["incremental"] = incremental
+        if decode_target is not None:
+            gen_kwargs["target"] = decode_target
+        generator = self.build_generator(model, **gen_kwargs)
+        return generator.generate(model, sample)
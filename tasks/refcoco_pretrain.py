@@ -22,6 +22,7 @@ from fairseq.tasks import register_task
 from tasks.base_task import BaseTask, BaseConfig
 from data.refcoco_pretrain_dataset import RefcocoPretrainDataset
 from data.file_dataset import FileDataset
+from models.fast_init import restoring_from_checkpoint
 from tasks.base_task import BaseTask, BaseConfig, load_bert_pretrained_weights
 
 logger = logging.getLogger(__name__)
@@ -91,15 +92,17 @@ class RefcocoPretrainTask(BaseTask):
 
     def build_model(self, cfg):
         model = super().build_model(cfg)
-        bert_path = "../../pretrained_weights/bert-base-uncased-pytorch_model.bin"
-        if os.path.exists(bert_path):
-            load_bert_pretrained_weights(model.encoder.bert, bert_path)
-        if cfg._name == 'polyformer_b':
-            swin_path = "../../pretrained_weights/swin_base_patch4_window12_384_22k.pth"
-        else:
-            swin_path = "../../pretrained_weights/swin_large_patch4_window12_384_22k.pth"
-        if os.path.exists(swin_path):
-            model.encoder.embed_images.init_weights(pretrained=swin_path)
+        # skipped when all weights are about to be overwritten by a checkpoint
+        if not restoring_from_checkpoint():
+            bert_path = "../../pretrained_weights/bert-base-uncased-pytorch_model.bin"
+            if os.path.exists(bert_path):
+                load_bert_pretrained_weights(model.encoder.bert, bert_path)
+            if cfg._name == 'polyformer_b':
+                swin_path = "../../pretrained_weights/swin_base_patch4_window12_384_22k.pth"
+            else:
+                swin_path = "../../pretrained_weights/swin_large_patch4_window12_384_22k.pth"
+            if os.path.exists(swin_path):
+                model.encoder.embed_images.init_weights(pretrained=swin_path)
         return model
 
     def _calculate_ap_score(self, hyps, refs, thresh=0.5):
@@ -0,0 +1,2 @@
+# 推理检查点工具
+# export_inference_checkpoint.py - 训练检查点导出为内存映射的推理检查点
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""export_inference_checkpoint.py
+
+Export a training checkpoint as an inference checkpoint (see
+utils/inference_checkpoint.py): the config and the model weights in half
+precision, without optimizer or EMA state, in a flat layout that is
+memory-mapped when loaded. Serving processes on one host then share the
+weights through the page cache instead of each unpickling a private copy.
+
+The output can be passed anywhere a checkpoint is loaded for inference
+(evaluate.py --path, serve.py --checkpoint, RefcocoPredictor.from_checkpoint).
+
+Typical usage:
+
+  python tools/checkpoints/export_inference_checkpoint.py \
+    --input weights/polyformer_b_refcoco.pt \
+    --out weights/polyformer_b_refcoco.infer \
+    --dtype fp16
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from utils.inference_checkpoint import EXPORT_DTYPES, export_inference_checkpoint  # noqa: E402
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Export a training checkpoint as a memory-mapped inference checkpoint")
+    ap.add_argument("--input", required=True, type=Path, help="Training checkpoint")
+    ap.add_argument("--out", required=True, type=Path, help="Output inference checkpoint")
+    ap.add_argument("--dtype", default="fp16", choices=sorted(EXPORT_DTYPES),
+                    help="Type of the floating point weights; fp32 keeps them exact, e.g. for CPU inference")
+    ap.add_argument("--use-ema", action="store_true", help="Export the EMA weights instead of the model weights")
+    args = ap.parse_args()
+
+    header = export_inference_checkpoint(str(args.input), str(args.out), dtype=args.dtype, use_ema=args.use_ema)
+
+    num_params = 0
+    for entry in header["tensors"].values():
+        numel = 1
+        for size in entry["shape"]:
+            numel *= size
+        num_params += numel
+    print("=== inference checkpoint written to {} ===".format(args.out))
+    print("tensors:     {}".format(len(header["tensors"])))
+    print("elements:    {:.1f}M ({})".format(num_params / 1e6, header["dtype"]))
+    print("input size:  {:.1f} MB".format(args.input.stat().st_size / 2 ** 20))
+    print("output size: {:.1f} MB".format(args.out.stat().st_size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,4 +2,4 @@
 # label_adapter.py - 标注统一层
 # dataset_profile.py - 数据集画像分析
 # eval_metrics.py - 统一评估指标
-
+# parallel_convert.py - 多进程转换引擎
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+parallel_convert.py - Shared multi-process engine for the dataset converters.
+
+Per-sample work (RLE decoding, contour extraction, XML parsing, ...) is fanned
+out to a process pool, while results are consumed in input order, so the JSONL
+files written with ``workers > 1`` are byte-identical to a serial run.
+
+A converter provides a picklable, module-level function that turns one work
+item into one or more :class:`ConvertedSample` and a ``on_sample`` callback
+that merges the per-sample stats in the parent process.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from multiprocessing import Pool
+from pathlib import Path
+from typing import IO, Any, Callable, Iterable, Iterator, Sequence
+
+
+try:
+    from tqdm import tqdm  # type: ignore
+except Exception:  # pragma: no cover
+
+    def tqdm(it: Iterable, **_: Any):
+        return it
+
+
+def default_workers() -> int:
+    return os.cpu_count() or 1
+
+
+@dataclass
+class ConvertedSample:
+    """One output line: a sample of ``split``, or a bad-sample entry if ``split`` is None."""
+
+    split: str | None
+    line: str
+    stats: dict[str, Any] = field(default_factory=dict)
+
+    @classmethod
+    def ok(cls, split: str, record: dict[str, Any], **stats: Any) -> "ConvertedSample":
+        # serialized in the worker, the parent only writes
+        return cls(split, json.dumps(record, ensure_ascii=False) + "\n", stats)
+
+    @classmethod
+    def bad(cls, record: dict[str, Any], **stats: Any) -> "ConvertedSample":
+        return cls(None, json.dumps(record, ensure_ascii=False) + "\n", stats)
+
+
+def ordered_map(
+    fn: Callable[[Any], Any],
+    items: Iterable[Any],
+    *,
+    workers: int = 1,
+    chunksize: int = 16,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+) -> Iterator[Any]:
+    """Yield ``fn(item)`` for every item, in input order, using ``workers`` processes."""
+    if workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield fn(item)
+        return
+    with Pool(workers, initializer=initializer, initargs=initargs) as pool:
+        yield from pool.imap(fn, items, chunksize=chunksize)
+
+
+class SplitWriters:
+    """Streaming writers of the per-split JSONL files and ``bad_samples.jsonl``."""
+
+    def __init__(self, out_dir: Path, file_names: dict[str, str], bad_name: str = "bad_samples.jsonl") -> None:
+        out_dir = Path(out_dir)
+        out_dir.mkdir(parents=True, exist_ok=True)
+        self.files: dict[str, IO[str]] = {
+            split: (out_dir / name).open("w", encoding="utf-8") for split, name in file_names.items()
+        }
+        self.bad_file = (out_dir / bad_name).open("w", encoding="utf-8")
+        self.counts: Counter = Counter()
+
+    def write(self, sample: ConvertedSample) -> None:
+        if sample.split is None:
+            self.bad_file.write(sample.line)
+            self.counts["bad"] += 1
+        else:
+            self.files[sample.split].write(sample.line)
+            self.counts[sample.split] += 1
+
+    def close(self) -> None:
+        for f in self.files.values():
+            f.close()
+        self.bad_file.close()
+
+    def __enter__(self) -> "SplitWriters":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+
+def run_conversion(
+    items: Sequence[Any],
+    convert_fn: Callable[[Any], ConvertedSample | list[ConvertedSample]],
+    writers: SplitWriters,
+    *,
+    workers: int = 1,
+    chunksize: int = 16,
+    initializer: Callable[..., None] | None = None,
+    initargs: tuple = (),
+    on_sample: Callable[[ConvertedSample], None] | None = None,
+    desc: str | None = None,
+) -> None:
+    """Convert ``items`` with ``convert_fn`` in parallel and write the samples in input order."""
+    results = ordered_map(
+        convert_fn, items, workers=workers, chunksize=chunksize, initializer=initializer, initargs=initargs
+    )
+    for result in tqdm(results, total=len(items), desc=desc):
+        for sample in result if isinstance(result, list) else [result]:
+            writers.write(sample)
+            if on_sample is not None:
+                on_sample(sample)
@@ -0,0 +1,2 @@
+# 冻结编码器特征库工具
+# precompute_features.py - 预先计算视觉主干与 BERT 特征
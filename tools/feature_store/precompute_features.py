@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""precompute_features.py
+
+Run the frozen parts of the PolyFormer encoder, the visual backbone
+(``encoder.embed_images``) and BERT (``encoder.bert``), once over refcoco-style
+data files and write their outputs to a feature store (see
+data/feature_store.py). Finetuning with ``--feature-store`` then reads these
+features instead of the images and expressions, and only trains the fusion
+encoder layers and the decoder.
+
+Samples are read and preprocessed exactly as by the refcoco task (same image
+transform, prompt and tokenization), with the settings of the checkpoint's
+task config; the networks run in eval mode. Each distinct image is encoded
+and stored once. The checkpoint must be the one finetuning starts from
+(``--restore-file``), so that the stored features match the frozen weights.
+
+Typical usage:
+
+  python tools/feature_store/precompute_features.py \
+    --checkpoint weights/polyformer_b_pretrain.pt \
+    --input datasets/finetune/refcoco+g_train_shuffled.tsv datasets/finetune/refcoco/refcoco_val.tsv \
+    --selected-cols 0,5,6,2,4,3,7 \
+    --out datasets/finetune/refcoco+g_b.features
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+from typing import Any, Iterable
+
+import torch
+
+try:
+    from tqdm import tqdm  # type: ignore
+except Exception:  # pragma: no cover
+
+    def tqdm(it: Iterable, **_: Any):
+        return it
+
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from data.feature_store import FeatureStoreWriter  # noqa: E402
+from models.polyformer.image_embed_cache import ImageEmbedCache  # noqa: E402
+
+
+def load(checkpoint: Path, overrides: dict):
+    from fairseq import utils
+
+    import models  # noqa: F401  (registers the polyformer architectures)
+    import tasks  # noqa: F401  (registers the refcoco task)
+    from utils.checkpoint_utils import load_model_ensemble_and_task
+
+    models_, cfg, task = load_model_ensemble_and_task(utils.split_paths(str(checkpoint)), arg_overrides=overrides)
+    return models_[0], cfg, task
+
+
+@torch.no_grad()
+def encode(encoder, batch, writer: FeatureStoreWriter, device: torch.device, dtype: torch.dtype) -> None:
+    net_input = batch["net_input"]
+    patch_images = net_input["patch_images"]
+    keys = ImageEmbedCache.image_keys(patch_images)
+
+    # the backbone only runs on images that are not in the store yet
+    new_rows = {}
+    for i, key in enumerate(keys):
+        if not writer.has_image(key) and key not in new_rows:
+            new_rows[key] = i
+    if new_rows:
+        rows = list(new_rows.values())
+        image_features = encoder.embed_images(patch_images[rows].to(device, dtype)).float().cpu().numpy()
+        for features, i in zip(image_features, rows):
+            writer.add_image(keys[i], features, (int(batch["w"][i]), int(batch["h"][i])))
+
+    src_tokens = net_input["src_tokens"]
+    att_masks = net_input["att_masks"]
+    token_features = encoder.bert(src_tokens.to(device), attention_mask=att_masks.to(device))[0].float().cpu().numpy()
+    for i, length in enumerate(att_masks.sum(1).tolist()):
+        writer.add(str(batch["id"][i]), keys[i], src_tokens[i, :length].numpy(), token_features[i, :length])
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Precompute frozen backbone and BERT features for decoder finetuning")
+    ap.add_argument("--checkpoint", required=True, type=Path, help="Checkpoint finetuning starts from")
+    ap.add_argument("--input", required=True, type=Path, nargs="+", help="Data files (.tsv / .jsonl) or sample stores")
+    ap.add_argument("--out", required=True, type=Path, help="Output feature store directory")
+    ap.add_argument("--selected-cols", default=None,
+                    help="TSV columns as for training (default: those of the checkpoint's task)")
+    ap.add_argument("--batch-size", default=32, type=int)
+    ap.add_argument("--num-workers", default=4, type=int, help="Data loading workers")
+    ap.add_argument("--fp16", action="store_true", help="Run the backbone and BERT in half precision on CUDA")
+    ap.add_argument("--cpu", action="store_true", help="Run on CPU even if CUDA is available")
+    args = ap.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.cpu else "cpu")
+    dtype = torch.float16 if args.fp16 and device.type == "cuda" else torch.float32
+    overrides = {"bpe_dir": str(REPO_ROOT / "utils" / "BPE"), "feature_store": None}
+    if args.selected_cols is not None:
+        overrides["selected_cols"] = args.selected_cols
+    model, cfg, task = load(args.checkpoint, overrides)
+    encoder = model.encoder.to(device, dtype).eval()
+
+    writer = FeatureStoreWriter(str(args.out), settings={
+        "checkpoint": str(args.checkpoint),
+        "patch_image_size": task.cfg.patch_image_size,
+        "max_text_len": task.cfg.max_text_len,
+        "imagenet_default_mean_and_std": task.cfg.imagenet_default_mean_and_std,
+    })
+    for path in args.input:
+        # the last data file is loaded as the validation split
+        task.cfg.data = str(path)
+        task.load_dataset("valid")
+        dataset = task.dataset("valid")
+        loader = torch.utils.data.DataLoader(
+            dataset, batch_size=args.batch_size, collate_fn=dataset.collater, num_workers=args.num_workers
+        )
+        for batch in tqdm(loader, desc=path.name):
+            encode(encoder, batch, writer, device, dtype)
+    meta = writer.close()
+
+    print("\n=== feature store written to {} ===".format(args.out))
+    print(json.dumps(meta, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
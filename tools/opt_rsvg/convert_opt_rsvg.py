@@ -31,12 +31,13 @@ import argparse
 import json
 import os
 import re
+import sys
 import xml.etree.ElementTree as ET
 import zipfile
 from collections import Counter, defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import IO, Any, Iterable
+from typing import Any, Iterable
 
 
 try:
@@ -47,6 +48,14 @@ except Exception:  # pragma: no cover
         return it
 
 
+# Make `tools.*` imports work when the script is executed as
+# `python tools/opt_rsvg/convert_opt_rsvg.py` (also in converter worker processes).
+_REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(_REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(_REPO_ROOT))
+
+from tools.common.parallel_convert import ConvertedSample, SplitWriters, default_workers, ordered_map  # noqa: E402
+
 _INT_LINE_RE = re.compile(r"^\s*(\d+)\s*$")
 
 
@@ -155,16 +164,22 @@ class XmlReader:
     def __call__(self, name: str) -> bytes: ...
 
 
-def _open_writers(out_dir: Path) -> dict[str, IO[str]]:
-    out_dir.mkdir(parents=True, exist_ok=True)
-    return {
-        "train": (out_dir / "opt_rsvg_train.jsonl").open("w", encoding="utf-8"),
-        "val": (out_dir / "opt_rsvg_val.jsonl").open("w", encoding="utf-8"),
-        "test": (out_dir / "opt_rsvg_test.jsonl").open("w", encoding="utf-8"),
-    }
+def _parse_xml_files(
+    xml_names: list[str], xml_reader: "XmlReader", workers: int
+) -> dict[str, XmlAnn]:
+    """Parse every distinct xml (by basename, first occurrence wins) with ``workers`` processes."""
+    first_names: dict[str, str] = {}
+    for xml_name in xml_names:
+        first_names.setdefault(os.path.basename(xml_name), xml_name)
+    # xml bytes are read in this process (zip handles are not fork-safe), only parsing is parallel
+    xml_bytes = (xml_reader(xml_name) for xml_name in first_names.values())
+    parsed = ordered_map(_parse_xml, xml_bytes, workers=workers, chunksize=64)
+    return dict(zip(first_names, tqdm(parsed, total=len(first_names), desc="OPT-RSVG xml")))
 
 
-def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None) -> dict[str, Any]:
+def convert_opt_rsvg(
+    root: Path, out_dir: Path, *, img_root: Path | None = None, workers: int = 1
+) -> dict[str, Any]:
     train_ids = _load_split_ids(root, "train")
     val_ids = _load_split_ids(root, "val")
     test_ids = _load_split_ids(root, "test")
@@ -187,8 +202,15 @@ def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None)
             img_root = root / "Image"  # default expected extracted folder
 
     xml_names, xml_reader = _iter_xml_entries(root)
-    writers = _open_writers(out_dir)
-    bad_f = (out_dir / "bad_samples.jsonl").open("w", encoding="utf-8")
+    xml_cache = _parse_xml_files(xml_names, xml_reader, workers)
+    writers = SplitWriters(
+        out_dir,
+        {
+            "train": "opt_rsvg_train.jsonl",
+            "val": "opt_rsvg_val.jsonl",
+            "test": "opt_rsvg_test.jsonl",
+        },
+    )
 
     stats: dict[str, Any] = {
         "total": 0,
@@ -202,28 +224,22 @@ def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None)
         "image_sizes": Counter(),
     }
 
-    xml_cache: dict[str, XmlAnn] = {}
     global_idx = 0
-    for xml_name in tqdm(xml_names, desc="OPT-RSVG xml"):
-        # parse xml (with cache)
+    for xml_name in xml_names:
         cache_key = os.path.basename(xml_name)
-        if cache_key not in xml_cache:
-            xml_cache[cache_key] = _parse_xml(xml_reader(xml_name))
         ann = xml_cache[cache_key]
 
         for obj_idx, obj in enumerate(ann.objects):
             if global_idx not in all_ids:
-                bad_f.write(
-                    json.dumps(
+                writers.write(
+                    ConvertedSample.bad(
                         {
                             "sample_id": str(global_idx),
                             "reason": "id_not_in_any_split",
                             "xml": cache_key,
                             "obj_idx": obj_idx,
-                        },
-                        ensure_ascii=False,
+                        }
                     )
-                    + "\n"
                 )
                 stats["bad"] += 1
                 global_idx += 1
@@ -231,17 +247,15 @@ def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None)
 
             expr = obj.description
             if not expr:
-                bad_f.write(
-                    json.dumps(
+                writers.write(
+                    ConvertedSample.bad(
                         {
                             "sample_id": str(global_idx),
                             "reason": "empty_expression",
                             "xml": cache_key,
                             "obj_idx": obj_idx,
-                        },
-                        ensure_ascii=False,
+                        }
                     )
-                    + "\n"
                 )
                 stats["bad"] += 1
                 global_idx += 1
@@ -281,7 +295,7 @@ def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None)
                 "notes": None,
             }
 
-            writers[split].write(json.dumps(sample, ensure_ascii=False) + "\n")
+            writers.write(ConvertedSample.ok(split, sample))
             stats[split] += 1
             stats["total"] += 1
             stats["categories"][obj.name] += 1
@@ -290,9 +304,7 @@ def convert_opt_rsvg(root: Path, out_dir: Path, *, img_root: Path | None = None)
             stats["image_sizes"][(ann.width, ann.height)] += 1
             global_idx += 1
 
-    for f in writers.values():
-        f.close()
-    bad_f.close()
+    writers.close()
 
     if global_idx != expected_total:
         raise AssertionError(f"Enumerated samples {global_idx} != expected {expected_total}")
@@ -349,9 +361,10 @@ def main() -> None:
         type=Path,
         help="Image directory (default: <root>/Image if exists)",
     )
+    ap.add_argument("--workers", default=default_workers(), type=int, help="Number of xml parsing processes")
     args = ap.parse_args()
 
-    meta = convert_opt_rsvg(args.root, args.out_dir, img_root=args.img_root)
+    meta = convert_opt_rsvg(args.root, args.out_dir, img_root=args.img_root, workers=args.workers)
     print("\n=== OPT-RSVG conversion complete ===")
     print(json.dumps(meta, indent=2, ensure_ascii=False))
 
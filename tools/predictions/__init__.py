@@ -0,0 +1,2 @@
+# 评估预测结果库工具
+# query_predictions.py - 合并 / 查询各 rank 的预测分片
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""query_predictions.py
+
+Summarize, export and query the prediction store that `evaluate.py` writes
+to `<result_dir>/predictions` (one shard per rank, see
+utils/prediction_store.py).
+
+Typical usage:
+
+  # metrics of all samples of all ranks
+  python tools/predictions/query_predictions.py summary \
+    --store results_polyformer_b/refcoco/result/refcoco_val/predictions
+
+  # failure cases with their polygons and masks as JSON
+  python tools/predictions/query_predictions.py export \
+    --store .../predictions --out failures.json --iou-below 0.5 \
+    --fields uniq_id,iou,box,polygons,mask
+
+  # one sample
+  python tools/predictions/query_predictions.py show --store .../predictions --id 12345_0
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from utils.prediction_store import PREDICTION_DTYPE, PredictionStore  # noqa: E402
+
+PREC_THRESHOLDS = [0.5, 0.6, 0.7, 0.8, 0.9]
+ALL_FIELDS = ["uniq_id", "polygons", "mask"] + [name for name in PREDICTION_DTYPE.names if name not in ("id", "polygons", "mask")]
+
+
+def summary(store: PredictionStore) -> dict:
+    iou = store.column("iou")
+    f_score = store.column("f_score")
+    n = len(iou)
+    if n == 0:
+        return {"sample_cnt": 0}
+    miou = float(iou.mean())
+    f = float(f_score.mean())
+    result = {
+        "sample_cnt": n,
+        "num_shards": len(store.shards),
+        "complete": store.complete,
+        "mIoU": round(miou, 4),
+        "oIoU": round(float(store.column("I").sum() / store.column("U").sum()), 4),
+        "ap_det": round(float(store.column("ap").mean()), 4),
+        "f_score": round(f, 4),
+        "J&F": round((miou + f) / 2, 4),
+    }
+    for prec in PREC_THRESHOLDS:
+        result[f"prec@{prec}"] = round(float((iou >= prec).mean()), 4)
+    return result
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Summarize / export / query an evaluation prediction store")
+    sub = ap.add_subparsers(dest="command", required=True)
+
+    p_summary = sub.add_parser("summary", help="Metrics over all samples")
+    p_summary.add_argument("--store", required=True, type=Path)
+
+    p_export = sub.add_parser("export", help="Write (selected) samples to a JSON list")
+    p_export.add_argument("--store", required=True, type=Path)
+    p_export.add_argument("--out", required=True, type=Path)
+    p_export.add_argument("--fields", default="uniq_id", help=f"Comma separated, any of {','.join(ALL_FIELDS)}")
+    p_export.add_argument("--iou-below", default=None, type=float, help="Only samples with a lower IoU")
+    p_export.add_argument("--iou-above", default=None, type=float, help="Only samples with at least this IoU")
+
+    p_show = sub.add_parser("show", help="All fields of one sample")
+    p_show.add_argument("--store", required=True, type=Path)
+    p_show.add_argument("--id", required=True, help="uniq_id of the sample")
+    args = ap.parse_args()
+
+    store = PredictionStore(str(args.store))
+    if not store.complete:
+        print("warning: some shards are incomplete (evaluation still running or interrupted)", file=sys.stderr)
+
+    if args.command == "summary":
+        print(json.dumps(summary(store), indent=2))
+    elif args.command == "export":
+        fields = args.fields.split(",")
+        unknown = [field for field in fields if field not in ALL_FIELDS]
+        if unknown:
+            ap.error(f"unknown fields: {unknown}")
+
+        def where(shard, index) -> bool:
+            iou = float(shard.records[index]["iou"])
+            if args.iou_below is not None and iou >= args.iou_below:
+                return False
+            return args.iou_above is None or iou >= args.iou_above
+
+        num_written = store.write_json(str(args.out), fields, where=where)
+        print(f"wrote {num_written} of {len(store)} samples to {args.out}")
+    else:
+        for shard, index in store:
+            if shard.uniq_id(index) == args.id:
+                print(json.dumps(shard.to_dict(index, ALL_FIELDS), indent=2))
+                return
+        sys.exit(f"no sample with uniq_id {args.id}")
+
+
+if __name__ == "__main__":
+    main()
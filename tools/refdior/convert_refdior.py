@@ -20,12 +20,20 @@ import os
 import json
 import argparse
 import hashlib
+import sys
 from pathlib import Path
 from typing import Dict, List, Tuple, Optional
 import xml.etree.ElementTree as ET
 from collections import defaultdict
 from tqdm import tqdm
 
+# 使 `tools.*` 在直接运行脚本（以及转换子进程）时可导入
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from tools.common.parallel_convert import ConvertedSample, SplitWriters, default_workers, ordered_map  # noqa: E402
+
 
 def parse_xml(xml_path: str) -> Dict:
     """解析单个 XML annotation 文件"""
@@ -77,21 +85,24 @@ def bbox_to_polygon(bbox: List[int]) -> List[List[int]]:
     ]
 
 
-def build_sample_index(ann_dir: str) -> List[Tuple[str, int]]:
+def build_sample_index(ann_dir: str, workers: int = 1) -> Tuple[List[Tuple[str, int]], Dict[str, Dict]]:
     """构建全局样本索引: [(xml_file, object_idx), ...]
     
-    按文件名排序，然后展开每个文件的所有 objects
+    按文件名排序，然后展开每个文件的所有 objects。
+    XML 用 workers 个进程并行解析（结果保持文件名顺序），同时返回解析结果 {xml_file: data}，
+    转换时不再重复解析。
     """
     xml_files = sorted([f for f in os.listdir(ann_dir) if f.endswith('.xml')])
+    xml_paths = [os.path.join(ann_dir, xml_file) for xml_file in xml_files]
+    parsed = ordered_map(parse_xml, xml_paths, workers=workers, chunksize=64)
+    xml_cache = dict(zip(xml_files, tqdm(parsed, total=len(xml_files), desc='Parsing XML')))
     
     sample_index = []
     for xml_file in xml_files:
-        xml_path = os.path.join(ann_dir, xml_file)
-        data = parse_xml(xml_path)
-        for obj_idx in range(len(data['objects'])):
+        for obj_idx in range(len(xml_cache[xml_file]['objects'])):
             sample_index.append((xml_file, obj_idx))
     
-    return sample_index
+    return sample_index, xml_cache
 
 
 def load_split_ids(split_file: str) -> set:
@@ -103,7 +114,8 @@ def load_split_ids(split_file: str) -> set:
 def convert_dataset(
     root_dir: str,
     out_dir: str,
-    img_root: Optional[str] = None
+    img_root: Optional[str] = None,
+    workers: int = 1
 ) -> Dict:
     """转换整个数据集"""
     
@@ -120,7 +132,7 @@ def convert_dataset(
     
     # 构建样本索引
     print("Building sample index...")
-    sample_index = build_sample_index(ann_dir)
+    sample_index, xml_cache = build_sample_index(ann_dir, workers)
     print(f"Total samples: {len(sample_index)}")
     
     # 验证
@@ -129,15 +141,11 @@ def convert_dataset(
         f"Sample count mismatch: {len(sample_index)} vs {len(all_ids)}"
     
     # 准备输出
-    os.makedirs(out_dir, exist_ok=True)
-    
-    splits = {
-        'train': (train_ids, open(os.path.join(out_dir, 'refdior_train.jsonl'), 'w', encoding='utf-8')),
-        'val': (val_ids, open(os.path.join(out_dir, 'refdior_val.jsonl'), 'w', encoding='utf-8')),
-        'test': (test_ids, open(os.path.join(out_dir, 'refdior_test.jsonl'), 'w', encoding='utf-8')),
-    }
-    
-    bad_samples_f = open(os.path.join(out_dir, 'bad_samples.jsonl'), 'w', encoding='utf-8')
+    writers = SplitWriters(Path(out_dir), {
+        'train': 'refdior_train.jsonl',
+        'val': 'refdior_val.jsonl',
+        'test': 'refdior_test.jsonl',
+    })
     
     # 统计
     stats = {
@@ -151,17 +159,9 @@ def convert_dataset(
         'bbox_sizes': [],
     }
     
-    # 缓存解析结果
-    xml_cache = {}
-    
     # 转换
     print("Converting samples...")
     for global_idx, (xml_file, obj_idx) in enumerate(tqdm(sample_index)):
-        # 解析 XML（带缓存）
-        if xml_file not in xml_cache:
-            xml_path = os.path.join(ann_dir, xml_file)
-            xml_cache[xml_file] = parse_xml(xml_path)
-        
         data = xml_cache[xml_file]
         obj = data['objects'][obj_idx]
         
@@ -177,7 +177,7 @@ def convert_dataset(
                 'xml_file': xml_file,
                 'obj_idx': obj_idx
             }
-            bad_samples_f.write(json.dumps(bad_sample, ensure_ascii=False) + '\n')
+            writers.write(ConvertedSample.bad(bad_sample))
             stats['bad'] += 1
             continue
         
@@ -221,15 +221,15 @@ def convert_dataset(
         # 确定 split
         if global_idx in train_ids:
             sample['split'] = 'train'
-            splits['train'][1].write(json.dumps(sample, ensure_ascii=False) + '\n')
+            writers.write(ConvertedSample.ok('train', sample))
             stats['train'] += 1
         elif global_idx in val_ids:
             sample['split'] = 'val'
-            splits['val'][1].write(json.dumps(sample, ensure_ascii=False) + '\n')
+            writers.write(ConvertedSample.ok('val', sample))
             stats['val'] += 1
         elif global_idx in test_ids:
             sample['split'] = 'test'
-            splits['test'][1].write(json.dumps(sample, ensure_ascii=False) + '\n')
+            writers.write(ConvertedSample.ok('test', sample))
             stats['test'] += 1
         else:
             bad_sample = {
@@ -238,7 +238,7 @@ def convert_dataset(
                 'xml_file': xml_file,
                 'obj_idx': obj_idx
             }
-            bad_samples_f.write(json.dumps(bad_sample, ensure_ascii=False) + '\n')
+            writers.write(ConvertedSample.bad(bad_sample))
             stats['bad'] += 1
             continue
         
@@ -252,9 +252,7 @@ def convert_dataset(
         stats['bbox_sizes'].append(w * h)
     
     # 关闭文件
-    for split_name, (_, f) in splits.items():
-        f.close()
-    bad_samples_f.close()
+    writers.close()
     
     # 计算统计信息
     import numpy as np
@@ -267,7 +265,7 @@ def convert_dataset(
         'val_samples': stats['val'],
         'test_samples': stats['test'],
         'bad_samples': stats['bad'],
-        'num_images': len(xml_cache),
+        'num_images': len(set(xml_file for xml_file, _ in sample_index)),
         'num_categories': len(stats['categories']),
         'categories': dict(stats['categories']),
         'expr_length_stats': {
@@ -305,13 +303,15 @@ def main():
                         help='Output directory for JSONL files')
     parser.add_argument('--img-root', type=str, default=None,
                         help='Path to JPEGImages directory (default: <root>/JPEGImages)')
+    parser.add_argument('--workers', type=int, default=default_workers(),
+                        help='Number of XML parsing processes')
     
     args = parser.parse_args()
     
     print(f"Converting DIOR-RSVG from: {args.root}")
     print(f"Output to: {args.out_dir}")
     
-    meta_stats = convert_dataset(args.root, args.out_dir, args.img_root)
+    meta_stats = convert_dataset(args.root, args.out_dir, args.img_root, args.workers)
     
     print("\n=== Conversion Complete ===")
     print(f"Total: {meta_stats['total_samples']}")
@@ -69,6 +69,174 @@ def _default_img_root(root: Path) -> Path:
     return candidates[0]
 
 
+# Make `tools.*` and `data.*` imports work even when the script is executed as
+# `python tools/rrsis_d/convert_rrsis_d.py` (also in converter worker processes).
+_REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(_REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(_REPO_ROOT))
+
+from tools.common.parallel_convert import ConvertedSample, SplitWriters, default_workers, run_conversion  # noqa: E402
+
+# conversion options of the current (worker) process, see `_init_worker`
+_OPTIONS: dict[str, Any] = {}
+
+
+def _init_worker(options: dict[str, Any]) -> None:
+    _OPTIONS.clear()
+    _OPTIONS.update(options)
+
+
+def _convert_ref(item: tuple[dict, dict | None, dict | None]) -> ConvertedSample:
+    from tools.common.label_adapter import mask_to_box_xyxy, mask_to_polygons, rle_to_mask
+
+    ref, ann, im = item
+    img_root = _OPTIONS["img_root"]
+    nmax = _OPTIONS["nmax"]
+    cc_policy = _OPTIONS["cc_policy"]
+    approx_epsilon = _OPTIONS["approx_epsilon"]
+    export_masks = _OPTIONS["export_masks"]
+    mask_dir = _OPTIONS["mask_dir"]
+
+    ref_id = int(ref["ref_id"])
+    ann_id = int(ref["ann_id"])
+    image_id = int(ref["image_id"])
+    split = ref.get("split")
+    if split not in {"train", "val", "test"}:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "bad_split",
+                "split": split,
+                "ann_id": ann_id,
+            }
+        )
+
+    if ann is None or im is None:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "missing_ann_or_image",
+                "ann_id": ann_id,
+                "image_id": image_id,
+            }
+        )
+
+    file_name = ref.get("file_name") or im.get("file_name")
+    if not file_name:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "missing_file_name",
+                "image_id": image_id,
+            }
+        )
+
+    sent_list = ref.get("sentences") or []
+    expr = (sent_list[0].get("sent") if sent_list else "") if isinstance(sent_list, list) else ""
+    expr = (expr or "").strip()
+    if not expr:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "empty_expression",
+                "ann_id": ann_id,
+            }
+        )
+
+    seg_list = ann.get("segmentation")
+    if not isinstance(seg_list, list) or not seg_list:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "missing_segmentation",
+                "ann_id": ann_id,
+            }
+        )
+
+    rle = seg_list[0]
+    try:
+        mask = rle_to_mask(rle)
+    except Exception as e:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "rle_decode_failed",
+                "ann_id": ann_id,
+                "error": str(e),
+            }
+        )
+
+    if mask.sum() == 0:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "empty_mask",
+                "ann_id": ann_id,
+            },
+            empty_mask=True,
+        )
+
+    poly_res = mask_to_polygons(mask, cc_policy=cc_policy, nmax=nmax, approx_epsilon=approx_epsilon)
+    if not poly_res.polygons:
+        return ConvertedSample.bad(
+            {
+                "sample_id": str(ref_id),
+                "reason": "mask_to_polygon_failed",
+                "ann_id": ann_id,
+            }
+        )
+
+    tight_box = mask_to_box_xyxy(mask)
+    raw_box = [int(x) for x in ann.get("bbox") or [0, 0, 0, 0]]
+    cat_id = int(ann.get("categories_id") or ref.get("category_id") or -1)
+    cat_name = _OPTIONS["cat_by_id"].get(cat_id)
+
+    mask_path: str | None
+    if export_masks:
+        import cv2
+
+        mask_path = str(mask_dir / f"{ref_id}.png")
+        cv2.imwrite(mask_path, (mask * 255).astype("uint8"))
+    else:
+        mask_path = None
+
+    sample = {
+        "sample_id": str(ref_id),
+        "split": split,
+        "image_path": str(img_root / file_name),
+        "mask_path": mask_path,
+        "image_id": Path(file_name).stem,
+        "image_id_int": image_id,
+        "ref_id": ref_id,
+        "ann_id": ann_id,
+        "expr": expr,
+        "img_w": int(im.get("width") or mask.shape[1]),
+        "img_h": int(im.get("height") or mask.shape[0]),
+        "raw_box_xyxy": raw_box,
+        "tight_box_xyxy": tight_box,
+        "polygons": poly_res.polygons,
+        "poly_meta": {
+            "cc_policy": cc_policy,
+            "nmax": int(nmax),
+            "n_vertices": poly_res.n_vertices,
+            "has_hole": False,
+            "fidelity_iou": float(poly_res.fidelity_iou),
+            "source": "rrsis-d_coco_rle",
+        },
+        "category": cat_name,
+        "category_id": cat_id,
+        "notes": None,
+    }
+    return ConvertedSample.ok(
+        split,
+        sample,
+        category=cat_name,
+        expr_len=len(expr.split()),
+        bbox_area=max(0, tight_box[2] - tight_box[0]) * max(0, tight_box[3] - tight_box[1]),
+        fidelity=float(poly_res.fidelity_iou),
+    )
+
+
 def convert_rrsis_d(
     root: Path,
     out_dir: Path,
@@ -79,15 +247,8 @@ def convert_rrsis_d(
     approx_epsilon: float | None = None,
     export_masks: bool = False,
     limit: int | None = None,
+    workers: int = 1,
 ) -> dict[str, Any]:
-    # Make `tools.*` and `data.*` imports work even when the script is executed as
-    # `python tools/rrsis_d/convert_rrsis_d.py`.
-    repo_root = Path(__file__).resolve().parents[2]
-    if str(repo_root) not in sys.path:
-        sys.path.insert(0, str(repo_root))
-
-    from tools.common.label_adapter import mask_to_box_xyxy, mask_to_polygons, rle_to_mask
-
     instances_path = _find_first(
         root,
         [
@@ -108,13 +269,14 @@ def convert_rrsis_d(
     if img_root is None:
         img_root = _default_img_root(root)
 
-    out_dir.mkdir(parents=True, exist_ok=True)
-    writers = {
-        "train": (out_dir / "rrsis_d_train.jsonl").open("w", encoding="utf-8"),
-        "val": (out_dir / "rrsis_d_val.jsonl").open("w", encoding="utf-8"),
-        "test": (out_dir / "rrsis_d_test.jsonl").open("w", encoding="utf-8"),
-    }
-    bad_f = (out_dir / "bad_samples.jsonl").open("w", encoding="utf-8")
+    writers = SplitWriters(
+        out_dir,
+        {
+            "train": "rrsis_d_train.jsonl",
+            "val": "rrsis_d_val.jsonl",
+            "test": "rrsis_d_test.jsonl",
+        },
+    )
     mask_dir = out_dir / "masks"
     if export_masks:
         mask_dir.mkdir(parents=True, exist_ok=True)
@@ -144,200 +306,43 @@ def convert_rrsis_d(
     if limit is not None:
         refs = refs[:limit]
 
-    for ref in tqdm(refs, desc="RRSIS-D refs"):
-        ref_id = int(ref["ref_id"])
-        ann_id = int(ref["ann_id"])
-        image_id = int(ref["image_id"])
-        split = ref.get("split")
-        if split not in {"train", "val", "test"}:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "bad_split",
-                        "split": split,
-                        "ann_id": ann_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        ann = ann_by_id.get(ann_id)
-        im = img_by_id.get(image_id)
-        if ann is None or im is None:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "missing_ann_or_image",
-                        "ann_id": ann_id,
-                        "image_id": image_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        file_name = ref.get("file_name") or im.get("file_name")
-        if not file_name:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "missing_file_name",
-                        "image_id": image_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        sent_list = ref.get("sentences") or []
-        expr = (sent_list[0].get("sent") if sent_list else "") if isinstance(sent_list, list) else ""
-        expr = (expr or "").strip()
-        if not expr:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "empty_expression",
-                        "ann_id": ann_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        seg_list = ann.get("segmentation")
-        if not isinstance(seg_list, list) or not seg_list:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "missing_segmentation",
-                        "ann_id": ann_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        rle = seg_list[0]
-        try:
-            mask = rle_to_mask(rle)
-        except Exception as e:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "rle_decode_failed",
-                        "ann_id": ann_id,
-                        "error": str(e),
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        if mask.sum() == 0:
-            stats["empty_mask"] += 1
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "empty_mask",
-                        "ann_id": ann_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        poly_res = mask_to_polygons(mask, cc_policy=cc_policy, nmax=nmax, approx_epsilon=approx_epsilon)
-        if not poly_res.polygons:
-            bad_f.write(
-                json.dumps(
-                    {
-                        "sample_id": str(ref_id),
-                        "reason": "mask_to_polygon_failed",
-                        "ann_id": ann_id,
-                    },
-                    ensure_ascii=False,
-                )
-                + "\n"
-            )
-            stats["bad"] += 1
-            continue
-
-        tight_box = mask_to_box_xyxy(mask)
-        raw_box = [int(x) for x in ann.get("bbox") or [0, 0, 0, 0]]
-        cat_id = int(ann.get("categories_id") or ref.get("category_id") or -1)
-        cat_name = cat_by_id.get(cat_id)
-
-        mask_path: str | None
-        if export_masks:
-            import cv2
-
-            mask_path = str(mask_dir / f"{ref_id}.png")
-            cv2.imwrite(mask_path, (mask * 255).astype("uint8"))
-        else:
-            mask_path = None
-
-        sample = {
-            "sample_id": str(ref_id),
-            "split": split,
-            "image_path": str(img_root / file_name),
-            "mask_path": mask_path,
-            "image_id": Path(file_name).stem,
-            "image_id_int": image_id,
-            "ref_id": ref_id,
-            "ann_id": ann_id,
-            "expr": expr,
-            "img_w": int(im.get("width") or mask.shape[1]),
-            "img_h": int(im.get("height") or mask.shape[0]),
-            "raw_box_xyxy": raw_box,
-            "tight_box_xyxy": tight_box,
-            "polygons": poly_res.polygons,
-            "poly_meta": {
-                "cc_policy": cc_policy,
-                "nmax": int(nmax),
-                "n_vertices": poly_res.n_vertices,
-                "has_hole": False,
-                "fidelity_iou": float(poly_res.fidelity_iou),
-                "source": "rrsis-d_coco_rle",
-            },
-            "category": cat_name,
-            "category_id": cat_id,
-            "notes": None,
-        }
+    # every work item carries its own annotation, so workers need no copy of the full index
+    items = [(ref, ann_by_id.get(int(ref["ann_id"])), img_by_id.get(int(ref["image_id"]))) for ref in refs]
+    options = {
+        "img_root": img_root,
+        "nmax": nmax,
+        "cc_policy": cc_policy,
+        "approx_epsilon": approx_epsilon,
+        "export_masks": export_masks,
+        "mask_dir": mask_dir,
+        "cat_by_id": cat_by_id,
+    }
 
-        writers[split].write(json.dumps(sample, ensure_ascii=False) + "\n")
+    def on_sample(sample: ConvertedSample) -> None:
+        if sample.split is None:
+            stats["bad"] += 1
+            if sample.stats.get("empty_mask"):
+                stats["empty_mask"] += 1
+            return
         stats["total"] += 1
-        stats[split] += 1
-        if cat_name is not None:
-            stats["categories"][cat_name] += 1
-        stats["expr_len"].append(len(expr.split()))
-        stats["bbox_area"].append(max(0, tight_box[2] - tight_box[0]) * max(0, tight_box[3] - tight_box[1]))
-        stats["fidelity"].append(float(poly_res.fidelity_iou))
-
-    for f in writers.values():
-        f.close()
-    bad_f.close()
+        stats[sample.split] += 1
+        if sample.stats["category"] is not None:
+            stats["categories"][sample.stats["category"]] += 1
+        stats["expr_len"].append(sample.stats["expr_len"])
+        stats["bbox_area"].append(sample.stats["bbox_area"])
+        stats["fidelity"].append(sample.stats["fidelity"])
+
+    with writers:
+        run_conversion(
+            items,
+            _convert_ref,
+            writers,
+            workers=workers,
+            initializer=_init_worker,
+            initargs=(options,),
+            on_sample=on_sample,
+            desc="RRSIS-D refs",
+        )
 
     import numpy as np
 
@@ -407,6 +412,7 @@ def main() -> None:
     )
     ap.add_argument("--export-masks", action="store_true", help="Write PNG masks under <out-dir>/masks")
     ap.add_argument("--limit", default=None, type=int, help="Convert only first N samples (debug)")
+    ap.add_argument("--workers", default=default_workers(), type=int, help="Number of worker processes")
     args = ap.parse_args()
 
     meta = convert_rrsis_d(
@@ -418,6 +424,7 @@ def main() -> None:
         approx_epsilon=args.approx_epsilon,
         export_masks=args.export_masks,
         limit=args.limit,
+        workers=args.workers,
     )
     print("\n=== RRSIS-D conversion complete ===")
     print(json.dumps(meta, indent=2, ensure_ascii=False))
@@ -0,0 +1,2 @@
+# 二进制样本库工具
+# convert_to_sample_store.py - TSV / JSONL 转换为样本库
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""convert_to_sample_store.py
+
+Convert a refcoco-style TSV (base64 image / mask columns) or an RS
+reproduction JSONL file into a binary sample store (see data/sample_store.py).
+
+Images and masks are stored once as raw file bytes no matter how many
+expressions refer to them, and boxes / polygons are stored as float arrays,
+so reading a sample needs neither base64 decoding nor string parsing.
+The resulting directory can be passed anywhere a data file is accepted by
+the refcoco task.
+
+Typical usage:
+
+  python tools/sample_store/convert_to_sample_store.py \
+    --input datasets/finetune/refcoco/refcoco_val.tsv \
+    --out datasets/finetune/refcoco/refcoco_val.store \
+    --selected-cols 0,5,6,2,4,3
+
+  python tools/sample_store/convert_to_sample_store.py \
+    --input datasets/rrsis_d/processed/rrsis_d_train.jsonl \
+    --out datasets/rrsis_d/processed/rrsis_d_train.store
+
+--selected-cols has the same meaning as for training / evaluation: the
+columns holding uniq_id, image, mask, text, polygons, box and (for the
+7-column training format) interpolated polygons.
+"""
+
+from __future__ import annotations
+
+import argparse
+import base64
+import json
+import os
+import sys
+from pathlib import Path
+from typing import Any, Iterable
+
+try:
+    from tqdm import tqdm  # type: ignore
+except Exception:  # pragma: no cover
+
+    def tqdm(it: Iterable, **_: Any):
+        return it
+
+
+REPO_ROOT = Path(__file__).resolve().parents[2]
+if str(REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(REPO_ROOT))
+
+from data.poly_utils import string_to_polygons  # noqa: E402
+from data.sample_store import SampleStoreWriter  # noqa: E402
+
+
+def convert_tsv(src: Path, writer: SampleStoreWriter, selected_cols: list[int]) -> None:
+    with src.open("r") as f:
+        for line in tqdm(f, desc=src.name):
+            columns = line.rstrip("\n").split("\t")
+            columns = [columns[col_id] for col_id in selected_cols]
+            if len(selected_cols) == 7:
+                uniq_id, base64_str, seg64_str, text, poly, region_coord, poly_interpolated = columns
+                polygons_interpolated = string_to_polygons(poly_interpolated)
+            else:
+                uniq_id, base64_str, seg64_str, text, poly, region_coord = columns
+                polygons_interpolated = None
+            writer.add(
+                uniq_id,
+                text,
+                base64.urlsafe_b64decode(base64_str),
+                base64.urlsafe_b64decode(seg64_str),
+                [float(x) for x in region_coord.strip().split(",")],
+                string_to_polygons(poly),
+                polygons_interpolated,
+            )
+
+
+def convert_jsonl(src: Path, writer: SampleStoreWriter) -> None:
+    with src.open("r", encoding="utf-8") as f:
+        for line in tqdm(f, desc=src.name):
+            if not line.strip():
+                continue
+            sample = json.loads(line)
+            uniq_id = sample.get("sample_id")
+            region = sample.get("tight_box_xyxy") or sample.get("raw_box_xyxy")
+            if not region or len(region) != 4:
+                raise ValueError(f"Missing bbox for sample_id={uniq_id}: {region}")
+            image_path = sample.get("image_path")
+            if not image_path or not os.path.exists(image_path):
+                raise FileNotFoundError(f"Missing image_path for sample_id={uniq_id}: {image_path}")
+            with open(image_path, "rb") as img_f:
+                image = img_f.read()
+            mask = None
+            mask_path = sample.get("mask_path")
+            if mask_path and os.path.exists(mask_path):
+                with open(mask_path, "rb") as mask_f:
+                    mask = mask_f.read()
+            polygons = [
+                [float(c) for pt in poly_xy for c in (pt[0], pt[1])]
+                for poly_xy in (sample.get("polygons") or [])
+            ]
+            writer.add(uniq_id, (sample.get("expr") or "").strip(), image, mask, region, polygons)
+
+
+def _dir_size(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.iterdir() if p.is_file())
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description="Convert a TSV / JSONL dataset to a binary sample store")
+    ap.add_argument("--input", required=True, type=Path, help="Input .tsv or .jsonl file")
+    ap.add_argument("--out", required=True, type=Path, help="Output store directory")
+    ap.add_argument(
+        "--selected-cols",
+        default="0,5,6,2,4,3,7",
+        help="TSV columns of uniq_id, image, mask, text, polygons, box[, interpolated polygons]",
+    )
+    ap.add_argument("--max-shard-gb", default=2.0, type=float, help="Size at which a new blob shard is started")
+    args = ap.parse_args()
+
+    is_jsonl = args.input.suffix == ".jsonl"
+    selected_cols = [int(col_id) for col_id in args.selected_cols.split(",")]
+    if not is_jsonl and len(selected_cols) not in (6, 7):
+        ap.error("--selected-cols must name 6 or 7 columns")
+
+    writer = SampleStoreWriter(
+        str(args.out),
+        train_format=None if is_jsonl else len(selected_cols) == 7,
+        max_shard_bytes=int(args.max_shard_gb * 2 ** 30),
+    )
+    if is_jsonl:
+        convert_jsonl(args.input, writer)
+    else:
+        convert_tsv(args.input, writer, selected_cols)
+    meta = writer.close()
+
+    meta["input_bytes"] = args.input.stat().st_size
+    meta["store_bytes"] = _dir_size(args.out)
+    print("\n=== sample store written to {} ===".format(args.out))
+    print(json.dumps(meta, indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
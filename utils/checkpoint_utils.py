@@ -28,6 +28,8 @@ from fairseq.models import FairseqDecoder, FairseqEncoder
 from omegaconf import DictConfig, open_dict, OmegaConf
 
 from data import data_utils
+from models.fast_init import checkpoint_restore_init, materialize_parameters_, meta_parameter_names
+from utils.inference_checkpoint import is_inference_checkpoint, load_inference_checkpoint
 
 logger = logging.getLogger(__name__)
 
@@ -326,8 +328,11 @@ def load_checkpoint_to_cpu(path, arg_overrides=None, load_on_all_ranks=False):
             torch.distributed.barrier()
         local_path = PathManager.get_local_path(path)
 
-    with open(local_path, "rb") as f:
-        state = torch.load(f, map_location=torch.device("cpu"))
+    if is_inference_checkpoint(local_path):
+        state = load_inference_checkpoint(local_path)
+    else:
+        with open(local_path, "rb") as f:
+            state = torch.load(f, map_location=torch.device("cpu"))
 
     if "args" in state and state["args"] is not None and arg_overrides is not None:
         args = state["args"]
@@ -363,6 +368,7 @@ def load_model_ensemble(
     suffix="",
     num_shards=1,
     state=None,
+    fast_init=True,
 ):
     """Loads an ensemble of models.
 
@@ -371,6 +377,8 @@ def load_model_ensemble(
         arg_overrides (Dict[str,Any], optional): override model args that
             were used during model training
         task (fairseq.tasks.FairseqTask, optional): task to use for loading
+        fast_init (bool, optional): build the models without pretrained
+            weights and random initialization, see :func:`build_model_for_restore`
     """
     assert not (
         strict and num_shards > 1
@@ -383,6 +391,7 @@ def load_model_ensemble(
         suffix,
         num_shards,
         state,
+        fast_init,
     )
     return ensemble, args
 
@@ -402,6 +411,42 @@ def get_maybe_sharded_checkpoint_filename(
         return filename
 
 
+def build_model_for_restore(task, model_cfg, state_dict, strict=True, fast_init=True):
+    """Build the model of *model_cfg* and load *state_dict* into it.
+
+    With *fast_init*, the model is built inside
+    :func:`models.fast_init.checkpoint_restore_init`: no pretrained BERT /
+    Swin weights are loaded and the parameters are only allocated, not
+    initialized, before the checkpoint is copied in; parameters whose
+    checkpoint tensor already has the right shape and dtype use that tensor
+    directly, so the weights of a memory-mapped inference checkpoint stay
+    shared with the page cache. A checkpoint that lacks
+    some of the parameters (older architectures) would leave them
+    uninitialized, so it is loaded into a regularly built model instead.
+    """
+    if fast_init:
+        with checkpoint_restore_init():
+            model = task.build_model(model_cfg)
+        # the upgrade fills in what the checkpoint lacks from the model itself, i.e. with meta tensors here
+        probe = dict(state_dict)
+        model.upgrade_state_dict(probe)
+        missing = [
+            name for name in meta_parameter_names(model)
+            if name not in probe or probe[name].device.type == "meta"
+        ]
+        if len(missing) == 0:
+            materialize_parameters_(model, tensors=probe)
+            model.load_state_dict(state_dict, strict=strict, model_cfg=model_cfg)
+            return model
+        logger.info(
+            "checkpoint lacks {} parameters (e.g. {}), building the model with regular initialization".format(
+                len(missing), missing[0])
+        )
+    model = task.build_model(model_cfg)
+    model.load_state_dict(state_dict, strict=strict, model_cfg=model_cfg)
+    return model
+
+
 def load_model_ensemble_and_task(
     filenames,
     arg_overrides: Optional[Dict[str, Any]] = None,
@@ -410,6 +455,7 @@ def load_model_ensemble_and_task(
     suffix="",
     num_shards=1,
     state=None,
+    fast_init=True,
 ):
     assert state is None or len(filenames) == 1
 
@@ -463,15 +509,13 @@ def load_model_ensemble_and_task(
                         shard_weights=model_shard_state["shard_weights"],
                         shard_metadata=model_shard_state["shard_metadata"],
                     )
-                    model = task.build_model(cfg.model)
-                    model.load_state_dict(
-                        consolidated_model_state, strict=strict, model_cfg=cfg.model
+                    model = build_model_for_restore(
+                        task, cfg.model, consolidated_model_state, strict=strict, fast_init=fast_init
                     )
             else:
                 # model parallel checkpoint or unsharded checkpoint
-                model = task.build_model(cfg.model)
-                model.load_state_dict(
-                    state["model"], strict=False, model_cfg=cfg.model
+                model = build_model_for_restore(
+                    task, cfg.model, state["model"], strict=False, fast_init=fast_init
                 )
 
             # reset state so it gets loaded for the next model in ensemble
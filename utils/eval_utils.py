@@ -9,15 +9,17 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import json
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 import os
 import torch
 import torch.distributed as dist
 import numpy as np
-from skimage import draw
-from PIL import Image
-from utils.vis_utils import overlay_predictions
-from torchvision.utils import save_image
+from fairseq import utils as fairseq_utils
+from utils.mask_scoring import encode_mask, mask_overlaps, rasterize_polygons
+from utils.prediction_store import PredictionStore
+from utils.vis_writer import VisWriter
 
 SMOOTH = 1e-6
 
@@ -29,12 +31,13 @@ def check_length(polygons):
     return length
 
 
-def eval_refcoco(task, generator, models, sample, **kwargs):
-    def _computeIoU(pred_seg, gd_seg):
-        I = np.sum(np.logical_and(pred_seg, gd_seg))
-        U = np.sum(np.logical_or(pred_seg, gd_seg))
-        return I, U
+def decode_refcoco(task, generator, models, sample, **kwargs):
+    rs_eval_mode = kwargs.get('rs_eval_mode', 'ris')
+    # box IoU only needs the two bounding box corners the model emits first
+    return task.inference_step(models, sample, decode_target='box' if rs_eval_mode == 'vg' else None)
+
 
+def score_refcoco(task, gen_out, sample, **kwargs):
     def _calculate_ap_score(hyps, refs, thresh=0.5):
         interacts = torch.cat(
             [torch.where(hyps[:, :2] < refs[:, :2], refs[:, :2], hyps[:, :2]),
@@ -49,39 +52,32 @@ def eval_refcoco(task, generator, models, sample, **kwargs):
         ious = area_interacts / (area_predictions + area_targets - area_interacts + 1e-6)
         return ((ious >= thresh) & (interacts_w > 0) & (interacts_h > 0)).float()
 
-    def convert_pts(coeffs):
-        pts = []
-        for i in range(len(coeffs) // 2):
-            pts.append([coeffs[2 * i + 1], coeffs[2 * i]])  # y, x
-        return np.array(pts, np.int32)
-
-    def get_mask_from_codes(codes, img_size):
-        masks = [np.zeros(img_size)]
-        for code in codes:
-            if len(code) > 0:
-                try:
-                    mask = draw.polygon2mask(img_size, convert_pts(code))
-                    mask = np.array(mask, np.uint8)
-                except:
-                    mask = np.zeros(img_size)
-                masks.append(mask)
-        mask = sum(masks)
-        mask = mask > 0
-        return mask.astype(np.uint8)
-
-    def _calculate_score(hyps, hyps_det, refs, sample, n_poly_pred, n_poly_gt, rs_eval_mode='ris', vis=True, vis_dir=None):
-        if vis:
-            os.makedirs(vis_dir, exist_ok=True)
-
-        def compute_jf(pred_mask, gt_mask):
-            I, U = _computeIoU(pred_mask, gt_mask)
+    def pre_caption(caption):
+        import re
+        caption = caption.lower().lstrip(",.!?*#:;~").replace('-', ' ').replace('/', ' ').replace(
+            '<person>',
+            'person')
+        caption = re.sub(
+            r"\s{2,}",
+            ' ',
+            caption,
+        )
+        caption = caption.rstrip('\n')
+        return caption
+
+    def _calculate_score(hyps, hyps_det, refs, sample, n_poly_pred, n_poly_gt, rs_eval_mode='ris', vis=True, vis_dir=None,
+                         vis_writer=None):
+        if vis and vis_writer is None:
+            vis_writer = VisWriter(vis_dir, num_workers=0)
+
+        def compute_jf(I, U, pred_area, gt_area):
             if U == 0:
                 this_iou = 0.0
             else:
                 this_iou = I * 1.0 / U
 
-            prec = (I + SMOOTH) / (pred_mask.sum() + SMOOTH)
-            rec = (I + SMOOTH) / (gt_mask.sum() + SMOOTH)
+            prec = (I + SMOOTH) / (pred_area + SMOOTH)
+            rec = (I + SMOOTH) / (gt_area + SMOOTH)
             this_f = 2 * prec * rec / (prec + rec)
             return this_iou, this_f, I, U
 
@@ -94,6 +90,15 @@ def eval_refcoco(task, generator, models, sample, **kwargs):
         bboxes = torch.tensor(np.stack(bboxes, 0))
         bboxes = bboxes.to(sample['w_resize_ratios'].device)
         ap_scores = _calculate_ap_score(bboxes.float(), sample['region_coords'].float())
+        if rs_eval_mode != 'vg':
+            # rasterize and score the whole batch at once on the eval device; the counts are
+            # exact integers, so the per-sample scores below are the same as with numpy masks
+            gt_masks = torch.from_numpy(np.asarray(refs)).to(bboxes.device)
+            pred_masks = rasterize_polygons(hyps, gt_masks.shape[1:3], device=bboxes.device)
+            overlaps = torch.stack(mask_overlaps(pred_masks, gt_masks), dim=1).cpu().numpy()
+            pred_rles = [encode_mask(mask) for mask in pred_masks.cpu().numpy()]
+        else:
+            pred_rles = [None] * b
         for i in range(b):
             if rs_eval_mode == 'vg':
                 pred_box = bboxes[i].float()
@@ -117,28 +122,13 @@ def eval_refcoco(task, generator, models, sample, **kwargs):
                 cum_U.append(float(union.item()))
                 continue
             hyps_i = hyps[i]
-            gt_mask = refs[i]
-            pred_mask = get_mask_from_codes(hyps_i, gt_mask.shape[0:2])
-            this_iou, this_f, this_I, this_U = compute_jf(pred_mask, gt_mask)
+            this_iou, this_f, this_I, this_U = compute_jf(*overlaps[i])
             IoU.append(this_iou)
             F_score.append(this_f)
             cum_I.append(this_I)
             cum_U.append(this_U)
 
-            if vis:
-                def pre_caption(caption):
-                    import re
-                    caption = caption.lower().lstrip(",.!?*#:;~").replace('-', ' ').replace('/', ' ').replace(
-                        '<person>',
-                        'person')
-                    caption = re.sub(
-                        r"\s{2,}",
-                        ' ',
-                        caption,
-                    )
-                    caption = caption.rstrip('\n')
-                    return caption
-
+            if vis and vis_writer.wanted(sample["id"][i], this_iou):
                 gt_box = sample['region_coords'][i].cpu().numpy()
                 pred_box = bboxes[i].cpu().numpy()
                 pred_box[::2] *= sample['w_resize_ratios'][i].cpu().numpy()
@@ -153,23 +143,12 @@ def eval_refcoco(task, generator, models, sample, **kwargs):
                 img_ndarray = img.permute(1, 2, 0).cpu().numpy() * 255
                 img_ndarray = img_ndarray.astype(np.uint8)
 
-                gt_overlayed_fn = f"{uniq_id}_{text}_gt_overlayed.png"
-                pred_overlayed_fn = f"{uniq_id}_{text}_pred_overlayed.png"
-
-                pred_overlayed = overlay_predictions(img_ndarray, pred_mask, hyps_i, pred_box)
-                gt_overlayed = overlay_predictions(img_ndarray, gt_mask, None, gt_box)
+                vis_writer.submit(f"{uniq_id}_{text}", img_ndarray, pred_masks[i].cpu().numpy(), hyps_i, pred_box,
+                                  refs[i], gt_box)
 
-                pred_overlayed = Image.fromarray(pred_overlayed.astype(np.uint8))
-                pred_overlayed.save(os.path.join(vis_dir, pred_overlayed_fn))
-                gt_overlayed = Image.fromarray(gt_overlayed.astype(np.uint8))
-                gt_overlayed.save(os.path.join(vis_dir, gt_overlayed_fn))
+        return torch.tensor(IoU), torch.tensor(F_score), ap_scores, torch.tensor(cum_I), torch.tensor(cum_U), pred_rles
 
-                img_fn = f"{uniq_id}_{text}.png"
-                save_image(img, os.path.join(vis_dir, img_fn))
-
-        return torch.tensor(IoU), torch.tensor(F_score), ap_scores, torch.tensor(cum_I), torch.tensor(cum_U)
-
-    gen_out = task.inference_step(models, sample)
+    rs_eval_mode = kwargs.get('rs_eval_mode', 'ris')
     hyps = []
     hyps_det = []
     n_poly_pred = []
@@ -206,24 +185,34 @@ def eval_refcoco(task, generator, models, sample, **kwargs):
         hyps.append(polygons)
         hyps_det.append(gen_out_i_det)
     gt = sample['label']
-    results = [
-        {"uniq_id": sample_id}
-        for i, sample_id in enumerate(sample["id"].tolist())
-    ]
-
-    iou_scores, f_scores, ap_scores, cum_I, cum_U = _calculate_score(hyps, hyps_det, gt, sample, n_poly_pred,
-                                                                     sample['n_poly'],
-                                                                     rs_eval_mode=kwargs.get('rs_eval_mode', 'ris'),
-                                                                     vis=kwargs['vis'], vis_dir=kwargs['vis_dir'])
-    result_dir = kwargs['result_dir']
-    os.makedirs(result_dir, exist_ok=True)
-    torch.save({"iou_scores": iou_scores, "ap_scores": ap_scores, "n_poly_pred": n_poly_pred,
-                "n_poly_gt": sample['n_poly'], "poly_len": poly_len, "uniq_id": sample["id"]},
-               os.path.join(result_dir, f'{sample["id"][0]}.pt'))
+
+    iou_scores, f_scores, ap_scores, cum_I, cum_U, pred_rles = _calculate_score(
+        hyps, hyps_det, gt, sample, n_poly_pred, sample['n_poly'], rs_eval_mode=rs_eval_mode, vis=kwargs['vis'],
+        vis_dir=kwargs['vis_dir'], vis_writer=kwargs.get('vis_writer'))
+    # the columns of the batch in the prediction store (see utils/prediction_store.py)
+    results = {
+        "uniq_id": sample["id"].tolist(),
+        "box": np.stack(hyps_det, 0),
+        "polygons": hyps,
+        "mask": pred_rles,
+        "iou": iou_scores.numpy(),
+        "f_score": f_scores.numpy(),
+        "ap": ap_scores.cpu().numpy(),
+        "I": cum_I.numpy(),
+        "U": cum_U.numpy(),
+        "n_poly_pred": n_poly_pred,
+        "n_poly_gt": sample['n_poly'],
+        "poly_len": poly_len,
+    }
 
     return results, iou_scores, f_scores, ap_scores, cum_I, cum_U
 
 
+def eval_refcoco(task, generator, models, sample, **kwargs):
+    gen_out = decode_refcoco(task, generator, models, sample, **kwargs)
+    return score_refcoco(task, gen_out, sample, **kwargs)
+
+
 def eval_step(task, generator, models, sample, **kwargs):
     if task.cfg._name == 'refcoco':
         return eval_refcoco(task, generator, models, sample, **kwargs)
@@ -231,8 +220,63 @@ def eval_step(task, generator, models, sample, **kwargs):
         raise NotImplementedError
 
 
+def decode_step(task, generator, models, sample, **kwargs):
+    """The device half of :func:`eval_step`: the model outputs of a batch, to be passed to :func:`score_step`."""
+    if task.cfg._name == 'refcoco':
+        return decode_refcoco(task, generator, models, sample, **kwargs)
+    else:
+        raise NotImplementedError
+
+
+def score_step(task, gen_out, sample, **kwargs):
+    """The host half of :func:`eval_step`: scores (and artifacts) of a decoded batch."""
+    if task.cfg._name == 'refcoco':
+        return score_refcoco(task, gen_out, sample, **kwargs)
+    else:
+        raise NotImplementedError
+
+
+def sample_to_cpu(sample, vis=False):
+    """Host copy of the fields of a batch used by :func:`score_step`; the images are only kept for visualization."""
+    sample = dict(sample)
+    net_input = sample.pop("net_input")
+    if vis:
+        sample["net_input"] = {"patch_images": net_input["patch_images"]}
+    # dtypes are kept, so scores are computed from the same values as on the device
+    return fairseq_utils.apply_to_sample(lambda t: t.cpu(), sample)
+
+
+class ScoringPipeline(object):
+    def __init__(self, num_workers, max_pending=None):
+        """Score decoded batches on a pool of threads while the next batches decode.
+
+        Results are returned in submission order, so anything accumulated from
+        them (metric sums, the prediction list) is the same as when scoring
+        inline. At most *max_pending* batches (default: twice the number of
+        workers) are in flight; :meth:`submit` blocks beyond that.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="score")
+        self.max_pending = max_pending if max_pending is not None else 2 * num_workers
+        self.pending = deque()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)``; return the results of the oldest batches that are done."""
+        self.pending.append(self.executor.submit(fn, *args, **kwargs))
+        done = []
+        while len(self.pending) > 0 and (len(self.pending) > self.max_pending or self.pending[0].done()):
+            done.append(self.pending.popleft().result())
+        return done
+
+    def drain(self):
+        """Wait for every queued batch and return the remaining results."""
+        done = [future.result() for future in self.pending]
+        self.pending.clear()
+        self.executor.shutdown()
+        return done
+
+
 def merge_results(task, cfg, logger, score_cnt, score_sum, f_score_sum=None, ap_det_score_sum=None, prec_score_sum=None,
-                  cum_I_sum=None, cum_U_sum=None, results=None):
+                  cum_I_sum=None, cum_U_sum=None, results=None, prediction_dir=None):
     if task.cfg._name == 'image_gen':
         if cfg.distributed_training.distributed_world_size > 1:
             dist.all_reduce(score_sum.data)
@@ -244,8 +288,12 @@ def merge_results(task, cfg, logger, score_cnt, score_sum, f_score_sum=None, ap_
     else:
         gather_results = None
         if cfg.distributed_training.distributed_world_size > 1:
-            gather_results = [None for _ in range(dist.get_world_size())]
-            dist.all_gather_object(gather_results, results)
+            if prediction_dir is None:
+                gather_results = [None for _ in range(dist.get_world_size())]
+                dist.all_gather_object(gather_results, results)
+            else:
+                # every rank has closed its shard of the prediction store
+                dist.barrier()
             dist.all_reduce(score_sum.data)
             dist.all_reduce(f_score_sum.data)
             dist.all_reduce(cum_I_sum.data)
@@ -278,6 +326,11 @@ def merge_results(task, cfg, logger, score_cnt, score_sum, f_score_sum=None, ap_
         if cfg.distributed_training.distributed_world_size == 1 or dist.get_rank() == 0:
             os.makedirs(cfg.common_eval.results_path, exist_ok=True)
             output_path = os.path.join(cfg.common_eval.results_path, "{}_predict.json".format(cfg.dataset.gen_subset))
-            gather_results = list(chain(*gather_results)) if gather_results is not None else results
-            with open(output_path, 'w') as fw:
-                json.dump(gather_results, fw)
+            if prediction_dir is not None:
+                # streamed from the shards of all ranks, nothing is gathered in memory
+                store = PredictionStore(prediction_dir, num_shards=cfg.distributed_training.distributed_world_size)
+                store.write_json(output_path)
+            else:
+                gather_results = list(chain(*gather_results)) if gather_results is not None else results
+                with open(output_path, 'w') as fw:
+                    json.dump(gather_results, fw)
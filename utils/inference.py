@@ -0,0 +1,234 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Batched referring segmentation of (image, expression) requests.
+
+:class:`RefcocoPredictor` splits serving a request into the same steps the
+evaluation follows, so that they can run on different threads:
+
+* :meth:`RefcocoPredictor.prepare` - image decoding, resizing and
+  tokenization of one request (CPU, any thread)
+* :meth:`RefcocoPredictor.predict` - collating prepared requests into a batch
+  and decoding it with ``RefcocoTask.inference_step`` (the thread owning the
+  model)
+* :meth:`RefcocoPredictor.postprocess` - box, polygons and mask of one
+  request in original image coordinates (CPU, any thread)
+
+Several expressions about one image (:meth:`RefcocoPredictor.prepare_many`,
+:meth:`RefcocoPredictor.predict_many`) share the preprocessed image; a batch
+passes every distinct image once with a ``patch_image_index`` per sample, so
+the visual backbone and the image projection run once per image, and all
+expressions are decoded in the same batch.
+"""
+
+import logging
+import re
+from io import BytesIO
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+import utils.transforms as T
+from bert.tokenization_bert import BertTokenizer
+from utils.prompt_tokenizer import PROMPT_TEMPLATE, PromptTokenizer
+from utils.mask_scoring import encode_mask, rasterize_polygons
+
+logger = logging.getLogger(__name__)
+
+IMAGENET_DEFAULT_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_DEFAULT_STD = (0.229, 0.224, 0.225)
+
+
+def pre_caption(caption, max_words):
+    """The caption normalization of ``BaseDataset.pre_caption``."""
+    caption = caption.lower().lstrip(",.!?*#:;~").replace('-', ' ').replace('/', ' ').replace('<person>', 'person')
+    caption = re.sub(r"\s{2,}", ' ', caption)
+    caption = caption.rstrip('\n')
+    caption = caption.strip(' ')
+    caption_words = caption.split(' ')
+    if len(caption_words) > max_words:
+        caption = ' '.join(caption_words[:max_words])
+    return caption
+
+
+def split_gen_out(gen_out_i):
+    """Normalized box (4,) and list of normalized flat x, y polygons of one ``inference_step`` output."""
+    gen_out_i = np.array(gen_out_i, dtype=np.float64)
+    gen_out_i = gen_out_i[gen_out_i != -1]  # excluding eos and padding indices
+    box = gen_out_i[:4]
+    polygons = []
+    start = 4
+    for end in list(np.nonzero(gen_out_i[4:] == 2)[0] + 4) + [len(gen_out_i)]:  # 2 indicates separator token
+        if end > start:
+            polygons.append(gen_out_i[start:end])
+        start = end + 1
+    return box, polygons
+
+
+class RefcocoPredictor(object):
+    def __init__(self, task, model, cfg, device=None, use_fp16=False, min_len=6, max_len=210):
+        """Run a loaded refcoco model on batches of (image, expression) requests.
+
+        Args:
+            task (RefcocoTask): task of the model; decoding goes through
+                ``task.inference_step``, so the task options (e.g.
+                ``--decode-target``, ``--image-embed-cache-mb``) apply
+            model: the model, already on *device* and in eval mode
+            cfg: the config the model was loaded with
+            device (torch.device, optional): device of the model
+            use_fp16 (bool, optional): the model runs in half precision
+            min_len (int, optional): see ``RefcocoTask.inference_step``
+            max_len (int, optional): see ``RefcocoTask.inference_step``
+        """
+        self.task = task
+        self.model = model
+        self.cfg = cfg
+        self.device = device if device is not None else torch.device("cpu")
+        self.dtype = torch.half if use_fp16 else torch.float
+        self.min_len = min_len
+        self.max_len = max_len
+        self.patch_image_size = task.cfg.patch_image_size
+        self.max_src_length = task.cfg.max_src_length
+        self.max_text_len = task.cfg.max_text_len
+
+        if task.cfg.imagenet_default_mean_and_std:
+            mean, std = IMAGENET_DEFAULT_MEAN, IMAGENET_DEFAULT_STD
+        else:
+            mean, std = [0.5, 0.5, 0.5], [0.5, 0.5, 0.5]
+        # the evaluation transform of RefcocoDataset
+        self.transform = T.Compose([
+            T.RandomResize([self.patch_image_size], max_size=self.patch_image_size),
+            T.ToTensor(),
+            T.Normalize(mean=mean, std=std, max_image_size=task.cfg.max_image_size)
+        ])
+        self.tokenizer = BertTokenizer.from_pretrained('bert-base-uncased')
+        self.prompt_tokenizer = None
+        if not task.cfg.no_fast_tokenizer:
+            self.prompt_tokenizer = PromptTokenizer(self.tokenizer, max_text_len=self.max_text_len)
+
+    @classmethod
+    def from_checkpoint(cls, path, use_cuda=None, use_fp16=False, model_overrides=None, **kwargs):
+        """Load a refcoco checkpoint the way ``evaluate.py`` does, on GPU if available and not disabled."""
+        from fairseq import utils
+
+        import models  # noqa: F401  (registers the polyformer architectures)
+        import tasks  # noqa: F401  (registers the refcoco task)
+        from utils.checkpoint_utils import load_model_ensemble_and_task
+
+        if use_cuda is None:
+            use_cuda = torch.cuda.is_available()
+        use_fp16 = use_fp16 and use_cuda
+        overrides = {"bpe_dir": "utils/BPE", "feature_store": None}
+        overrides.update(model_overrides or {})
+        logger.info("loading model from {}".format(path))
+        models_, cfg, task = load_model_ensemble_and_task(utils.split_paths(path), arg_overrides=overrides)
+        model = models_[0]
+        model.eval()
+        if use_fp16:
+            model.half()
+        if use_cuda:
+            model.cuda()
+        model.prepare_for_inference_(cfg)
+        device = torch.device("cuda" if use_cuda else "cpu")
+        return cls(task, model, cfg, device=device, use_fp16=use_fp16, **kwargs)
+
+    def prepare(self, image, text):
+        """Preprocess one request.
+
+        Args:
+            image: a ``PIL.Image`` or the encoded image bytes
+            text (str): the referring expression
+
+        Returns:
+            dict: the input of :meth:`predict` and :meth:`postprocess`
+        """
+        return self.prepare_many(image, [text])[0]
+
+    def prepare_many(self, image, texts):
+        """Preprocess several expressions about one image; the items share the preprocessed image."""
+        if isinstance(image, (bytes, bytearray)):
+            image = Image.open(BytesIO(image))
+        image = image.convert("RGB")
+        w, h = image.size
+        patch_image = self.transform(image, target=None)
+        return [dict(self._prepare_text(text), patch_image=patch_image, w=w, h=h) for text in texts]
+
+    def _prepare_text(self, text):
+        caption = pre_caption(text, self.max_src_length)
+        if self.prompt_tokenizer is not None:
+            tokens = self.prompt_tokenizer.encode(caption)
+        elif self.max_text_len and self.max_text_len > 0:
+            tokens = self.tokenizer.encode(PROMPT_TEMPLATE.format(caption), truncation=True, max_length=self.max_text_len)
+        else:
+            tokens = self.tokenizer.encode(PROMPT_TEMPLATE.format(caption))
+        return {"tokens": torch.LongTensor(tokens), "text": caption}
+
+    def collate(self, items: List[Dict[str, Any]]):
+        """A ``RefcocoDataset`` style batch of prepared requests, on the device of the model."""
+        lengths = torch.LongTensor([len(item["tokens"]) for item in items])
+        src_tokens = torch.zeros(len(items), int(lengths.max()), dtype=torch.long)  # BERT [PAD] is 0
+        for i, item in enumerate(items):
+            src_tokens[i, :len(item["tokens"])] = item["tokens"]
+        att_masks = (torch.arange(src_tokens.size(1))[None, :] < lengths[:, None]).long()
+
+        # items of prepare_many share their image tensor, which is passed once
+        images = {}
+        for item in items:
+            images.setdefault(id(item["patch_image"]), (len(images), item["patch_image"]))
+        net_input = {
+            "src_tokens": src_tokens.to(self.device),
+            "src_lengths": lengths.to(self.device),
+            "att_masks": att_masks.to(self.device),
+            "patch_images": torch.stack([image for _, image in images.values()]).to(self.device, self.dtype),
+            "patch_masks": torch.ones(len(items), dtype=torch.bool, device=self.device),
+        }
+        if len(images) < len(items):
+            net_input["patch_image_index"] = torch.LongTensor(
+                [images[id(item["patch_image"])][0] for item in items]).to(self.device)
+        return {"net_input": net_input}
+
+    @torch.no_grad()
+    def predict(self, items: List[Dict[str, Any]]):
+        """Decode a batch of prepared requests; returns the ``inference_step`` output of every request."""
+        sample = self.collate(items)
+        return self.task.inference_step(self.model, sample, min_len=self.min_len, max_len=self.max_len)
+
+    def predict_many(self, image, texts, return_mask=True):
+        """Box, polygons and mask of every expression in *texts* about one image, decoded as one batch."""
+        items = self.prepare_many(image, texts)
+        return self.postprocess_many(items, self.predict(items), return_mask=return_mask)
+
+    @staticmethod
+    def postprocess(item, gen_out_i, return_mask=True) -> Dict[str, Optional[Any]]:
+        """Box (x0, y0, x1, y1), polygons (flat x, y lists) and COCO RLE mask of a request, in pixels of the input image."""
+        return RefcocoPredictor.postprocess_many([item], [gen_out_i], return_mask=return_mask)[0]
+
+    @staticmethod
+    def postprocess_many(items, gen_out, return_mask=True) -> List[Dict[str, Optional[Any]]]:
+        """:meth:`postprocess` of several requests about images of the same size."""
+        w, h = items[0]["w"], items[0]["h"]
+        assert all((item["w"], item["h"]) == (w, h) for item in items), "images of different sizes"
+        scale = np.array([w, h], dtype=np.float64)
+        results = []
+        hyps = []
+        for gen_out_i in gen_out:
+            box, polygons = split_gen_out(gen_out_i)
+            box = box * np.resize(scale, len(box))
+            polygons = [polygon * np.resize(scale, len(polygon)) for polygon in polygons]
+            hyps.append(polygons)
+            results.append({
+                "box": box.tolist(),
+                "polygons": [polygon.tolist() for polygon in polygons],
+                "mask": None,
+            })
+        if return_mask:
+            for result, polygons in zip(results, hyps):
+                # one request at a time: the scan-line buffers of rasterize_polygons grow with the number of
+                # polygons times the image size, which for full-size photos and hundreds of expressions is GBs
+                mask = rasterize_polygons([polygons], (h, w))[0].numpy()
+                rle = encode_mask(mask)
+                result["mask"] = {"size": [int(x) for x in rle["size"]], "counts": rle["counts"].decode("ascii")}
+        return results
@@ -0,0 +1,193 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Inference-only checkpoint format with memory-mapped weights.
+
+A training checkpoint is a pickle of the model weights, the optimizer state,
+EMA weights and the config, which every process unpickles into its own
+memory. An inference checkpoint holds only the config and the model weights,
+cast to a half precision type, in a flat layout:
+
+  magic            8 bytes, ``PFINFER1``
+  header length    little-endian uint64
+  header           utf-8 JSON: config, number of updates, and the dtype,
+                   shape and (offset, nbytes) in the data section of every
+                   tensor
+  data             the raw tensors, each aligned to ALIGNMENT bytes
+
+:func:`load_inference_checkpoint` maps the data section copy-on-write and
+returns tensors viewing it, so processes loading the same file share its
+page cache instead of holding private copies. ``load_checkpoint_to_cpu``
+recognizes the format, so an inference checkpoint can be passed anywhere a
+training checkpoint is loaded for evaluation or serving; see
+``tools/checkpoints/export_inference_checkpoint.py``.
+"""
+
+import json
+import struct
+from argparse import Namespace
+from enum import Enum
+
+import numpy as np
+import torch
+from omegaconf import DictConfig, OmegaConf
+
+MAGIC = b"PFINFER1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+EXPORT_DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}
+
+# numpy dtypes the tensors are mapped as; bfloat16 is mapped as int16 and viewed as bfloat16
+_NUMPY_DTYPES = {
+    torch.float16: np.float16,
+    torch.bfloat16: np.int16,
+    torch.float32: np.float32,
+    torch.float64: np.float64,
+    torch.uint8: np.uint8,
+    torch.int8: np.int8,
+    torch.int16: np.int16,
+    torch.int32: np.int32,
+    torch.int64: np.int64,
+    torch.bool: np.bool_,
+}
+_DTYPE_NAMES = {dtype: str(dtype).replace("torch.", "") for dtype in _NUMPY_DTYPES}
+_DTYPES_BY_NAME = {name: dtype for dtype, name in _DTYPE_NAMES.items()}
+
+
+def is_inference_checkpoint(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _config_to_json(obj):
+    # model configs of PolyFormer checkpoints are argparse Namespaces
+    if isinstance(obj, DictConfig):
+        return _config_to_json(OmegaConf.to_container(obj, resolve=True))
+    if isinstance(obj, Namespace):
+        return {"__namespace__": _config_to_json(vars(obj))}
+    if isinstance(obj, dict):
+        return {key: _config_to_json(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [_config_to_json(value) for value in obj]
+    if isinstance(obj, Enum):
+        return obj.value
+    return obj
+
+
+def _config_from_json(obj):
+    if "__namespace__" in obj:
+        return Namespace(**obj["__namespace__"])
+    return obj
+
+
+def save_inference_checkpoint(path, model_state, cfg, dtype=torch.float16, num_updates=0):
+    """Write *model_state* (floating point tensors cast to *dtype*) and *cfg* as an inference checkpoint."""
+    tensors = {}
+    entries = {}
+    offset = 0
+    for name, tensor in model_state.items():
+        tensor = tensor.detach().cpu()
+        if tensor.is_floating_point():
+            tensor = tensor.to(dtype)
+        tensor = tensor.contiguous()
+        if tensor.dtype not in _NUMPY_DTYPES:
+            raise ValueError("unsupported dtype {} of {}".format(tensor.dtype, name))
+        nbytes = tensor.numel() * tensor.element_size()
+        entries[name] = {
+            "dtype": _DTYPE_NAMES[tensor.dtype],
+            "shape": list(tensor.shape),
+            "offsets": [offset, nbytes],
+        }
+        tensors[name] = tensor
+        offset += -(-nbytes // ALIGNMENT) * ALIGNMENT
+    header = json.dumps({
+        "format_version": FORMAT_VERSION,
+        "dtype": _DTYPE_NAMES[dtype],
+        "num_updates": num_updates,
+        "cfg": _config_to_json(cfg),
+        "tensors": entries,
+    }).encode("utf-8")
+    data_start = -(-(len(MAGIC) + 8 + len(header)) // ALIGNMENT) * ALIGNMENT
+
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        for name, tensor in tensors.items():
+            f.seek(data_start + entries[name]["offsets"][0])
+            if tensor.dtype == torch.bfloat16:
+                tensor = tensor.view(torch.int16)
+            f.write(tensor.numpy().tobytes())
+        f.truncate(data_start + offset)
+
+
+def read_header(path):
+    """The JSON header of an inference checkpoint and the file offset of its data section."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not an inference checkpoint".format(path))
+        (header_len,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_len).decode("utf-8"), object_hook=_config_from_json)
+    if header["format_version"] > FORMAT_VERSION:
+        raise ValueError("{} has format version {}, this version reads up to {}".format(
+            path, header["format_version"], FORMAT_VERSION))
+    data_start = -(-(len(MAGIC) + 8 + header_len) // ALIGNMENT) * ALIGNMENT
+    return header, data_start
+
+
+def load_inference_checkpoint(path):
+    """Load an inference checkpoint as a fairseq checkpoint state, with the weights memory-mapped.
+
+    The tensors view a copy-on-write mapping of the file: reading them shares
+    the page cache with other processes, and writing to them (which loading
+    a model does not do) only copies the touched pages.
+    """
+    header, data_start = read_header(path)
+    data = np.memmap(path, dtype=np.uint8, mode="c", offset=data_start) if header["tensors"] else None
+    model_state = {}
+    for name, entry in header["tensors"].items():
+        dtype = _DTYPES_BY_NAME[entry["dtype"]]
+        offset, nbytes = entry["offsets"]
+        array = data[offset:offset + nbytes].view(_NUMPY_DTYPES[dtype]).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        if dtype == torch.bfloat16:
+            tensor = tensor.view(torch.bfloat16)
+        model_state[name] = tensor
+    return {
+        "cfg": header["cfg"],
+        "model": model_state,
+        "optimizer_history": [{
+            "criterion_name": None,
+            "optimizer_name": None,
+            "lr_scheduler_state": {"best": None},
+            "num_updates": header["num_updates"],
+        }],
+        "extra_state": {"train_iterator": None},
+        "last_optimizer_state": None,
+    }
+
+
+def export_inference_checkpoint(src, dst, dtype="fp16", use_ema=False):
+    """Write the weights and config of the training checkpoint *src* as the inference checkpoint *dst*.
+
+    Args:
+        src (str): training checkpoint
+        dst (str): output path
+        dtype (str, optional): type of the floating point weights, one of
+            ``fp16``, ``bf16`` and ``fp32``
+        use_ema (bool, optional): export the EMA weights of the checkpoint
+            instead of the model weights
+    """
+    from utils.checkpoint_utils import load_checkpoint_to_cpu
+
+    state = load_checkpoint_to_cpu(src)
+    model_state = state["model"]
+    if use_ema:
+        if "ema" not in state["extra_state"]:
+            raise ValueError("{} has no EMA weights".format(src))
+        model_state = state["extra_state"]["ema"]
+    num_updates = state["optimizer_history"][-1].get("num_updates", 0) if state.get("optimizer_history") else 0
+    save_inference_checkpoint(dst, model_state, state["cfg"], dtype=EXPORT_DTYPES[dtype], num_updates=num_updates)
+    return read_header(dst)[0]
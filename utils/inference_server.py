@@ -0,0 +1,381 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Dynamic-batching HTTP inference server (asyncio, standard library only).
+
+Requests are queued by the event loop and collected by
+:class:`DynamicBatcher` into batches of at most ``max_batch_size`` requests,
+waiting at most ``max_latency_ms`` after the first request of a batch for more
+to arrive. A single worker thread owns the model and decodes one batch at a
+time; while it does, new requests queue up and form the next batch. Decoding
+images, tokenizing and building the output masks run on a separate thread
+pool, so they overlap with the model.
+
+Endpoints:
+
+  POST /predict   {"image": <base64 image>, "text": <expression>, "return_mask": true}
+                  -> {"box": [x0, y0, x1, y1], "polygons": [[x, y, ...], ...],
+                      "mask": {"size": [h, w], "counts": <COCO RLE>} or null}
+  POST /predict_many  {"image": <base64 image>, "texts": [<expression>, ...], "return_mask": true}
+                  -> {"results": [<output of /predict>, ...]}, one per expression;
+                     the image is preprocessed and embedded once for all of them
+  GET  /health    {"status": "ok", ...}
+  GET  /metrics   counters, batch sizes and latencies per route (Prometheus text format)
+"""
+
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ServerMetrics(object):
+    def __init__(self, window=2048):
+        """Counters and recent latencies of the server, rendered by :meth:`render`."""
+        self.start_time = time.time()
+        self.counters = Counter()
+        self.batch_sizes = Counter()
+        self.window = window
+        self.latencies = {}  # route -> request latencies, seconds
+        self.queue_waits = deque(maxlen=window)  # time from arrival to the start of its batch, seconds
+        self.batch_times = deque(maxlen=window)  # model time of a batch, seconds
+
+    def observe_batch(self, size, seconds):
+        self.counters["batches"] += 1
+        self.counters["batched_requests"] += size
+        self.counters["model_seconds"] += seconds
+        self.batch_sizes[size] += 1
+        self.batch_times.append(seconds)
+
+    def observe_request(self, route, seconds):
+        if route not in self.latencies:
+            self.latencies[route] = deque(maxlen=self.window)
+        self.latencies[route].append(seconds)
+
+    def snapshot(self, queue_size=0):
+        def quantiles(values):
+            if len(values) == 0:
+                return {}
+            values = np.asarray(values)
+            return {q: float(np.quantile(values, q)) for q in (0.5, 0.9, 0.99)}
+
+        batches = self.counters["batches"]
+        return {
+            "uptime_seconds": time.time() - self.start_time,
+            "queue_size": queue_size,
+            "counters": dict(self.counters),
+            "mean_batch_size": self.counters["batched_requests"] / batches if batches > 0 else 0.0,
+            "batch_sizes": dict(self.batch_sizes),
+            "latency_seconds": {route: quantiles(values) for route, values in self.latencies.items()},
+            "queue_wait_seconds": quantiles(self.queue_waits),
+            "batch_seconds": quantiles(self.batch_times),
+        }
+
+    def render(self, queue_size=0):
+        """Prometheus text exposition of :meth:`snapshot`."""
+        snapshot = self.snapshot(queue_size)
+        lines = [
+            "polyformer_uptime_seconds {:.3f}".format(snapshot["uptime_seconds"]),
+            "polyformer_queue_size {}".format(queue_size),
+            "polyformer_mean_batch_size {:.4f}".format(snapshot["mean_batch_size"]),
+        ]
+        for name, value in sorted(snapshot["counters"].items()):
+            lines.append("polyformer_{}_total {}".format(name, value))
+        for size, count in sorted(snapshot["batch_sizes"].items()):
+            lines.append('polyformer_batch_size_count{{size="{}"}} {}'.format(size, count))
+        for route, values in sorted(snapshot["latency_seconds"].items()):
+            for q, value in values.items():
+                lines.append('polyformer_latency_seconds{{route="{}",quantile="{}"}} {:.6f}'.format(route, q, value))
+        for name in ("queue_wait_seconds", "batch_seconds"):
+            for q, value in snapshot[name].items():
+                lines.append('polyformer_{}{{quantile="{}"}} {:.6f}'.format(name, q, value))
+        return "\n".join(lines) + "\n"
+
+
+class DynamicBatcher(object):
+    def __init__(self, run_batch, max_batch_size=8, max_latency_ms=10.0, max_queue_size=256, metrics=None):
+        """Collect concurrent requests into batches for a single model worker thread.
+
+        Args:
+            run_batch (callable): ``run_batch(items) -> outputs``, one output
+                per item; always called on the same thread
+            max_batch_size (int, optional): largest batch
+            max_latency_ms (float, optional): longest time to wait for more
+                requests after the first request of a batch has arrived;
+                requests that queued up while the previous batch ran are
+                batched right away
+            max_queue_size (int, optional): requests beyond this many waiting
+                ones are rejected with :class:`QueueFullError`
+            metrics (ServerMetrics, optional): where to record batches
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency_ms / 1000.0
+        self.max_queue_size = max_queue_size
+        self.metrics = metrics if metrics is not None else ServerMetrics()
+        self.queue = None
+        self._task = None
+        # the thread that owns the model
+        self._worker = ThreadPoolExecutor(1, thread_name_prefix="model")
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._worker.shutdown(wait=True)
+
+    def qsize(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def submit(self, item):
+        """Queue one request and wait for its output."""
+        return (await self.submit_many([item]))[0]
+
+    async def submit_many(self, items):
+        """Queue several requests next to each other and wait for their outputs."""
+        if self.qsize() + len(items) > self.max_queue_size:
+            raise QueueFullError("{} requests are already waiting".format(self.qsize()))
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in items]
+        arrival = time.perf_counter()
+        for item, future in zip(items, futures):
+            self.queue.put_nowait((item, future, arrival))
+        return await asyncio.gather(*futures)
+
+    async def _next_batch(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # requests whose client went away are not decoded
+        return [entry for entry in batch if not entry[1].done()]
+
+    async def _loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            if len(batch) == 0:
+                continue
+            items = [item for item, _, _ in batch]
+            start = time.perf_counter()
+            for _, _, arrival in batch:
+                self.metrics.queue_waits.append(start - arrival)
+            try:
+                outputs = await loop.run_in_executor(self._worker, self.run_batch, items)
+            except Exception as e:
+                logger.exception("batch of {} requests failed".format(len(items)))
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.metrics.observe_batch(len(items), time.perf_counter() - start)
+            for (_, future, _), output in zip(batch, outputs):
+                if not future.done():
+                    future.set_result(output)
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class InferenceServer(object):
+    def __init__(self, predictor, max_batch_size=8, max_latency_ms=10.0, max_queue_size=256, num_workers=4,
+                 max_body_mb=32):
+        """HTTP front end of a :class:`~utils.inference.RefcocoPredictor`.
+
+        Args:
+            predictor (RefcocoPredictor): the model
+            max_batch_size, max_latency_ms, max_queue_size: see :class:`DynamicBatcher`
+            num_workers (int, optional): threads preprocessing requests and
+                building the output masks
+            max_body_mb (int, optional): largest accepted request body
+        """
+        self.predictor = predictor
+        self.metrics = ServerMetrics()
+        self.batcher = DynamicBatcher(predictor.predict, max_batch_size=max_batch_size,
+                                      max_latency_ms=max_latency_ms, max_queue_size=max_queue_size,
+                                      metrics=self.metrics)
+        self.pool = ThreadPoolExecutor(max(1, num_workers), thread_name_prefix="preprocess")
+        self.max_body = max_body_mb * 1024 * 1024
+        self.routes = {
+            ("GET", "/health"): self.health,
+            ("GET", "/metrics"): self.render_metrics,
+            ("POST", "/predict"): self.predict,
+            ("POST", "/predict_many"): self.predict_many,
+        }
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        self.batcher.start()
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info("serving on http://{}:{}".format(host, port))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+            self.pool.shutdown(wait=False)
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, fn, *args)
+
+    async def health(self, body):
+        return HTTPStatus.OK, {
+            "status": "ok",
+            "device": str(self.predictor.device),
+            "dtype": str(self.predictor.dtype),
+            "queue_size": self.batcher.qsize(),
+            "max_batch_size": self.batcher.max_batch_size,
+        }
+
+    async def render_metrics(self, body):
+        return HTTPStatus.OK, self.metrics.render(self.batcher.qsize())
+
+    async def predict(self, body):
+        request = self._parse(body, "text")
+        results = await self._predict_texts(request, [request["text"]])
+        return HTTPStatus.OK, results[0]
+
+    async def predict_many(self, body):
+        request = self._parse(body, "texts")
+        texts = request["texts"]
+        if not isinstance(texts, list) or len(texts) == 0 or not all(isinstance(text, str) for text in texts):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'texts' must be a non-empty list of expressions (strings)")
+        return HTTPStatus.OK, {"results": await self._predict_texts(request, request["texts"])}
+
+    @staticmethod
+    def _parse(body, text_key):
+        try:
+            request = json.loads(body)
+            request["image"] = base64.b64decode(request["image"])
+            request[text_key]
+        except (ValueError, KeyError, TypeError, binascii.Error) as e:
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            "expected JSON with a base64 'image' and '{}': {}".format(text_key, e))
+        if text_key == "text" and not isinstance(request["text"], str):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "'text' must be a string")
+        return request
+
+    async def _predict_texts(self, request, texts):
+        try:
+            items = await self._run(self.predictor.prepare_many, request["image"], texts)
+        except (OSError, ValueError) as e:  # PIL.UnidentifiedImageError is an OSError
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "can not read the image: {}".format(e))
+        if len(items) > self.batcher.max_queue_size:
+            raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                            "more than {} expressions".format(self.batcher.max_queue_size))
+        try:
+            # queued back to back, so the expressions of an image are decoded in the same batch(es)
+            gen_out = await self.batcher.submit_many(items)
+        except QueueFullError as e:
+            self.metrics.counters["rejected"] += 1
+            raise HTTPError(HTTPStatus.SERVICE_UNAVAILABLE, str(e))
+        return await self._run(self.predictor.postprocess_many, items, gen_out,
+                               bool(request.get("return_mask", True)))
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await reader.readline()
+                except (ConnectionError, asyncio.LimitOverrunError, ValueError):
+                    break
+                if not request_line:
+                    break
+                keep_alive = await self._handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_request(self, request_line, reader, writer):
+        start = time.perf_counter()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            self._respond(writer, HTTPStatus.BAD_REQUEST, {"error": "malformed request line"}, keep_alive=False)
+            return False
+        keep_alive = headers.get("connection", "").lower() != "close" and version != "HTTP/1.0"
+        path = target.split("?", 1)[0]
+
+        self.metrics.counters["requests"] += 1
+        try:
+            length = int(headers.get("content-length", 0))
+            if length > self.max_body:
+                raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "body larger than {} bytes".format(self.max_body))
+            body = await reader.readexactly(length) if length > 0 else b""
+            handler = self.routes.get((method, path))
+            if handler is None:
+                if any(route_path == path for _, route_path in self.routes):
+                    raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, "{} not allowed on {}".format(method, path))
+                raise HTTPError(HTTPStatus.NOT_FOUND, "no route {}".format(path))
+            status, payload = await handler(body)
+        except HTTPError as e:
+            status, payload = e.status, {"error": str(e)}
+            keep_alive = keep_alive and e.status != HTTPStatus.REQUEST_ENTITY_TOO_LARGE
+        except asyncio.IncompleteReadError:
+            return False
+        except Exception as e:
+            logger.exception("request {} {} failed".format(method, path))
+            status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": repr(e)}
+
+        if status != HTTPStatus.OK:
+            self.metrics.counters["failed"] += 1
+        elif path in ("/predict", "/predict_many"):
+            self.metrics.observe_request(path, time.perf_counter() - start)
+        self._respond(writer, status, payload, keep_alive)
+        return keep_alive
+
+    @staticmethod
+    def _respond(writer, status, payload, keep_alive):
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+        head = "HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: {}\r\n\r\n".format(
+            int(status), status.phrase, content_type, len(body), "keep-alive" if keep_alive else "close")
+        writer.write(head.encode("latin-1") + body)
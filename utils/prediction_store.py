@@ -0,0 +1,227 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Append-only, columnar store of evaluation predictions.
+
+Every rank streams its predictions into its own shard directory
+``shard_XXXXX`` of the store, holding
+
+  records.bin    one PREDICTION_DTYPE row per sample
+  ids.bin        utf-8 sample ids
+  polygons.bin   int64 (offset, length) rows into coords.bin
+  coords.bin     float32 flat x, y polygon coordinates
+  masks.bin      COCO RLE counts of the predicted masks
+  meta.json      written when the shard is closed
+
+Every batch is appended and flushed as it is scored, so nothing is gathered
+in memory and a shard can be read while it is still being written.
+:class:`PredictionStore` reads all shards of a store in rank order, see
+``tools/predictions/query_predictions.py``.
+"""
+
+import glob
+import json
+import os
+
+import numpy as np
+
+STORE_VERSION = 1
+META_FILE = "meta.json"
+
+PREDICTION_DTYPE = np.dtype([
+    ("id", np.int64, (2,)),  # offset, length in ids.bin
+    ("box", np.float64, (4,)),  # predicted x0, y0, x1, y1 in original image coordinates
+    ("polygons", np.int64, (2,)),  # first polygon, number of polygons
+    ("mask", np.int64, (2,)),  # offset, length in masks.bin; length 0 if no mask was predicted
+    ("mask_size", np.int64, (2,)),  # height, width
+    ("iou", np.float64),
+    ("f_score", np.float64),
+    ("ap", np.float64),
+    ("I", np.float64),
+    ("U", np.float64),
+    ("n_poly_pred", np.int64),
+    ("n_poly_gt", np.int64),
+    ("poly_len", np.int64),
+])
+
+_FILES = ("records", "ids", "polygons", "coords", "masks")
+
+
+def shard_path(store_dir, rank):
+    return os.path.join(store_dir, "shard_{:05d}".format(rank))
+
+
+class PredictionShardWriter(object):
+    def __init__(self, path):
+        """Stream predictions to the shard directory *path*, replacing any previous shard there."""
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, META_FILE)):
+            os.remove(os.path.join(path, META_FILE))
+        self._files = {name: open(os.path.join(path, name + ".bin"), "wb") for name in _FILES}
+        self._offsets = {name: 0 for name in _FILES}
+        self.num_records = 0
+
+    def _write(self, name, data):
+        offset = self._offsets[name]
+        self._files[name].write(data)
+        self._offsets[name] += len(data)
+        return offset
+
+    def append(self, batch):
+        """Append the predictions of a batch.
+
+        Args:
+            batch (dict): per-sample lists / arrays ``uniq_id``, ``box``,
+                ``polygons`` (list of flat x, y arrays per sample), ``mask``
+                (COCO RLE dict per sample, or None) and the metrics ``iou``,
+                ``f_score``, ``ap``, ``I``, ``U``, ``n_poly_pred``,
+                ``n_poly_gt``, ``poly_len``
+        """
+        records = np.zeros(len(batch["uniq_id"]), dtype=PREDICTION_DTYPE)
+        for i, uniq_id in enumerate(batch["uniq_id"]):
+            data = str(uniq_id).encode("utf-8")
+            records[i]["id"] = (self._write("ids", data), len(data))
+
+            polygons = batch["polygons"][i]
+            records[i]["polygons"] = (self._offsets["polygons"] // 16, len(polygons))
+            for polygon in polygons:
+                coords = np.asarray(polygon, dtype=np.float32).reshape(-1)
+                offset = self._write("coords", coords.tobytes()) // 4
+                self._write("polygons", np.array([offset, coords.size], dtype=np.int64).tobytes())
+
+            rle = batch["mask"][i]
+            if rle is not None:
+                counts = rle["counts"]
+                counts = counts.encode("ascii") if isinstance(counts, str) else counts
+                records[i]["mask"] = (self._write("masks", counts), len(counts))
+                records[i]["mask_size"] = rle["size"]
+        records["box"] = batch["box"]
+        for name in ("iou", "f_score", "ap", "I", "U", "n_poly_pred", "n_poly_gt", "poly_len"):
+            records[name] = batch[name]
+        # records go last, so that a reader never sees a record whose data is not written yet
+        for name in _FILES[1:]:
+            self._files[name].flush()
+        self._write("records", records.tobytes())
+        self._files["records"].flush()
+        self.num_records += len(records)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        meta = {"version": STORE_VERSION, "num_records": self.num_records}
+        # written last: a shard without meta.json is incomplete
+        with open(os.path.join(self.path, META_FILE), "w") as f:
+            json.dump(meta, f, indent=2)
+        return meta
+
+
+class PredictionShard(object):
+    def __init__(self, path):
+        self.path = path
+        self.complete = os.path.exists(os.path.join(path, META_FILE))
+        if self.complete:
+            with open(os.path.join(path, META_FILE)) as f:
+                meta = json.load(f)
+            assert meta["version"] == STORE_VERSION, "unsupported prediction store version {}".format(meta["version"])
+        self.records = self._load("records", PREDICTION_DTYPE)
+        self.polygon_index = self._load("polygons", np.int64).reshape(-1, 2)
+        self.coords = self._load("coords", np.float32)
+        self._ids = self._load("ids", np.uint8)
+        self._masks = self._load("masks", np.uint8)
+
+    def _load(self, name, dtype):
+        file_path = os.path.join(self.path, name + ".bin")
+        dtype = np.dtype(dtype)
+        # a partly written trailing row of a shard that is still being written is ignored
+        count = os.path.getsize(file_path) // dtype.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(file_path, dtype=dtype, mode="r", shape=(count,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def uniq_id(self, index):
+        offset, length = self.records[index]["id"]
+        return self._ids[offset:offset + length].tobytes().decode("utf-8")
+
+    def polygons(self, index):
+        start, count = self.records[index]["polygons"]
+        return [np.array(self.coords[offset:offset + length]) for offset, length in self.polygon_index[start:start + count]]
+
+    def to_dict(self, index, fields):
+        item = {}
+        for field in fields:
+            if field == "uniq_id":
+                item[field] = self.uniq_id(index)
+            elif field == "polygons":
+                item[field] = [polygon.tolist() for polygon in self.polygons(index)]
+            elif field == "mask":
+                rle = self.mask_rle(index)
+                item[field] = None if rle is None else {"size": rle["size"], "counts": rle["counts"].decode("ascii")}
+            else:
+                item[field] = self.records[index][field].tolist()
+        return item
+
+    def mask_rle(self, index):
+        offset, length = self.records[index]["mask"]
+        if length == 0:
+            return None
+        return {"size": [int(x) for x in self.records[index]["mask_size"]],
+                "counts": self._masks[offset:offset + length].tobytes()}
+
+
+class PredictionStore(object):
+    def __init__(self, store_dir, num_shards=None):
+        """Read-only view of the shards of a store, in rank order.
+
+        Args:
+            store_dir (str): store directory
+            num_shards (int, optional): read the shards of ranks
+                0..num_shards-1 only, e.g. to ignore the shards of an earlier
+                run with more ranks (default: all shards in *store_dir*)
+        """
+        self.store_dir = store_dir
+        if num_shards is None:
+            paths = sorted(glob.glob(os.path.join(store_dir, "shard_*")))
+        else:
+            paths = [shard_path(store_dir, rank) for rank in range(num_shards)]
+        self.shards = [PredictionShard(path) for path in paths]
+        self.complete = all(shard.complete for shard in self.shards)
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+    def column(self, name):
+        """One metric / record column of all samples, e.g. ``store.column("iou")``."""
+        if len(self.shards) == 0:
+            return np.zeros(0, dtype=PREDICTION_DTYPE[name])
+        return np.concatenate([np.asarray(shard.records[name]) for shard in self.shards])
+
+    def __iter__(self):
+        """Yield ``(shard, index)`` of every sample."""
+        for shard in self.shards:
+            for index in range(len(shard)):
+                yield shard, index
+
+    def uniq_ids(self):
+        for shard, index in self:
+            yield shard.uniq_id(index)
+
+    def write_json(self, output_path, fields=("uniq_id",), where=None):
+        """Write the samples as a JSON list of dicts with *fields*, one sample at a time.
+
+        *where*, if given, is a function ``(shard, index) -> bool`` selecting the samples.
+        """
+        with open(output_path, "w") as fw:
+            fw.write("[")
+            num_written = 0
+            for shard, index in self:
+                if where is not None and not where(shard, index):
+                    continue
+                fw.write((", " if num_written > 0 else "") + json.dumps(shard.to_dict(index, fields)))
+                num_written += 1
+            fw.write("]")
+        return num_written
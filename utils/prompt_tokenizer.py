@@ -0,0 +1,193 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+"""Tokenization of the referring expression prompt.
+
+Every expression is encoded as ``PROMPT_TEMPLATE.format(caption)``. The
+generic ``BertTokenizer`` re-tokenizes the whole template for every prompt,
+splits the text on every special token, and matches WordPiece pieces by
+hashing ever shorter substrings of each word. :class:`PromptTokenizer`
+produces the same token ids as ``BertTokenizer.encode`` (including
+``truncation=True, max_length=max_text_len``) faster:
+
+* the template text around the caption is tokenized once, and the caption
+  ids are spliced in between (exact, since BERT's basic tokenizer splits
+  on the whitespace around ``{}``)
+* WordPiece pieces are matched by walking a character trie of the
+  vocabulary (:class:`WordPieceTrie`), one step per character
+* the ids of recently seen captions are kept in a bounded LRU cache;
+  expressions repeat across epochs and serving requests
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Sequence, Tuple
+
+import torch
+
+PROMPT_TEMPLATE = ' which region does the text " {} " describe?'
+
+_END = ""  # trie key of the vocabulary id of a node; never a character
+
+
+class WordPieceTrie(object):
+    def __init__(self, vocab: Dict[str, int], unk_id: int, max_input_chars_per_word: int = 100):
+        """Greedy longest-match-first WordPiece over a character trie of *vocab*.
+
+        Gives the pieces of ``WordpieceTokenizer.tokenize`` (as ids) with
+        one trie step per character instead of a vocabulary lookup for every
+        candidate substring.
+        """
+        self.unk_id = unk_id
+        self.max_input_chars_per_word = max_input_chars_per_word
+        self.root: dict = {}  # pieces starting a word
+        self.suffix_root: dict = {}  # "##" pieces continuing a word, without the "##"
+        for token, index in vocab.items():
+            self._insert(self.root, token, index)
+            if token.startswith("##"):
+                self._insert(self.suffix_root, token[2:], index)
+
+    @staticmethod
+    def _insert(node, piece, index):
+        if not piece:
+            return
+        for char in piece:
+            node = node.setdefault(char, {})
+        # the first entry wins, like a vocabulary dict lookup of a duplicated token
+        node.setdefault(_END, index)
+
+    def tokenize(self, word: str) -> List[int]:
+        """Piece ids of one word of the basic tokenizer."""
+        if len(word) > self.max_input_chars_per_word:
+            return [self.unk_id]
+        ids = []
+        start = 0
+        root = self.root
+        while start < len(word):
+            node = root
+            piece_id = None
+            piece_end = start
+            for end in range(start, len(word)):
+                node = node.get(word[end])
+                if node is None:
+                    break
+                index = node.get(_END)
+                if index is not None:
+                    piece_id = index
+                    piece_end = end + 1
+            if piece_id is None:
+                return [self.unk_id]
+            ids.append(piece_id)
+            start = piece_end
+            root = self.suffix_root
+        return ids
+
+
+class PromptTokenizer(object):
+    def __init__(self, tokenizer, template: str = PROMPT_TEMPLATE, max_text_len: int = 0, cache_size: int = 65536):
+        """Token ids of ``template.format(caption)``, as ``tokenizer.encode`` gives them.
+
+        Args:
+            tokenizer (BertTokenizer): the tokenizer to reproduce, with its
+                vocabulary and basic tokenizer settings
+            template (str, optional): prompt with a ``{}`` for the caption
+            max_text_len (int, optional): truncate to this many ids, as
+                ``encode(truncation=True, max_length=max_text_len)`` (0 disables)
+            cache_size (int, optional): number of captions whose ids are
+                memoized (0 disables)
+        """
+        self.tokenizer = tokenizer
+        self.max_text_len = max_text_len
+        self.cache_size = cache_size
+        self.cls_id = tokenizer.cls_token_id
+        self.sep_id = tokenizer.sep_token_id
+        self.pad_id = tokenizer.pad_token_id
+        self.trie = WordPieceTrie(
+            tokenizer.vocab, tokenizer.vocab[tokenizer.unk_token],
+            tokenizer.wordpiece_tokenizer.max_input_chars_per_word,
+        )
+        # captions with these are tokenized by the generic tokenizer, which splits them out
+        self.no_split_tokens = list(tokenizer.unique_no_split_tokens) + list(tokenizer.added_tokens_encoder)
+        self.exact = tokenizer.do_basic_tokenize and not any(tok in template for tok in self.no_split_tokens)
+
+        self.template = template
+        prefix, suffix = template.split("{}")
+        # the caption is tokenized on its own if whitespace separates it from the template
+        self.splice = prefix[-1:].isspace() and suffix[:1].isspace()
+        if self.splice:
+            self.prefix_ids = self._text_ids(prefix)
+            self.suffix_ids = self._text_ids(suffix)
+
+        self._cache: "OrderedDict[str, Tuple[int, ...]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _text_ids(self, text: str) -> List[int]:
+        """``BertTokenizer._tokenize`` of *text* as ids, with trie WordPiece matching."""
+        basic_tokenizer = self.tokenizer.basic_tokenizer
+        vocab = self.tokenizer.vocab
+        if self.tokenizer.init_kwargs.get("do_lower_case", False):
+            text = text.lower()
+        ids = []
+        for token in basic_tokenizer.tokenize(text, never_split=self.tokenizer.all_special_tokens):
+            if token in basic_tokenizer.never_split:
+                ids.append(vocab.get(token, self.trie.unk_id))
+            else:
+                ids.extend(self.trie.tokenize(token))
+        return ids
+
+    def _encode(self, caption: str) -> List[int]:
+        if not self.exact or any(tok in caption for tok in self.no_split_tokens):
+            prompt = self.template.format(caption)
+            if self.max_text_len and self.max_text_len > 0:
+                return self.tokenizer.encode(prompt, truncation=True, max_length=self.max_text_len)
+            return self.tokenizer.encode(prompt)
+        if self.splice:
+            body = self.prefix_ids + self._text_ids(caption) + self.suffix_ids
+        else:
+            body = self._text_ids(self.template.format(caption))
+        if self.max_text_len and self.max_text_len > 0:
+            body = body[:max(self.max_text_len - 2, 0)]
+        return [self.cls_id] + body + [self.sep_id]
+
+    def encode(self, caption: str) -> List[int]:
+        """Ids of ``[CLS] template.format(caption) [SEP]``."""
+        if self.cache_size <= 0:
+            return self._encode(caption)
+        with self._lock:
+            ids = self._cache.get(caption)
+            if ids is not None:
+                self._cache.move_to_end(caption)
+                self.hits += 1
+                return list(ids)
+        ids = self._encode(caption)
+        with self._lock:
+            self.misses += 1
+            self._cache[caption] = tuple(ids)
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ids
+
+    def batch_encode(self, captions: Sequence[str]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """``input_ids`` and ``attention_mask`` of the prompts of *captions*, padded to the longest."""
+        return self.pad([self.encode(caption) for caption in captions])
+
+    def pad(self, token_ids: Sequence[Sequence[int]]) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Right-pad token id sequences to the longest, with their attention mask."""
+        lengths = torch.LongTensor([len(ids) for ids in token_ids])
+        input_ids = torch.full((len(token_ids), int(lengths.max())), self.pad_id, dtype=torch.long)
+        for i, ids in enumerate(token_ids):
+            input_ids[i, :len(ids)] = torch.as_tensor(ids, dtype=torch.long)
+        attention_mask = (torch.arange(input_ids.size(1))[None, :] < lengths[:, None]).long()
+        return input_ids, attention_mask
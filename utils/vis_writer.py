@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------------
+# Modifications Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: Apache-2.0
+
+import multiprocessing
+import os
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+from pycocotools import mask as mask_utils
+
+from utils.mask_scoring import encode_mask
+from utils.vis_utils import overlay_predictions
+
+
+def write_visualization(vis_dir, name, image, pred_rle, pred_polygons, pred_box, gt_rle, gt_box):
+    """Write the image and its prediction / ground truth overlays as ``<name>*.png`` to *vis_dir*."""
+    pred_overlayed = overlay_predictions(image, mask_utils.decode(pred_rle), pred_polygons, pred_box)
+    gt_overlayed = overlay_predictions(image, mask_utils.decode(gt_rle), None, gt_box)
+
+    Image.fromarray(pred_overlayed.astype(np.uint8)).save(os.path.join(vis_dir, f"{name}_pred_overlayed.png"))
+    Image.fromarray(gt_overlayed.astype(np.uint8)).save(os.path.join(vis_dir, f"{name}_gt_overlayed.png"))
+    Image.fromarray(image).save(os.path.join(vis_dir, f"{name}.png"))
+
+
+class VisWriter(object):
+    def __init__(self, vis_dir, num_workers=2, every=1, iou_below=None, max_pending=None):
+        """Write evaluation visualizations on a pool of background processes.
+
+        Samples are handed over in a compact form (uint8 image, RLE masks,
+        polygons and boxes), and the blending, contour dilation and PNG
+        encoding run in the workers. Submitting blocks while *max_pending*
+        samples (default: 8 per worker) are waiting, so a slow disk can not
+        pile up images in memory.
+
+        Args:
+            vis_dir (str): output directory
+            num_workers (int, optional): worker processes, 0 to write inline
+            every (int, optional): visualize about one in *every* samples,
+                chosen by a hash of the sample id, so the same samples are
+                picked no matter the batch order or number of GPUs
+            iou_below (float, optional): only visualize samples whose IoU is
+                below this threshold (failure cases)
+        """
+        self.vis_dir = vis_dir
+        self.every = max(1, every)
+        self.iou_below = iou_below
+        os.makedirs(vis_dir, exist_ok=True)
+
+        self.executor = None
+        self.errors = []
+        if num_workers > 0:
+            # spawned, since the evaluating process holds a CUDA context and threads
+            self.executor = ProcessPoolExecutor(num_workers, mp_context=multiprocessing.get_context("spawn"))
+            self.slots = threading.BoundedSemaphore(max_pending if max_pending is not None else 8 * num_workers)
+
+    def wanted(self, uniq_id, iou):
+        if self.iou_below is not None and iou >= self.iou_below:
+            return False
+        return self.every == 1 or zlib.crc32(str(uniq_id).encode("utf-8")) % self.every == 0
+
+    def submit(self, name, image, pred_mask, pred_polygons, pred_box, gt_mask, gt_box):
+        args = (self.vis_dir, name, image, encode_mask(pred_mask), pred_polygons, pred_box, encode_mask(gt_mask), gt_box)
+        if self.executor is None:
+            write_visualization(*args)
+            return
+        self.slots.acquire()
+        future = self.executor.submit(write_visualization, *args)
+        future.add_done_callback(self._done)
+
+    def _done(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.errors.append(future.exception())
+
+    def close(self):
+        """Wait for the queued samples; raise the first error of a worker, if any."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        if len(self.errors) > 0:
+            raise self.errors[0]